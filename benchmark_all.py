@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+
+'''
+This is the benchmark file
+for the hot paths of the
+conversion library.
+
+To run the benchmarks use:
+python3 benchmark_all.py
+
+The results can be written as json and
+compared against a stored baseline:
+python3 benchmark_all.py --output results.json
+python3 benchmark_all.py --baseline results.json
+'''
+
+import argparse
+import json
+import math
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import gfzwpsformatconversions
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+GRID_CELLS = [1000, 10000, 100000, 1000000]
+EVENTS = [100, 1000, 10000, 100000]
+# smaller memory peaks are compared with this value,
+# so that a peak near 0 still has a regression signal
+MIN_MEMORY_BYTES = 1024 * 1024
+MEMORY_KEYS = ('peak_memory_bytes', 'peak_rss_bytes')
+
+
+def _read_testinput(filename):
+    '''
+    Reads the content of a file in the testinputs folder.
+    '''
+    path = os.path.join(os.path.dirname(__file__), 'testinputs', filename)
+    with open(path, 'rb') as input_file:
+        return input_file.read()
+
+
+def _measure_seconds(function, repeat=5):
+    '''
+    Returns the best wall time of the function calls.
+    '''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def _measure_peak_memory(function):
+    '''
+    Returns the peak of the memory allocated
+    (by python and numpy) during the function call.
+    '''
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def _get_max_rss():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return max_rss
+    # kilobytes on linux
+    return max_rss * 1024
+
+
+def _measure_peak_rss(function):
+    '''
+    Returns the growth of the peak resident memory during the
+    function call (including the native allocations of lxml,
+    which tracemalloc doesn't see) or None if it can't be
+    measured on the platform.
+    The function runs in a forked process, so that the peak
+    of the earlier measurements doesn't hide it.
+    '''
+    if resource is None or not hasattr(os, 'fork'):
+        return None
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_fd)
+            before = _get_max_rss()
+            function()
+            os.write(
+                write_fd,
+                str(max(0, _get_max_rss() - before)).encode('ascii')
+            )
+        finally:
+            os._exit(0)  # pylint: disable=protected-access
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as read_file:
+        content = read_file.read()
+    os.waitpid(pid, 0)
+    if not content:
+        return None
+    return int(content)
+
+
+def _create_shakemap(n_cells, seed=42):
+    '''
+    Creates a synthetic shakemap with about n_cells grid cells.
+    '''
+    nlon = int(math.ceil(math.sqrt(n_cells)))
+    nlat = int(math.ceil(n_cells / nlon))
+    return gfzwpsformatconversions.Shakemap.from_stream(
+        gfzwpsformatconversions.generate_shakemap(nlat, nlon, seed=seed)
+    )
+
+
+def _run_case(name, size, unit, function, repeat):
+    '''
+    Measures the time and the peak memory
+    of the function and returns the result entry.
+    '''
+    seconds = _measure_seconds(function, repeat)
+    peak_memory = _measure_peak_memory(function)
+    peak_rss = _measure_peak_rss(function)
+    result = {
+        'benchmark': name,
+        'size': size,
+        'unit': unit,
+        'seconds': seconds,
+        'throughput': size / seconds if seconds > 0 else math.inf,
+        'peak_memory_bytes': peak_memory,
+        'peak_rss_bytes': peak_rss,
+    }
+    print(
+        '{:<40} {:>8} {:<6} {:>10.4f} s {:>14.0f} {}/s {:>10.1f} MB '
+        '{:>10} MB rss'.format(
+            name,
+            size,
+            unit,
+            seconds,
+            result['throughput'],
+            unit,
+            peak_memory / 1024 / 1024,
+            '-' if peak_rss is None else '{:.1f}'.format(
+                peak_rss / 1024 / 1024
+            )
+        )
+    )
+    return result
+
+
+def benchmark_shakemap(grid_cells, repeat=3):
+    '''
+    Measures the conversion of the shakemap grid to a
+    dataframe and of the dataframe to a raster.
+    '''
+    results = []
+    for n_cells in grid_cells:
+        shakemap = _create_shakemap(n_cells)
+        # the grid array is cached in the shakemap, so every
+        # measurement starts with a fresh instance
+        xml = shakemap.to_xml()
+        size = len(shakemap.to_grid_array())
+        results.append(_run_case(
+            'Shakemap.to_intensity_dataframe',
+            size,
+            'cells',
+            lambda: gfzwpsformatconversions.Shakemap.from_xml(
+                xml
+            ).to_intensity_dataframe(),
+            repeat
+        ))
+        dataframe = shakemap.to_intensity_dataframe()
+        results.append(_run_case(
+            'Shakemap.dataframe2raster',
+            size,
+            'cells',
+            lambda: gfzwpsformatconversions.Shakemap.dataframe2raster(
+                dataframe,
+                'LON',
+                'LAT',
+                'value_PGA'
+            ),
+            repeat
+        ))
+    return results
+
+
+def benchmark_quakeml(events, repeat=3):
+    '''
+    Measures the conversions of quakeml to a dataframe
+    and of a dataframe to quakeml.
+    '''
+    results = []
+    for n_events in events:
+        dataframe = gfzwpsformatconversions.generate_event_dataframe(
+            n_events,
+            seed=42
+        )
+        quakeml_dataframe = \
+            gfzwpsformatconversions.QuakeMLDataframe.from_dataframe(dataframe)
+        results.append(_run_case(
+            'QuakeMLDataframe.to_xml',
+            n_events,
+            'events',
+            quakeml_dataframe.to_xml,
+            repeat
+        ))
+        quakeml = gfzwpsformatconversions.QuakeML.from_xml(
+            quakeml_dataframe.to_xml()
+        )
+        results.append(_run_case(
+            'QuakeML.to_dataframe',
+            n_events,
+            'events',
+            quakeml.to_dataframe,
+            repeat
+        ))
+    return results
+
+
+def benchmark_fragility_lookup_table(n_values=1000000):
+    '''
+    Compares the exact evaluation of the fragility
+    functions with the evaluation using the lookup table.
+    '''
+    fragility = gfzwpsformatconversions.Fragility.from_string(
+        _read_testinput('fragility_sara.json')
+    )
+    fragility_with_table = fragility.with_lookup_table(
+        intensity_max=3.0,
+        n_points=2048
+    )
+    random = np.random.default_rng(42)
+    intensities = random.uniform(0.0, 3.0, n_values)
+    taxonomy_indices = random.integers(
+        0,
+        len(fragility.get_taxonomies()),
+        n_values
+    )
+
+    exact_seconds = _measure_seconds(
+        lambda: fragility.to_exceedance_probabilities(
+            intensities,
+            taxonomy_indices
+        )
+    )
+    table_seconds = _measure_seconds(
+        lambda: fragility_with_table.to_exceedance_probabilities(
+            intensities,
+            taxonomy_indices
+        )
+    )
+    print('fragility {} values'.format(n_values))
+    print('  exact cdf:    {:.4f} s'.format(exact_seconds))
+    print('  lookup table: {:.4f} s'.format(table_seconds))
+    print('  speedup:      {:.2f}x'.format(exact_seconds / table_seconds))
+    print('  max error:    {:.2e}'.format(
+        fragility_with_table.get_lookup_table_max_error()
+    ))
+
+
+def compare_with_baseline(results, baseline, tolerance=0.25):
+    '''
+    Returns a list with the descriptions of the results that are
+    slower or need more memory than the baseline (by more
+    than the tolerance).
+    Memory peaks below MIN_MEMORY_BYTES are compared with
+    MIN_MEMORY_BYTES and values that were not measured (None
+    or missing in older baselines) are skipped.
+    '''
+    baseline_entries = {
+        (entry['benchmark'], entry['size']): entry
+        for entry in baseline['results']
+    }
+    regressions = []
+    for entry in results:
+        baseline_entry = baseline_entries.get(
+            (entry['benchmark'], entry['size'])
+        )
+        if baseline_entry is None:
+            continue
+        for key in ('seconds',) + MEMORY_KEYS:
+            value = entry.get(key)
+            baseline_value = baseline_entry.get(key)
+            if value is None or baseline_value is None:
+                continue
+            if key in MEMORY_KEYS:
+                value = max(value, MIN_MEMORY_BYTES)
+                baseline_value = max(baseline_value, MIN_MEMORY_BYTES)
+            elif baseline_value <= 0:
+                continue
+            ratio = value / baseline_value
+            if ratio > 1 + tolerance:
+                regressions.append(
+                    '{} ({} {}): {} {:.2f}x of the baseline'.format(
+                        entry['benchmark'],
+                        entry['size'],
+                        entry['unit'],
+                        key,
+                        ratio
+                    )
+                )
+    return regressions
+
+
+def _parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks for the conversion library.'
+    )
+    parser.add_argument(
+        '--max-cells',
+        type=int,
+        default=GRID_CELLS[-1],
+        help='largest number of shakemap grid cells'
+    )
+    parser.add_argument(
+        '--max-events',
+        type=int,
+        default=EVENTS[-1],
+        help='largest number of quakeml events'
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help='number of runs per measurement (the best is used)'
+    )
+    parser.add_argument(
+        '--output',
+        help='file to write the results as json'
+    )
+    parser.add_argument(
+        '--baseline',
+        help='json file with results to compare with'
+    )
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.25,
+        help='allowed relative slowdown compared to the baseline'
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    '''
+    Runs all the benchmarks.
+    Returns 1 if there are regressions compared to the baseline.
+    '''
+    arguments = _parse_arguments(argv)
+    benchmark_fragility_lookup_table()
+
+    results = benchmark_shakemap(
+        [n for n in GRID_CELLS if n <= arguments.max_cells],
+        arguments.repeat
+    ) + benchmark_quakeml(
+        [n for n in EVENTS if n <= arguments.max_events],
+        arguments.repeat
+    )
+    output = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'results': results,
+    }
+    if arguments.output is not None:
+        with open(arguments.output, 'w') as output_file:
+            json.dump(output, output_file, indent=2)
+
+    if arguments.baseline is not None:
+        with open(arguments.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare_with_baseline(
+            results,
+            baseline,
+            arguments.tolerance
+        )
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+
+'''
+This is the command line converter for
+the data formats of the wps processes.
+
+It converts quakeml to csv or parquet,
+shakemaps to geotiff, npy or parquet and
+dataframes (csv or parquet) back to quakeml.
+
+To convert all the files of a folder use:
+python3 gfzwpsconvert.py --to csv --output-dir out testinputs
+
+Outputs that are up to date with their input
+are skipped. The state is stored in the
+.gfzwps-convert.json file of the output folder.
+'''
+
+import argparse
+import collections
+import concurrent.futures
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+
+import lxml.etree as le
+import numpy as np
+import pandas as pd
+
+import gfzwpsformatconversions
+
+STATE_FILENAME = '.gfzwps-convert.json'
+
+COMPRESSION_SUFFIXES = ('.gz', '.zst')
+INPUT_SUFFIXES = {
+    '.xml': 'xml',
+    '.csv': 'dataframe',
+    '.parquet': 'dataframe',
+}
+TARGET_FORMATS = {
+    'quakeml': ('csv', 'parquet'),
+    'shakemap': ('tif', 'npy', 'parquet'),
+    'dataframe': ('xml',),
+}
+
+
+def _split_suffixes(path):
+    '''
+    Returns the path without the compression and
+    data suffixes and the data suffix.
+    '''
+    base = path
+    for suffix in COMPRESSION_SUFFIXES:
+        if base.endswith(suffix):
+            base = base[:-len(suffix)]
+            break
+    base, suffix = os.path.splitext(base)
+    return base, suffix.lower()
+
+
+def find_input_files(patterns):
+    '''
+    Returns the sorted input files for the
+    given files, folders and glob patterns.
+    Files in folders and matches of patterns are
+    only used if they have a supported suffix.
+    '''
+    result = set()
+    for pattern in patterns:
+        if os.path.isfile(pattern):
+            result.add(pattern)
+            continue
+        if os.path.isdir(pattern):
+            candidates = [
+                os.path.join(pattern, name)
+                for name in os.listdir(pattern)
+            ]
+        else:
+            candidates = glob.glob(pattern, recursive=True)
+        for candidate in candidates:
+            if os.path.isfile(candidate) and \
+                    _split_suffixes(candidate)[1] in INPUT_SUFFIXES:
+                result.add(candidate)
+    return sorted(result)
+
+
+def get_target_path(source, target_format, output_dir=None):
+    '''
+    Returns the path of the converted file.
+    Without an output folder it is written next to the source.
+    '''
+    base, _ = _split_suffixes(source)
+    if output_dir is not None:
+        base = os.path.join(output_dir, os.path.basename(base))
+    return base + '.' + target_format
+
+
+def find_target_conflicts(sources, target_format, output_dir=None):
+    '''
+    Returns a dict with the targets that more than one of
+    the sources would be converted to (for example x.xml and
+    x.xml.gz or files with the same name in two folders
+    and one output folder) and the list of those sources.
+    '''
+    sources_by_target = collections.defaultdict(list)
+    for source in sources:
+        target = get_target_path(source, target_format, output_dir)
+        sources_by_target[os.path.normcase(os.path.abspath(target))].append(
+            source
+        )
+    return {
+        target: target_sources
+        for target, target_sources in sources_by_target.items()
+        if len(target_sources) > 1
+    }
+
+
+def _hash_file(path, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _read_xml(path):
+    '''
+    Reads the xml file and returns the kind of
+    the content ('quakeml' or 'shakemap') and the wrapper.
+    '''
+    with open(path, 'rb') as input_file:
+        xml = gfzwpsformatconversions.parse_xml_stream(
+            input_file,
+            stage_name='convert.parse_xml'
+        )
+    tag = le.QName(xml).localname
+    if tag == 'shakemap_grid':
+        return 'shakemap', gfzwpsformatconversions.Shakemap.from_xml(xml)
+    if tag in ('quakeml', 'eventParameters'):
+        return 'quakeml', gfzwpsformatconversions.QuakeML.from_xml(xml)
+    raise Exception('Unknown xml content {} in {}'.format(tag, path))
+
+
+def _write_shakemap(shakemap, target, target_format, field):
+    '''
+    Writes the shakemap and returns the number of grid cells.
+    '''
+    if target_format == 'npy':
+        grid_array = shakemap.to_grid_array()
+        np.save(target, grid_array)
+        return len(grid_array)
+    if target_format == 'parquet':
+        dataframe = shakemap.to_intensity_dataframe()
+        dataframe.to_parquet(target)
+        return len(dataframe)
+    bands = None if field is None else [field]
+    shakemap.to_geotiff(target, bands=bands, overviews=True)
+    return len(shakemap.to_grid_array())
+
+
+def convert_file(source, target, target_format, field=None):
+    '''
+    Converts the source file to the target format and
+    returns the number of converted records
+    (events, grid cells or rows).
+    '''
+    kind = INPUT_SUFFIXES.get(_split_suffixes(source)[1])
+    if kind is None:
+        raise Exception('Unsupported input file {}'.format(source))
+    if kind == 'xml':
+        kind, data = _read_xml(source)
+    elif _split_suffixes(source)[1] == '.parquet':
+        data = pd.read_parquet(source)
+    else:
+        data = pd.read_csv(source)
+
+    if target_format not in TARGET_FORMATS[kind]:
+        raise Exception('Can not convert {} from {} to {}'.format(
+            source, kind, target_format
+        ))
+
+    # write in a temporary file, so that no partial
+    # outputs remain on errors
+    base, suffix = os.path.splitext(target)
+    temporary = base + '.partial' + suffix
+    try:
+        if kind == 'quakeml':
+            dataframe = data.to_dataframe()
+            if target_format == 'csv':
+                dataframe.to_csv(temporary, index=False)
+            else:
+                dataframe.to_parquet(temporary)
+            n_records = len(dataframe)
+        elif kind == 'shakemap':
+            n_records = _write_shakemap(data, temporary, target_format, field)
+        else:
+            gfzwpsformatconversions.QuakeMLDataframe.from_dataframe(
+                data
+            ).write(temporary)
+            n_records = len(data)
+        os.replace(temporary, target)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+    return n_records
+
+
+class ConversionState():
+    '''
+    Class for the state of the converted files in
+    an output folder to skip the outputs that
+    are up to date.
+
+    An output is up to date if the source has the same
+    modification time as on the last conversion or (if
+    the modification time differs) if it has the same hash.
+    '''
+    def __init__(self, path):
+        self._path = path
+        self._entries = {}
+        if os.path.exists(path):
+            with open(path) as state_file:
+                self._entries = json.load(state_file)
+
+    def _get_key(self, target):
+        return os.path.relpath(target, os.path.dirname(self._path))
+
+    def is_up_to_date(self, source, target, options):
+        '''
+        Returns true if the target doesn't need a conversion.
+        '''
+        entry = self._entries.get(self._get_key(target))
+        if entry is None or not os.path.exists(target):
+            return False
+        if entry['options'] != options:
+            return False
+        mtime_ns = os.stat(source).st_mtime_ns
+        if entry['mtime_ns'] == mtime_ns:
+            return True
+        if entry['sha256'] != _hash_file(source):
+            return False
+        entry['mtime_ns'] = mtime_ns
+        return True
+
+    def update(self, source, target, options):
+        '''
+        Stores the state of the source after the conversion.
+        '''
+        self._entries[self._get_key(target)] = {
+            'options': options,
+            'mtime_ns': os.stat(source).st_mtime_ns,
+            'sha256': _hash_file(source),
+        }
+
+    def save(self):
+        '''
+        Writes the state file.
+        '''
+        temporary = self._path + '.partial'
+        with open(temporary, 'w') as state_file:
+            json.dump(self._entries, state_file, indent=2, sort_keys=True)
+        os.replace(temporary, self._path)
+
+
+def _parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description='Converts quakeml, shakemaps and dataframes.'
+    )
+    parser.add_argument(
+        'inputs',
+        nargs='+',
+        help='input files, folders or glob patterns'
+    )
+    parser.add_argument(
+        '--to',
+        required=True,
+        choices=['csv', 'parquet', 'tif', 'npy', 'xml'],
+        help='target format'
+    )
+    parser.add_argument(
+        '--output-dir',
+        help='folder for the converted files (default: next to the input)'
+    )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        help='number of worker processes'
+    )
+    parser.add_argument(
+        '--field',
+        help='shakemap field for the geotiff (default: all of them)'
+    )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='convert even if the outputs are up to date'
+    )
+    return parser.parse_args(argv)
+
+
+def _get_state(states, target):
+    directory = os.path.dirname(os.path.abspath(target))
+    if directory not in states:
+        states[directory] = ConversionState(
+            os.path.join(directory, STATE_FILENAME)
+        )
+    return states[directory]
+
+
+def main(argv=None):
+    '''
+    Runs the conversions.
+    Returns 1 if a conversion failed or if
+    sources have the same target (those are not converted).
+    '''
+    arguments = _parse_arguments(argv)
+    if arguments.output_dir is not None:
+        os.makedirs(arguments.output_dir, exist_ok=True)
+    options = {'to': arguments.to, 'field': arguments.field}
+
+    start = time.perf_counter()
+    states = {}
+    tasks = []
+    n_skipped = 0
+    sources = find_input_files(arguments.inputs)
+    # sources with the same target would overwrite each other
+    conflicts = find_target_conflicts(
+        sources,
+        arguments.to,
+        arguments.output_dir
+    )
+    conflicting = set()
+    for target, target_sources in sorted(conflicts.items()):
+        for source in target_sources:
+            conflicting.add(source)
+            print('FAILED {}: the target {} is also used by {}'.format(
+                source,
+                target,
+                ', '.join(other for other in target_sources if other != source)
+            ))
+    for source in sources:
+        if source in conflicting:
+            continue
+        target = get_target_path(source, arguments.to, arguments.output_dir)
+        state = _get_state(states, target)
+        if not arguments.force and \
+                state.is_up_to_date(source, target, options):
+            n_skipped += 1
+            continue
+        tasks.append((source, target, state))
+
+    n_records = 0
+    n_bytes = 0
+    failures = []
+    executor_class = concurrent.futures.ThreadPoolExecutor \
+        if arguments.jobs <= 1 else concurrent.futures.ProcessPoolExecutor
+    with executor_class(max(arguments.jobs, 1)) as executor:
+        futures = {
+            executor.submit(
+                convert_file,
+                source,
+                target,
+                arguments.to,
+                arguments.field
+            ): (source, target, state)
+            for source, target, state in tasks
+        }
+        for future in concurrent.futures.as_completed(futures):
+            source, target, state = futures[future]
+            try:
+                n_records += future.result()
+            except Exception as exception:  # pylint: disable=broad-except
+                failures.append(source)
+                print('FAILED {}: {}'.format(source, exception))
+                continue
+            n_bytes += os.path.getsize(source)
+            state.update(source, target, options)
+            print('{} -> {}'.format(source, target))
+
+    for state in states.values():
+        state.save()
+
+    seconds = time.perf_counter() - start
+    n_converted = len(tasks) - len(failures)
+    print(
+        '{} converted, {} up to date, {} failed in {:.2f} s'.format(
+            n_converted, n_skipped, len(failures) + len(conflicting), seconds
+        )
+    )
+    if seconds > 0 and n_converted > 0:
+        print('{:.1f} files/s, {:.0f} records/s, {:.2f} MB/s'.format(
+            n_converted / seconds,
+            n_records / seconds,
+            n_bytes / seconds / 1024 / 1024
+        ))
+    if failures or conflicting:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,17 +12,77 @@ https://raw.githubusercontent.com/gfzriesgos/quakeledger/master/quakeml.py
 '''
 
 import collections
+import contextlib
+import datetime
+import functools
+import gzip
+import hashlib
+import importlib
+import json
 import math
 import io
+import logging
+import operator
+import os
+import tempfile
+import threading
+import time
 import tokenize
+import tracemalloc
+import warnings
+import zlib
 
-import geopandas as gpd
-import georasters as gr
 import lxml.etree as le
 import numpy as np
 import pandas as pd
 
-from osgeo import osr
+
+class _LazyModule():
+    '''
+    Module that is imported on the first access
+    of one of its attributes.
+    The submodules are imported together with the module.
+
+    The geospatial libraries (and scipy) take a lot of time
+    to import, but they are only needed for some of the
+    conversions.
+    '''
+    def __init__(self, name, submodules=()):
+        self._name = name
+        self._submodules = submodules
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            module = importlib.import_module(self._name)
+            for submodule in self._submodules:
+                importlib.import_module(self._name + '.' + submodule)
+            self._module = module
+        return self._module
+
+    def __getattr__(self, attribute):
+        if attribute.startswith('_'):
+            raise AttributeError(attribute)
+        return getattr(self._load(), attribute)
+
+
+gpd = _LazyModule('geopandas')
+gr = _LazyModule('georasters')
+osr = _LazyModule('osgeo.osr')
+rasterio = _LazyModule(
+    'rasterio',
+    ('enums', 'features', 'shutil', 'transform', 'windows')
+)
+scipy = _LazyModule('scipy', ('sparse', 'special'))
+shapely = _LazyModule('shapely', ('geometry',))
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
 
 
 def _add_quakeml_namespace(element):
@@ -64,6 +124,480 @@ def _utc2event(utc):
     ]
 
 
+def _iterate_chunks(stream, chunk_size):
+    '''
+    Returns an iterator over the byte chunks
+    of a streaming http response, a file like object
+    or an iterable of chunks.
+    '''
+    if hasattr(stream, 'iter_content'):
+        return stream.iter_content(chunk_size)
+    if hasattr(stream, 'read'):
+        return iter(lambda: stream.read(chunk_size), b'')
+    return iter(stream)
+
+
+def _check_zstandard():
+    if zstandard is None:
+        raise Exception(
+            'The zstandard package is needed for zstd compressed data'
+        )
+
+
+def _create_decompressor(head):
+    '''
+    Returns a decompressor for gzip or zstd
+    data (detected by the magic bytes) or None
+    for uncompressed data.
+    '''
+    if head.startswith(GZIP_MAGIC):
+        return zlib.decompressobj(zlib.MAX_WBITS | 16)
+    if head.startswith(ZSTD_MAGIC):
+        _check_zstandard()
+        return zstandard.ZstdDecompressor().decompressobj()
+    return None
+
+
+def _decompress_chunks(chunks):
+    '''
+    Returns an iterator over the decompressed chunks
+    if the data is gzip or zstd compressed.
+    Otherwise the chunks are given back as they are.
+    '''
+    chunks = iter(chunks)
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= len(ZSTD_MAGIC):
+            break
+    decompressor = _create_decompressor(head)
+    if decompressor is None:
+        yield head
+        yield from chunks
+        return
+    yield decompressor.decompress(head)
+    for chunk in chunks:
+        yield decompressor.decompress(chunk)
+    if hasattr(decompressor, 'flush'):
+        yield decompressor.flush()
+
+
+def _read_content(value, chunk_size=64 * 1024):
+    '''
+    Returns the (decompressed) content of a string, bytes,
+    a file like object, a streaming http response or
+    an iterable of byte chunks.
+    '''
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bytes):
+        if _create_decompressor(value[:len(ZSTD_MAGIC)]) is None:
+            return value
+        value = [value]
+    return b''.join(_decompress_chunks(_iterate_chunks(value, chunk_size)))
+
+
+def _infer_compression(path):
+    if path.endswith('.gz'):
+        return 'gzip'
+    if path.endswith('.zst'):
+        return 'zstd'
+    return None
+
+
+@contextlib.contextmanager
+def _open_writer(target, compression='infer'):
+    '''
+    Returns a binary file object for writing in the path
+    or in the file object with gzip or zstd compression.
+    With compression='infer' the compression is chosen
+    by the file extension (.gz or .zst).
+    '''
+    if isinstance(target, (str, os.PathLike)):
+        with open(target, 'wb') as output_file:
+            if compression == 'infer':
+                compression = _infer_compression(os.fspath(target))
+            with _open_writer(output_file, compression) as writer:
+                yield writer
+        return
+    if compression == 'infer':
+        name = getattr(target, 'name', None)
+        compression = _infer_compression(name) if isinstance(
+            name, str
+        ) else None
+    if compression is None:
+        yield target
+    elif compression == 'gzip':
+        with gzip.GzipFile(fileobj=target, mode='wb') as writer:
+            yield writer
+    elif compression == 'zstd':
+        _check_zstandard()
+        writer = zstandard.ZstdCompressor().stream_writer(
+            target,
+            closefd=False
+        )
+        with writer:
+            yield writer
+    else:
+        raise Exception('Unsupported compression: {}'.format(compression))
+
+
+def _write_xml(xml, target, compression):
+    with _open_writer(target, compression) as writer:
+        le.ElementTree(xml).write(
+            writer,
+            encoding='UTF-8',
+            xml_declaration=True
+        )
+
+
+_encode_json_string = json.encoder.encode_basestring_ascii
+
+
+def _write_json(data, target, compression):
+    with _open_writer(target, compression) as writer:
+        text_writer = io.TextIOWrapper(writer, encoding='utf-8')
+        json.dump(data, text_writer)
+        text_writer.flush()
+        text_writer.detach()
+
+
+def parse_xml_stream(stream, chunk_size=64 * 1024, stage_name='parse_xml'):
+    '''
+    Parses the xml of the stream (an iterable of byte chunks,
+    a file object or a streaming requests response) while the
+    chunks arrive, so that the complete document is never hold
+    as one bytes object in memory, and returns the root element.
+    Gzip or zstd compressed data is decompressed
+    on the fly.
+    '''
+    with _stage(stage_name) as stage:
+        parser = le.XMLParser(huge_tree=True)
+        n_bytes = 0
+        for chunk in _decompress_chunks(_iterate_chunks(stream, chunk_size)):
+            if chunk:
+                n_bytes += len(chunk)
+                parser.feed(chunk)
+        stage.count = n_bytes
+        return parser.close()
+
+
+StageMeasurement = collections.namedtuple(
+    'StageMeasurement',
+    ['stage', 'seconds', 'count', 'peak_memory_bytes']
+)
+
+_INSTRUMENTATION = {
+    'sinks': [],
+    # the sinks that asked for the memory tracing
+    'memory_sinks': [],
+    # the stages (of all threads) that trace the memory
+    'traced_stages': [],
+    'started_tracing': False,
+}
+
+# tracemalloc is global for the process, so the
+# memory tracing of the threads is synchronized
+_INSTRUMENTATION_LOCK = threading.Lock()
+
+
+def add_instrumentation_sink(sink, trace_memory=False):
+    '''
+    Adds a sink (a callable like CounterRegistry, LoggingSink
+    or any function) that gets a StageMeasurement for every stage
+    of the conversions.
+    With trace_memory the peak memory of the stages is
+    measured with tracemalloc (this is slow).
+    '''
+    with _INSTRUMENTATION_LOCK:
+        _INSTRUMENTATION['sinks'] = _INSTRUMENTATION['sinks'] + [sink]
+        if trace_memory:
+            _INSTRUMENTATION['memory_sinks'] = (
+                _INSTRUMENTATION['memory_sinks'] + [sink]
+            )
+
+
+def remove_instrumentation_sink(sink):
+    '''
+    Removes the sink.
+    If there is no sink left that asked for the memory
+    tracing it is disabled.
+    '''
+    with _INSTRUMENTATION_LOCK:
+        for key in ('sinks', 'memory_sinks'):
+            _INSTRUMENTATION[key] = [
+                other for other in _INSTRUMENTATION[key]
+                if other != sink
+            ]
+
+
+class _NoStage():
+    '''
+    Stage that does nothing, used if there are no sinks.
+    '''
+    count = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+def _update_traced_peaks():
+    '''
+    Gives the peak memory since the last reset to all
+    running traced stages and resets the peak (only if the
+    tracing was started by the stages, so that the peak
+    of a tracing session of the user is kept).
+    Must be called with the instrumentation lock.
+    '''
+    peak = tracemalloc.get_traced_memory()[1]
+    for stage in _INSTRUMENTATION['traced_stages']:
+        stage.peak = max(stage.peak, peak)
+    if _INSTRUMENTATION['started_tracing']:
+        tracemalloc.reset_peak()
+
+
+class _Stage():
+    '''
+    Stage that measures the wall time (and the memory peak)
+    and gives the measurement to the sinks.
+    The count (of values, rows or events) can be set
+    inside of the with block.
+
+    tracemalloc is started by the first traced stage
+    (of any thread) and stopped after the last one.
+    As the memory is traced for the whole process, the peak
+    of a stage includes the memory of the stages running in
+    other threads at the same time.
+    If tracemalloc was already started by the user, its peak
+    is not reset, so the peak of a stage is the peak since
+    the last reset of the user.
+    '''
+    def __init__(self, name, sinks, trace_memory):
+        self.name = name
+        self.count = None
+        self.peak = 0
+        self._sinks = sinks
+        self._trace_memory = trace_memory
+        self._start = None
+
+    def __enter__(self):
+        if self._trace_memory:
+            with _INSTRUMENTATION_LOCK:
+                if not _INSTRUMENTATION['traced_stages'] and \
+                        not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    _INSTRUMENTATION['started_tracing'] = True
+                # keep the peak so far for the enclosing stages
+                _update_traced_peaks()
+                _INSTRUMENTATION['traced_stages'].append(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        seconds = time.perf_counter() - self._start
+        peak = None
+        if self._trace_memory:
+            with _INSTRUMENTATION_LOCK:
+                # the enclosing stages get the peak on the next reset
+                peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+                _INSTRUMENTATION['traced_stages'].remove(self)
+                if not _INSTRUMENTATION['traced_stages'] and \
+                        _INSTRUMENTATION['started_tracing']:
+                    tracemalloc.stop()
+                    _INSTRUMENTATION['started_tracing'] = False
+        measurement = StageMeasurement(self.name, seconds, self.count, peak)
+        for sink in self._sinks:
+            sink(measurement)
+        return False
+
+
+def _stage(name):
+    '''
+    Returns a context manager for measuring a stage.
+    If there are no sinks it does nothing.
+    '''
+    sinks = _INSTRUMENTATION['sinks']
+    if not sinks:
+        return _NO_STAGE
+    return _Stage(name, sinks, bool(_INSTRUMENTATION['memory_sinks']))
+
+
+def _instrumented(name, count=None):
+    '''
+    Decorator to measure the function as a stage.
+    The count function gets the result and returns
+    the number of values (rows, events) for the measurement.
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _INSTRUMENTATION['sinks']:
+                return function(*args, **kwargs)
+            with _stage(name) as stage:
+                result = function(*args, **kwargs)
+                if count is not None:
+                    stage.count = count(result)
+            return result
+        return wrapper
+    return decorator
+
+
+class LoggingSink():
+    '''
+    Sink that writes the measurements to a logger.
+    '''
+    def __init__(self, logger=None, level=logging.INFO):
+        if logger is None:
+            logger = logging.getLogger(__name__)
+        self._logger = logger
+        self._level = level
+
+    def __call__(self, measurement):
+        self._logger.log(
+            self._level,
+            '%s: %.6f s, count %s, peak memory %s bytes',
+            measurement.stage,
+            measurement.seconds,
+            measurement.count,
+            measurement.peak_memory_bytes
+        )
+
+
+class CounterRegistry():
+    '''
+    Sink that sums up the measurements per stage
+    (calls, seconds and counts and the maximum of the
+    memory peaks). The counters can be written in the
+    text format of prometheus.
+    '''
+    def __init__(self, prefix='gfzwps'):
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = collections.OrderedDict()
+
+    def __call__(self, measurement):
+        with self._lock:
+            counter = self._counters.setdefault(measurement.stage, {
+                'calls': 0,
+                'seconds': 0.0,
+                'count': 0,
+                'peak_memory_bytes': 0,
+            })
+            counter['calls'] += 1
+            counter['seconds'] += measurement.seconds
+            if measurement.count is not None:
+                counter['count'] += measurement.count
+            if measurement.peak_memory_bytes is not None:
+                counter['peak_memory_bytes'] = max(
+                    counter['peak_memory_bytes'],
+                    measurement.peak_memory_bytes
+                )
+
+    def get_counters(self):
+        '''
+        Returns a dict with the counters per stage.
+        '''
+        with self._lock:
+            return {
+                stage: dict(counter)
+                for stage, counter in self._counters.items()
+            }
+
+    def clear(self):
+        '''
+        Sets all counters back.
+        '''
+        with self._lock:
+            self._counters.clear()
+
+    def to_prometheus_text(self):
+        '''
+        Returns the counters in the text exposition
+        format of prometheus.
+        '''
+        metrics = [
+            ('stage_calls_total', 'counter', 'calls'),
+            ('stage_seconds_total', 'counter', 'seconds'),
+            ('stage_values_total', 'counter', 'count'),
+            ('stage_peak_memory_bytes', 'gauge', 'peak_memory_bytes'),
+        ]
+        counters = self.get_counters()
+        lines = []
+        for metric, metric_type, key in metrics:
+            name = self._prefix + '_' + metric
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for stage, counter in counters.items():
+                lines.append('{}{{stage="{}"}} {}'.format(
+                    name,
+                    stage,
+                    repr(counter[key])
+                ))
+        return '\n'.join(lines) + '\n'
+
+
+def _extend_column(columns, name, values, length):
+    '''
+    Extends the column with the values
+    and fills it with None first if
+    the column has been missing in
+    the entries before.
+    '''
+    column = columns[name]
+    if len(column) < length:
+        column.extend([None] * (length - len(column)))
+    column.extend(values)
+
+
+def _pad_columns(columns, length):
+    '''
+    Fills all the columns with None
+    up to the given length.
+    '''
+    for column in columns.values():
+        if len(column) < length:
+            column.extend([None] * (length - len(column)))
+
+
+def _properties_to_columns(properties_list):
+    '''
+    Converts the list of feature properties
+    to a dict of columns.
+    If all the features have the same keys in the same
+    order the values are extracted with one itemgetter
+    call per feature.
+    '''
+    if not properties_list:
+        return {}
+    keys = list(properties_list[0].keys())
+    if keys and all(
+            len(properties) == len(keys)
+            for properties in properties_list):
+        getter = operator.itemgetter(*keys)
+        try:
+            rows = [getter(properties) for properties in properties_list]
+        except KeyError:
+            rows = None
+        if rows is not None:
+            if len(keys) == 1:
+                return {keys[0]: rows}
+            return {
+                key: list(values)
+                for key, values in zip(keys, zip(*rows))
+            }
+    columns = collections.defaultdict(list)
+    for i, properties in enumerate(properties_list):
+        for name, value in properties.items():
+            _extend_column(columns, name, [value], i)
+    _pad_columns(columns, len(properties_list))
+    return columns
+
+
 class QuakeML():
     '''
     Class for handling quakeml data conversion.
@@ -89,12 +623,14 @@ class QuakeML():
         Returns a geopandas dataframe using the latitude and longitude columns.
         '''
         dataframe = self.to_dataframe()
-        geodataframe = gpd.GeoDataFrame(
-            dataframe,
-            geometry=gpd.points_from_xy(
-                dataframe['longitude'],
-                dataframe['latitude'])
-        )
+        with _stage('QuakeML.build_geometries') as stage:
+            stage.count = len(dataframe)
+            geodataframe = gpd.GeoDataFrame(
+                dataframe,
+                geometry=gpd.points_from_xy(
+                    dataframe['longitude'],
+                    dataframe['latitude'])
+            )
         return geodataframe
 
     @staticmethod
@@ -232,6 +768,7 @@ class QuakeML():
             )
         )
 
+    @_instrumented('QuakeML.to_dataframe', len)
     def to_dataframe(self):
         '''
         Converts the quakeml data to a pandas dataframe.
@@ -288,9 +825,13 @@ class QuakeML():
     @classmethod
     def from_string(cls, xml_string):
         '''
-        Reads the content from an xml string.
+        Reads the content from an xml string
+        (or gzip or zstd compressed bytes).
         '''
-        xml = le.fromstring(xml_string)
+        content = _read_content(xml_string)
+        with _stage('QuakeML.parse_xml') as stage:
+            stage.count = len(content)
+            xml = le.fromstring(content)
         return cls(xml)
 
     @classmethod
@@ -300,6 +841,21 @@ class QuakeML():
         '''
         return cls(xml)
 
+    @classmethod
+    def from_stream(cls, stream, chunk_size=64 * 1024):
+        '''
+        Reads the content from an iterable of byte chunks,
+        a file like object or a streaming http response
+        (requests.get(url, stream=True)).
+        '''
+        return cls(parse_xml_stream(stream, chunk_size, 'QuakeML.parse_xml'))
+
+    def to_xml(self):
+        '''
+        Returns the data as xml structure.
+        '''
+        return self._xml
+
 
 class QuakeMLDataframe():
     '''
@@ -322,7 +878,17 @@ class QuakeMLDataframe():
         Converts the dataframe to xml and gives the xml text back.
         '''
         xml = self.to_xml()
-        return le.tostring(xml, pretty_print=True, encoding='unicode')
+        with _stage('QuakeMLDataframe.serialize_xml') as stage:
+            stage.count = len(xml)
+            return le.tostring(xml, pretty_print=True, encoding='unicode')
+
+    def write(self, target, compression='infer'):
+        '''
+        Writes the xml in the path or file object.
+        The compression can be None, 'gzip', 'zstd' or
+        'infer' (by the file extension).
+        '''
+        _write_xml(self.to_xml(), target, compression)
 
     @staticmethod
     def _add_focal_mechanism_element(event, quake):
@@ -488,6 +1054,7 @@ class QuakeMLDataframe():
         author = le.SubElement(creation_info, _add_quakeml_namespace('author'))
         author.text = quake.agency
 
+    @_instrumented('QuakeMLDataframe.to_xml', len)
     def to_xml(self):
         '''
         Given a pandas dataframe with events returns QuakeML version of
@@ -584,14 +1151,48 @@ class QuakeMLDataframe():
         )
 
 
+def _to_axis_indices(values, start, spacing, count):
+    '''
+    Returns the indices of the nearest cells on one axis of
+    a grid and a mask for the values inside of the grid.
+    '''
+    with np.errstate(invalid='ignore'):
+        values = np.asarray(values, dtype=np.float64)
+        indices = np.rint((values - start) / spacing)
+        inside = (indices >= 0) & (indices < count)
+    return np.where(inside, indices, 0).astype(np.int64), inside
+
+
 class Shakemap():
     '''
     Class for accessing the shakemap data.
+
+    This works for all the intensity maps in the shakemap
+    format, for example also for the tsunami inundation maps.
     '''
+    COORDINATE_COLUMNS = {
+        'LON': ('LON', 'LONGITUDE'),
+        'LAT': ('LAT', 'LATITUDE'),
+    }
+
     def __init__(self, shakeml, x_column='LON', y_column='LAT'):
         self._shakeml = shakeml
-        self._x_column = x_column
-        self._y_column = y_column
+        self._grid_array = None
+        self._dense_grids = {}
+        self._x_column = self._find_coordinate_column(x_column)
+        self._y_column = self._find_coordinate_column(y_column)
+
+    def _find_coordinate_column(self, column):
+        '''
+        Returns the name of the coordinate column in the grid
+        fields, so that for example lon or Longitude can
+        be used instead of LON.
+        '''
+        candidates = Shakemap.COORDINATE_COLUMNS.get(column, (column,))
+        for name in self._get_grid_columns():
+            if name == column or name.upper() in candidates:
+                return name
+        return column
 
     @classmethod
     def from_xml(cls, shakemap_xml):
@@ -600,19 +1201,30 @@ class Shakemap():
         '''
         return cls(shakemap_xml)
 
+    @classmethod
+    def from_stream(cls, stream, chunk_size=64 * 1024):
+        '''
+        Constructs the instance from an iterable of byte chunks,
+        a file like object or a streaming http response
+        (requests.get(url, stream=True)).
+        '''
+        return cls(parse_xml_stream(stream, chunk_size, 'Shakemap.parse_xml'))
+
     def to_intensity_geodataframe(self):
         '''
         Returns the concent of the intensity map
         as a geodataframe.
         '''
         dataframe = self.to_intensity_dataframe()
-        geodataframe = gpd.GeoDataFrame(
-            dataframe,
-            geometry=gpd.points_from_xy(
-                dataframe[self._x_column],
-                dataframe[self._y_column]
+        with _stage('Shakemap.build_geometries') as stage:
+            stage.count = len(dataframe)
+            geodataframe = gpd.GeoDataFrame(
+                dataframe,
+                geometry=gpd.points_from_xy(
+                    dataframe[self._x_column],
+                    dataframe[self._y_column]
+                )
             )
-        )
         return geodataframe
 
     @staticmethod
@@ -648,19 +1260,33 @@ class Shakemap():
         return data_dict
 
     def _grid_to_dataframe(self, grid_data, column_names, value_column_prefix):
-        data_dict = self._grid_to_data_dict(
-            grid_data,
-            column_names,
-            value_column_prefix
-        )
-        return pd.DataFrame(data_dict)
+        with _stage('Shakemap.tokenize_grid') as stage:
+            data_dict = self._grid_to_data_dict(
+                grid_data,
+                column_names,
+                value_column_prefix
+            )
+            stage.count = sum(len(values) for values in data_dict.values())
+        with _stage('Shakemap.build_dataframe') as stage:
+            dataframe = pd.DataFrame(data_dict)
+            stage.count = len(dataframe)
+        return dataframe
 
     def to_xml_string(self):
         '''
         Returns the xml as a string.
         '''
         xml = self.to_xml()
-        return le.tostring(xml, pretty_print=True, encoding='unicode')
+        with _stage('Shakemap.serialize_xml'):
+            return le.tostring(xml, pretty_print=True, encoding='unicode')
+
+    def write(self, target, compression='infer'):
+        '''
+        Writes the xml in the path or file object.
+        The compression can be None, 'gzip', 'zstd' or
+        'infer' (by the file extension).
+        '''
+        _write_xml(self.to_xml(), target, compression)
 
     def to_xml(self):
         '''
@@ -745,17 +1371,15 @@ class Shakemap():
 
         return result_df.iloc[0]
 
-    def to_intensity_dataframe(self):
+    def _get_grid_columns(self):
         '''
-        Converts the intensities to
-        a dataframe.
+        Returns the names of the grid fields
+        in the order of their index.
         '''
-
-        shakeml = self._shakeml
-        nsmap = shakeml.nsmap
-
-        # columns
-        grid_fields = shakeml.findall('grid_field', namespaces=nsmap)
+        grid_fields = self._shakeml.findall(
+            'grid_field',
+            namespaces=self._shakeml.nsmap
+        )
 
         # indices (start at 1) & argsort them
         column_idxs = [
@@ -767,7 +1391,168 @@ class Shakemap():
             grid_field.attrib['name']
             for grid_field in grid_fields
         ]
-        columns = [column_names[idx] for idx in idxs_sorted]
+        return [column_names[idx] for idx in idxs_sorted]
+
+    def to_grid_array(self):
+        '''
+        Returns the grid data as numpy array
+        with one row per point and one column per
+        grid field (in the order of
+        to_grid_field_names).
+        '''
+        if self._grid_array is None:
+            columns = self._get_grid_columns()
+            grid_data = self._shakeml.find(
+                'grid_data',
+                namespaces=self._shakeml.nsmap
+            )
+            with _stage('Shakemap.tokenize_grid') as stage:
+                values = np.fromstring(
+                    grid_data.text or '',
+                    dtype=np.float64,
+                    sep=' '
+                )
+                stage.count = len(values)
+            if len(values) % len(columns) != 0:
+                raise Exception(
+                    'Grid data does not match the {} grid fields'.format(
+                        len(columns)
+                    )
+                )
+            self._grid_array = values.reshape(-1, len(columns))
+        return self._grid_array
+
+    def to_grid_field_names(self):
+        '''
+        Returns the names of the grid fields.
+        '''
+        return self._get_grid_columns()
+
+    def get_intensity_field_names(self):
+        '''
+        Returns the names of the grid fields
+        without the coordinate fields.
+        '''
+        return [
+            name for name in self._get_grid_columns()
+            if name not in (self._x_column, self._y_column)
+        ]
+
+    def get_field_units(self):
+        '''
+        Returns a dict with the units of the grid fields.
+        '''
+        return {
+            grid_field.attrib['name']: grid_field.attrib.get('units')
+            for grid_field in self._shakeml.findall(
+                'grid_field',
+                namespaces=self._shakeml.nsmap
+            )
+        }
+
+    def get_grid_specification(self):
+        '''
+        Returns the grid specification with the
+        numeric values converted to float (nlon and nlat to int).
+        '''
+        grid_specification = self._shakeml.find(
+            'grid_specification',
+            namespaces=self._shakeml.nsmap
+        )
+        result = {}
+        for key, value in grid_specification.attrib.items():
+            if key in ('nlon', 'nlat', 'regular_grid'):
+                result[key] = int(value)
+            else:
+                result[key] = QuakeML._as_float(value)
+        return result
+
+    def to_dense_grid(self, value_column):
+        '''
+        Returns the values on a dense array with shape (nlat, nlon)
+        starting in the north west corner.
+        Cells without a point in the grid data are NaN.
+        The points of irregular grids are assigned to the
+        nearest cell of the grid specification.
+        '''
+        if value_column not in self._dense_grids:
+            spec = self.get_grid_specification()
+            columns = self._get_grid_columns()
+            grid_array = self.to_grid_array()
+            rows, cols, inside = self._to_cell_indices(
+                grid_array[:, columns.index(self._x_column)],
+                grid_array[:, columns.index(self._y_column)]
+            )
+            dense = np.full((spec['nlat'], spec['nlon']), np.nan)
+            dense[rows[inside], cols[inside]] = grid_array[
+                inside,
+                columns.index(value_column)
+            ]
+            self._dense_grids[value_column] = dense
+        return self._dense_grids[value_column]
+
+    def _to_cell_indices(self, lons, lats):
+        '''
+        Returns the row & column indices of the nearest
+        grid cells and a mask for the points inside of the grid.
+        '''
+        spec = self.get_grid_specification()
+        lon_spacing, lat_spacing = Shakemap._get_spacings(spec)
+        cols, cols_inside = _to_axis_indices(
+            lons, spec['lon_min'], lon_spacing, spec['nlon']
+        )
+        # the rows start in the north
+        rows, rows_inside = _to_axis_indices(
+            lats, spec['lat_max'], -lat_spacing, spec['nlat']
+        )
+        inside = cols_inside & rows_inside
+        return np.where(inside, rows, 0), np.where(inside, cols, 0), inside
+
+    @staticmethod
+    def _get_spacing(minimum, maximum, count, nominal_spacing):
+        if count > 1:
+            return (maximum - minimum) / (count - 1)
+        return nominal_spacing or 1.0
+
+    @staticmethod
+    def _get_spacings(spec):
+        '''
+        Returns the lon and lat spacing of the grid specification.
+        '''
+        return (
+            Shakemap._get_spacing(
+                spec['lon_min'], spec['lon_max'], spec['nlon'],
+                spec.get('nominal_lon_spacing')
+            ),
+            Shakemap._get_spacing(
+                spec['lat_min'], spec['lat_max'], spec['nlat'],
+                spec.get('nominal_lat_spacing')
+            ),
+        )
+
+    def to_values_at(self, lons, lats, value_column):
+        '''
+        Returns the values of the nearest grid cells
+        for the given coordinates.
+        Coordinates outside of the grid get NaN.
+        '''
+        dense = self.to_dense_grid(value_column)
+        rows, cols, inside = self._to_cell_indices(lons, lats)
+        return np.where(inside, dense[rows, cols], np.nan)
+
+    @_instrumented('Shakemap.to_intensity_dataframe', len)
+    def to_intensity_dataframe(self):
+        '''
+        Converts the intensities to
+        a dataframe.
+        '''
+
+        shakeml = self._shakeml
+        nsmap = shakeml.nsmap
+
+        # columns
+        grid_fields = shakeml.findall('grid_field', namespaces=nsmap)
+        columns = self._get_grid_columns()
 
         # get grid
         grid_data = self._grid_to_dataframe(
@@ -784,6 +1569,162 @@ class Shakemap():
                 grid_data['unit_' + unit_name] = unit_value
         return grid_data
 
+    def to_geotiff(self, path, bands=None, tiled=True, compress='deflate',
+                   overviews=False, block_size=256, dtype='float32'):
+        '''
+        Writes the intensity fields (all if bands is not given)
+        as geotiff with one band per field using rasterio.
+        The grids are written in windows of block_size rows.
+        With overviews the file is written in the layout of a
+        cloud optimized geotiff (tiled and with the overviews
+        in front of the data).
+        '''
+        if bands is None:
+            bands = self.get_intensity_field_names()
+        spec = self.get_grid_specification()
+        profile = {
+            'driver': 'GTiff',
+            'width': spec['nlon'],
+            'height': spec['nlat'],
+            'count': len(bands),
+            'dtype': dtype,
+            'crs': 'EPSG:4326',
+            'transform': Shakemap._get_pixel_transform(spec),
+            'nodata': Shakemap._get_nodata(dtype),
+        }
+        creation_options = {'tiled': tiled}
+        if tiled:
+            creation_options['blockxsize'] = block_size
+            creation_options['blockysize'] = block_size
+        if compress is not None:
+            creation_options['compress'] = compress
+
+        with _stage('Shakemap.write_geotiff') as stage:
+            stage.count = spec['nlat'] * spec['nlon'] * len(bands)
+            factors = []
+            if overviews:
+                factor = 2
+                while max(spec['nlat'], spec['nlon']) / factor > block_size:
+                    factors.append(factor)
+                    factor *= 2
+            if not factors:
+                self._write_geotiff_windows(
+                    path,
+                    bands,
+                    dict(profile, **creation_options),
+                    block_size
+                )
+                return
+            # the overviews can only be placed in front of the
+            # data by copying a file that already has them
+            with tempfile.TemporaryDirectory(
+                    dir=os.path.dirname(os.path.abspath(path))
+            ) as directory:
+                temporary = os.path.join(directory, 'shakemap.tif')
+                self._write_geotiff_windows(
+                    temporary,
+                    bands,
+                    dict(profile, tiled=tiled),
+                    block_size
+                )
+                with rasterio.open(temporary, 'r+') as dataset:
+                    dataset.build_overviews(
+                        factors,
+                        rasterio.enums.Resampling.average
+                    )
+                    dataset.update_tags(
+                        ns='rio_overview',
+                        resampling='average'
+                    )
+                rasterio.shutil.copy(
+                    temporary,
+                    path,
+                    driver='GTiff',
+                    copy_src_overviews=True,
+                    **creation_options
+                )
+
+    @staticmethod
+    def _get_pixel_transform(spec, first_row=0, first_col=0):
+        '''
+        Returns the affine transform of the pixels of the grid
+        (starting at the given row and column).
+        The grid points are the centers of the pixels.
+        '''
+        lon_spacing, lat_spacing = Shakemap._get_spacings(spec)
+        return rasterio.transform.from_origin(
+            spec['lon_min'] + (first_col - 0.5) * lon_spacing,
+            spec['lat_max'] - (first_row - 0.5) * lat_spacing,
+            lon_spacing,
+            lat_spacing
+        )
+
+    @staticmethod
+    def _get_nodata(dtype):
+        '''
+        Returns the nodata value of the geotiff: NaN for floats,
+        else the minimum (the maximum for unsigned integers)
+        of the dtype.
+        '''
+        dtype = np.dtype(dtype)
+        if np.issubdtype(dtype, np.floating):
+            return np.nan
+        if np.issubdtype(dtype, np.unsignedinteger):
+            return int(np.iinfo(dtype).max)
+        return int(np.iinfo(dtype).min)
+
+    def _write_geotiff_windows(self, path, bands, profile, block_size):
+        '''
+        Writes the bands window by window. The windows are
+        filled from the grid points in their rows, so that
+        there is no dense copy of the whole grid.
+        '''
+        units = self.get_field_units()
+        nlat, nlon = profile['height'], profile['width']
+        dtype = np.dtype(profile['dtype'])
+        columns = self._get_grid_columns()
+        grid_array = self.to_grid_array()
+        rows, cols, inside = self._to_cell_indices(
+            grid_array[:, columns.index(self._x_column)],
+            grid_array[:, columns.index(self._y_column)]
+        )
+        # the points sorted by their row (stable, so that
+        # duplicated cells keep the last point as in to_dense_grid)
+        points = np.flatnonzero(inside)
+        points = points[np.argsort(rows[points], kind='stable')]
+        bounds = np.searchsorted(
+            rows[points],
+            np.append(np.arange(0, nlat, block_size), nlat)
+        )
+        with rasterio.open(path, 'w', **profile) as dataset:
+            for band_index, band in enumerate(bands, 1):
+                values = grid_array[:, columns.index(band)]
+                dataset.set_band_description(band_index, band)
+                if units.get(band) is not None:
+                    dataset.update_tags(band_index, units=units[band])
+                for window_index, row in enumerate(
+                        range(0, nlat, block_size)):
+                    n_rows = min(block_size, nlat - row)
+                    window_points = points[
+                        bounds[window_index]:bounds[window_index + 1]
+                    ]
+                    window = np.full((n_rows, nlon), np.nan)
+                    window[
+                        rows[window_points] - row,
+                        cols[window_points]
+                    ] = values[window_points]
+                    if not np.issubdtype(dtype, np.floating):
+                        window = np.where(
+                            np.isnan(window),
+                            profile['nodata'],
+                            np.rint(window)
+                        )
+                    dataset.write(
+                        window.astype(dtype),
+                        band_index,
+                        window=rasterio.windows.Window(0, row, nlon, n_rows)
+                    )
+
     def to_intensity_raster(self, value_column):
         '''
         Returns the shakemap intensities as a raster.
@@ -811,6 +1752,7 @@ class Shakemap():
         return mapped_series, cell_size
 
     @staticmethod
+    @_instrumented('Shakemap.build_raster', lambda raster: raster.raster.size)
     def dataframe2raster(dataframe, x_column, y_column, value_column):
         '''
         Converts the dataframe to a raster.
@@ -864,3 +1806,2956 @@ class Shakemap():
             raster.y_cell_size
         )
         return raster
+
+
+class ShakemapStack():
+    '''
+    Class for the intensities of many shakemaps
+    (for example one per event) on the same grid.
+
+    Only the dense value grids are kept, not the xml
+    of the shakemaps.
+    '''
+    GRID_KEYS = ('lon_min', 'lat_min', 'lon_max', 'lat_max', 'nlon', 'nlat')
+
+    def __init__(self, value_column='PGA', dtype=np.float32):
+        self._value_column = value_column
+        self._dtype = dtype
+        self._grid_specification = None
+        self._event_ids = []
+        self._grids = []
+
+    def add(self, event_id, shakemap):
+        '''
+        Adds the intensities of the shakemap.
+        Raises an exception if the grid differs
+        from the one of the shakemaps before.
+        '''
+        spec = shakemap.get_grid_specification()
+        if self._grid_specification is None:
+            self._grid_specification = spec
+        elif not all(
+                np.isclose(spec[key], self._grid_specification[key])
+                for key in ShakemapStack.GRID_KEYS):
+            raise Exception(
+                'The grid of the shakemap for {} differs '
+                'from the stack'.format(event_id)
+            )
+        self._event_ids.append(event_id)
+        self._grids.append(
+            shakemap.to_dense_grid(self._value_column).astype(self._dtype)
+        )
+
+    def get_event_ids(self):
+        '''
+        Returns the event ids in the order of the stack.
+        '''
+        return list(self._event_ids)
+
+    def get_grid_specification(self):
+        '''
+        Returns the grid specification of the shakemaps.
+        '''
+        return self._grid_specification
+
+    def to_array(self):
+        '''
+        Returns the intensities as array with
+        the shape (n_events, nlat, nlon).
+        '''
+        if not self._grids:
+            return np.zeros((0, 0, 0), dtype=self._dtype)
+        return np.stack(self._grids)
+
+    def to_maximum(self):
+        '''
+        Returns the maximum intensity of all events per cell.
+        '''
+        with warnings.catch_warnings():
+            # cells without values in all the shakemaps stay NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return np.nanmax(self.to_array(), axis=0)
+
+    def to_mean(self):
+        '''
+        Returns the mean intensity of all events per cell.
+        '''
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return np.nanmean(self.to_array(), axis=0)
+
+
+class HazardStack():
+    '''
+    Class for the intensities of several hazards (for example
+    the shakemap of an earthquake and the inundation map
+    of the following tsunami) on a common grid.
+
+    Every intensity field of the maps is one layer of the stack.
+    The values are resampled from the nearest cell of the
+    source grid (NaN outside of it).
+    The common grid is the one of the first map unless
+    a grid specification is given.
+
+    The stack can be used as the intensity map of the DamageEngine.
+    '''
+    def __init__(self, grid_specification=None, dtype=np.float32):
+        self._grid_specification = grid_specification
+        self._dtype = dtype
+        self._maps = []
+        self._layer_hazards = collections.OrderedDict()
+        self._layer_units = {}
+        self._array = None
+
+    def add(self, hazard, intensity_map, fields=None):
+        '''
+        Adds the fields of the intensity map (all the
+        intensity fields if not given) for the hazard.
+        Raises an exception if a field is already in the stack.
+        '''
+        if fields is None:
+            fields = intensity_map.get_intensity_field_names()
+        for field in fields:
+            if field in self._layer_hazards:
+                raise Exception(
+                    'The field {} is already in the stack for {}'.format(
+                        field,
+                        self._layer_hazards[field]
+                    )
+                )
+        if self._grid_specification is None:
+            self._grid_specification = intensity_map.get_grid_specification()
+        units = intensity_map.get_field_units()
+        for field in fields:
+            self._layer_hazards[field] = hazard
+            self._layer_units[field] = units.get(field)
+        self._maps.append((intensity_map, list(fields)))
+        self._array = None
+
+    def get_hazards(self):
+        '''
+        Returns the hazards in the order they were added.
+        '''
+        return list(collections.OrderedDict.fromkeys(
+            self._layer_hazards.values()
+        ))
+
+    def get_hazard(self, field):
+        '''
+        Returns the hazard of the field.
+        '''
+        return self._layer_hazards[field]
+
+    def to_grid_field_names(self):
+        '''
+        Returns the names of the layers.
+        '''
+        return list(self._layer_hazards.keys())
+
+    def get_field_units(self):
+        '''
+        Returns a dict with the units of the layers.
+        '''
+        return dict(self._layer_units)
+
+    def get_grid_specification(self):
+        '''
+        Returns the specification of the common grid.
+        '''
+        return self._grid_specification
+
+    def to_array(self):
+        '''
+        Returns the intensities as array with the
+        shape (n_layers, nlat, nlon) starting in the
+        north west corner.
+        '''
+        if self._array is None:
+            spec = self._grid_specification
+            if spec is None:
+                return np.zeros((0, 0, 0), dtype=self._dtype)
+            lon_spacing, lat_spacing = Shakemap._get_spacings(spec)
+            lons = spec['lon_min'] + np.arange(spec['nlon']) * lon_spacing
+            lats = spec['lat_max'] - np.arange(spec['nlat']) * lat_spacing
+            layers = []
+            for intensity_map, fields in self._maps:
+                source_spec = intensity_map.get_grid_specification()
+                source_lon_spacing, source_lat_spacing = \
+                    Shakemap._get_spacings(source_spec)
+                # the grids are aligned with the axes, so the
+                # cell indices can be computed per axis
+                cols, cols_inside = _to_axis_indices(
+                    lons,
+                    source_spec['lon_min'],
+                    source_lon_spacing,
+                    source_spec['nlon']
+                )
+                rows, rows_inside = _to_axis_indices(
+                    lats,
+                    source_spec['lat_max'],
+                    -source_lat_spacing,
+                    source_spec['nlat']
+                )
+                dense = np.stack([
+                    intensity_map.to_dense_grid(field) for field in fields
+                ]).astype(self._dtype)
+                values = dense[:, rows[:, np.newaxis], cols[np.newaxis, :]]
+                values[:, ~(rows_inside[:, np.newaxis] & cols_inside)] = np.nan
+                layers.append(values)
+            self._array = np.concatenate(layers)
+        return self._array
+
+    def _to_values(self, lons, lats, layers=slice(None)):
+        '''
+        Returns the values of the layers with the
+        shape (n_layers, n_points).
+        '''
+        spec = self._grid_specification
+        lon_spacing, lat_spacing = Shakemap._get_spacings(spec)
+        cols, cols_inside = _to_axis_indices(
+            lons, spec['lon_min'], lon_spacing, spec['nlon']
+        )
+        rows, rows_inside = _to_axis_indices(
+            lats, spec['lat_max'], -lat_spacing, spec['nlat']
+        )
+        values = self.to_array()[layers][:, rows, cols]
+        values[:, ~(rows_inside & cols_inside)] = np.nan
+        return values
+
+    def to_values_at(self, lons, lats, value_column):
+        '''
+        Returns the values of the layer in the nearest grid
+        cells for the given coordinates.
+        Coordinates outside of the grid get NaN.
+        '''
+        index = self.to_grid_field_names().index(value_column)
+        return self._to_values(lons, lats, [index])[0]
+
+    def to_values_dataframe_at(self, lons, lats):
+        '''
+        Returns a dataframe with one column per layer and
+        the values in the nearest grid cells for the given
+        coordinates (looked up for all the layers at once).
+        '''
+        return pd.DataFrame(
+            self._to_values(lons, lats).T,
+            columns=self.to_grid_field_names()
+        )
+
+
+class ShakemapDiff():
+    '''
+    Class for the grid cells that changed between two
+    versions of a shakemap on the same grid.
+
+    A cell changed if a value of one of the fields differs
+    by more than the tolerance (absolute plus relative
+    to the new value) or if it is NaN in only one of them.
+    '''
+    def __init__(self, grid_specification, changed):
+        self._grid_specification = grid_specification
+        self._changed = changed
+
+    @classmethod
+    def from_shakemaps(cls, old_shakemap, new_shakemap, fields=None,
+                       tolerance=1e-6, relative_tolerance=0.0):
+        '''
+        Compares the fields (by default all the intensity
+        fields of the new shakemap) of the shakemaps.
+        Raises an exception if the grids differ.
+        '''
+        spec = new_shakemap.get_grid_specification()
+        old_spec = old_shakemap.get_grid_specification()
+        if not all(
+                np.isclose(spec[key], old_spec[key])
+                for key in ShakemapStack.GRID_KEYS):
+            raise Exception('The shakemaps have different grids')
+        if fields is None:
+            fields = new_shakemap.get_intensity_field_names()
+        changed = np.zeros((spec['nlat'], spec['nlon']), dtype=bool)
+        with _stage('ShakemapDiff.compare') as stage:
+            stage.count = changed.size * len(fields)
+            for field in fields:
+                changed |= ~np.isclose(
+                    old_shakemap.to_dense_grid(field),
+                    new_shakemap.to_dense_grid(field),
+                    rtol=relative_tolerance,
+                    atol=tolerance,
+                    equal_nan=True
+                )
+        return cls(spec, changed)
+
+    def get_grid_specification(self):
+        '''
+        Returns the grid specification of the shakemaps.
+        '''
+        return self._grid_specification
+
+    def to_mask(self):
+        '''
+        Returns the mask of the changed cells with the
+        shape (nlat, nlon) starting in the north west corner.
+        '''
+        return self._changed
+
+    def get_changed_count(self):
+        '''
+        Returns the number of changed cells.
+        '''
+        return int(self._changed.sum())
+
+    def to_changed_cells(self):
+        '''
+        Returns the rows and columns of the changed cells.
+        '''
+        return np.nonzero(self._changed)
+
+    def is_changed_at(self, lons, lats):
+        '''
+        Returns true for the coordinates whose nearest
+        grid cell changed (false outside of the grid).
+        '''
+        spec = self._grid_specification
+        lon_spacing, lat_spacing = Shakemap._get_spacings(spec)
+        cols, cols_inside = _to_axis_indices(
+            lons, spec['lon_min'], lon_spacing, spec['nlon']
+        )
+        rows, rows_inside = _to_axis_indices(
+            lats, spec['lat_max'], -lat_spacing, spec['nlat']
+        )
+        return self._changed[rows, cols] & rows_inside & cols_inside
+
+
+class ZonalStatistics():
+    '''
+    Class for the minimum, mean and maximum intensity
+    of the grid cells that are covered by the (multi)polygons
+    of the exposure model.
+
+    A cell belongs to a polygon if its center is inside.
+    Polygons that contain no cell center get the cell
+    nearest to their centroid.
+
+    The cells of the polygons are computed once per grid
+    and cached (by the hash of the geometries and the grid
+    specification), so that the statistics for more
+    shakemaps on the same grid only need an array gather.
+    '''
+    MAX_CACHED_GRIDS = 8
+    _CACHE = collections.OrderedDict()
+    _CACHE_LOCK = threading.Lock()
+
+    def __init__(self, exposure):
+        self._geometries = exposure.to_geometry_array()
+        self._geometry_hash = None
+
+    def _get_geometry_hash(self):
+        if self._geometry_hash is None:
+            self._geometry_hash = hashlib.sha256(json.dumps(
+                list(self._geometries),
+                sort_keys=True
+            ).encode('utf-8')).hexdigest()
+        return self._geometry_hash
+
+    @staticmethod
+    def clear_cache():
+        '''
+        Removes the cells of all the grids from the cache.
+        '''
+        with ZonalStatistics._CACHE_LOCK:
+            ZonalStatistics._CACHE.clear()
+
+    def _get_cells(self, spec):
+        '''
+        Returns the flat indices of the cells of all
+        the geometries and the offsets of the geometries
+        in that array.
+        '''
+        key = (
+            self._get_geometry_hash(),
+            tuple(sorted(spec.items()))
+        )
+        cache = ZonalStatistics._CACHE
+        with ZonalStatistics._CACHE_LOCK:
+            if key in cache:
+                cache.move_to_end(key)
+                return cache[key]
+        cells = self._rasterize(spec)
+        with ZonalStatistics._CACHE_LOCK:
+            cache[key] = cells
+            while len(cache) > ZonalStatistics.MAX_CACHED_GRIDS:
+                cache.popitem(last=False)
+        return cells
+
+    def _rasterize(self, spec):
+        lon_spacing, lat_spacing = Shakemap._get_spacings(spec)
+        cells = []
+        counts = np.zeros(len(self._geometries), dtype=np.int64)
+        with _stage('ZonalStatistics.rasterize') as stage:
+            stage.count = len(self._geometries)
+            for index, geometry in enumerate(self._geometries):
+                if geometry is None:
+                    continue
+                shape = shapely.geometry.shape(geometry)
+                lon_min, lat_min, lon_max, lat_max = shape.bounds
+                # the window of cells with centers in the bounding box
+                first_col = max(0, int(np.ceil(
+                    (lon_min - spec['lon_min']) / lon_spacing
+                )))
+                last_col = min(spec['nlon'] - 1, int(np.floor(
+                    (lon_max - spec['lon_min']) / lon_spacing
+                )))
+                first_row = max(0, int(np.ceil(
+                    (spec['lat_max'] - lat_max) / lat_spacing
+                )))
+                last_row = min(spec['nlat'] - 1, int(np.floor(
+                    (spec['lat_max'] - lat_min) / lat_spacing
+                )))
+                rows = cols = np.zeros(0, dtype=np.int64)
+                if first_col <= last_col and first_row <= last_row:
+                    inside = rasterio.features.geometry_mask(
+                        [geometry],
+                        out_shape=(
+                            last_row - first_row + 1,
+                            last_col - first_col + 1
+                        ),
+                        transform=Shakemap._get_pixel_transform(
+                            spec,
+                            first_row,
+                            first_col
+                        ),
+                        invert=True
+                    )
+                    rows, cols = np.nonzero(inside)
+                    rows = rows + first_row
+                    cols = cols + first_col
+                if len(rows) == 0:
+                    centroid = shape.centroid
+                    cols, cols_inside = _to_axis_indices(
+                        [centroid.x],
+                        spec['lon_min'],
+                        lon_spacing,
+                        spec['nlon']
+                    )
+                    rows, rows_inside = _to_axis_indices(
+                        [centroid.y],
+                        spec['lat_max'],
+                        -lat_spacing,
+                        spec['nlat']
+                    )
+                    if not (cols_inside & rows_inside)[0]:
+                        continue
+                cells.append(rows * spec['nlon'] + cols)
+                counts[index] = len(rows)
+        offsets = np.zeros(len(self._geometries) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        if cells:
+            return np.concatenate(cells), offsets
+        return np.zeros(0, dtype=np.int64), offsets
+
+    def to_dataframe(self, shakemap, value_column):
+        '''
+        Returns a dataframe with one row per feature and the
+        number of cells and the min, mean and max values of
+        the cells (NaN cells are ignored).
+        '''
+        cell_indices, offsets = self._get_cells(
+            shakemap.get_grid_specification()
+        )
+        n_features = len(self._geometries)
+        counts = np.diff(offsets)
+        result = pd.DataFrame({
+            'n_cells': counts,
+            'min': np.full(n_features, np.nan),
+            'mean': np.full(n_features, np.nan),
+            'max': np.full(n_features, np.nan),
+        })
+        if len(cell_indices) == 0:
+            return result
+        values = shakemap.to_dense_grid(value_column).ravel()[cell_indices]
+        is_value = ~np.isnan(values)
+        # features without cells have empty segments and
+        # must not be part of the reductions
+        with_cells = counts > 0
+        starts = offsets[:-1][with_cells]
+        n_values = np.add.reduceat(is_value.astype(np.int64), starts)
+        sums = np.add.reduceat(np.where(is_value, values, 0.0), starts)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result.loc[with_cells, 'mean'] = np.where(
+                n_values > 0, sums / n_values, np.nan
+            )
+        result.loc[with_cells, 'min'] = np.fmin.reduceat(values, starts)
+        result.loc[with_cells, 'max'] = np.fmax.reduceat(values, starts)
+        return result
+
+
+class GeoJsonWriter():
+    '''
+    Class to write geojson feature collections from columnar
+    data without building a python dict per feature.
+
+    The properties are given as dataframe with one row per
+    feature. Nested properties (like the expo data of the
+    exposure models) are given as long format dataframe with
+    feature and asset columns; they are written as dicts
+    with the assets as keys for every column.
+
+    The columns of a chunk of features are formatted at once
+    and the chunks are written one after another.
+    The coordinates can be rounded to a precision (in digits).
+    '''
+    def __init__(self, geometries, properties, nested_properties=None,
+                 crs=None, precision=None, features_per_chunk=1000):
+        self._geometries = geometries
+        self._properties = properties
+        self._nested_name = None
+        self._nested = None
+        if nested_properties is not None:
+            self._nested_name, self._nested = nested_properties
+        self._crs = crs
+        self._precision = precision
+        self._features_per_chunk = features_per_chunk
+
+    @classmethod
+    def from_geodataframe(cls, geodataframe, crs=None, precision=None):
+        '''
+        Creates the writer for the geometries and
+        the columns of a geodataframe.
+        '''
+        geometry_column = geodataframe.geometry.name
+        return cls(
+            [
+                shapely.geometry.mapping(geometry)
+                if geometry is not None else None
+                for geometry in geodataframe.geometry
+            ],
+            pd.DataFrame(geodataframe.drop(columns=geometry_column)),
+            crs=crs,
+            precision=precision
+        )
+
+    @staticmethod
+    def _to_json_tokens(values):
+        '''
+        Returns the json text for every value of the array.
+        '''
+        values = np.asarray(values)
+        if values.dtype.kind == 'f':
+            tokens = list(map(float.__repr__, values.astype(float).tolist()))
+            for index in np.flatnonzero(~np.isfinite(values)):
+                tokens[index] = 'null'
+            return tokens
+        if values.dtype.kind in 'iu':
+            return list(map(str, values.tolist()))
+        if values.dtype.kind == 'b':
+            return np.where(values, 'true', 'false').tolist()
+        if values.dtype.kind == 'U':
+            return list(map(_encode_json_string, values.tolist()))
+        if values.dtype.kind == 'M':
+            # timestamps with NaT for the missing values
+            values = pd.DatetimeIndex(values).to_numpy(dtype=object)
+        return list(map(GeoJsonWriter._to_json_token, values))
+
+    @staticmethod
+    def _to_json_token(value):
+        '''
+        Returns the json text for a value of an object array.
+        Dates and times are given as iso strings.
+        '''
+        if isinstance(value, str):
+            return _encode_json_string(value)
+        if value is None or value is pd.NaT or (
+                isinstance(value, float) and math.isnan(value)):
+            return 'null'
+        if isinstance(value, np.datetime64):
+            if np.isnat(value):
+                return 'null'
+            value = pd.Timestamp(value)
+        if isinstance(value, (datetime.date, datetime.time)):
+            return _encode_json_string(value.isoformat())
+        return json.dumps(
+            value.item() if isinstance(value, np.generic) else value
+        )
+
+    @staticmethod
+    def _collect_rings(coordinates, rings):
+        '''
+        Appends the point arrays of the nested geojson coordinates
+        to the rings and returns the nesting with the ring indices
+        (tuples for single positions).
+        '''
+        if len(coordinates) == 0:
+            return []
+        if not isinstance(coordinates[0], (list, tuple, np.ndarray)):
+            rings.append(np.asarray([coordinates], dtype=np.float64))
+            return (len(rings) - 1,)
+        if not isinstance(coordinates[0][0], (list, tuple, np.ndarray)):
+            rings.append(np.asarray(coordinates, dtype=np.float64))
+            return len(rings) - 1
+        return [
+            GeoJsonWriter._collect_rings(part, rings)
+            for part in coordinates
+        ]
+
+    def _round_rings(self, rings):
+        '''
+        Returns the points of the rings rounded to the precision
+        (rounded all at once if they have the same dimension).
+        '''
+        if len({ring.shape[1] for ring in rings}) != 1:
+            return [
+                np.round(ring, self._precision).tolist() for ring in rings
+            ]
+        points = np.round(np.concatenate(rings), self._precision).tolist()
+        offsets = np.cumsum([0] + [len(ring) for ring in rings]).tolist()
+        return [
+            points[start:end]
+            for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+
+    @staticmethod
+    def _rebuild_coordinates(nesting, rounded_rings):
+        if isinstance(nesting, tuple):
+            return rounded_rings[nesting[0]][0]
+        if isinstance(nesting, list):
+            return [
+                GeoJsonWriter._rebuild_coordinates(part, rounded_rings)
+                for part in nesting
+            ]
+        return rounded_rings[nesting]
+
+    def _format_geometries(self, geometries):
+        '''
+        Returns the json text of the geometries.
+        The numbers are formatted by the c encoder of json.
+        '''
+        if self._precision is not None:
+            rings = []
+            nestings = [
+                GeoJsonWriter._collect_rings(geometry['coordinates'], rings)
+                if geometry is not None and 'coordinates' in geometry
+                else None
+                for geometry in geometries
+            ]
+            rounded_rings = self._round_rings(rings) if rings else []
+            geometries = [
+                dict(
+                    geometry,
+                    coordinates=GeoJsonWriter._rebuild_coordinates(
+                        nesting,
+                        rounded_rings
+                    )
+                ) if nesting is not None else geometry
+                for geometry, nesting in zip(geometries, nestings)
+            ]
+        return [
+            json.dumps(geometry, separators=(',', ':'))
+            for geometry in geometries
+        ]
+
+    def _format_nested(self, start, end, nested_order, boundaries):
+        '''
+        Returns the json text of the nested properties
+        for the features from start to end.
+        '''
+        rows = nested_order[boundaries[start]:boundaries[end]]
+        keys = [
+            json.dumps(str(key))
+            for key in self._nested['asset'].to_numpy()[rows]
+        ]
+        columns = [
+            (json.dumps(name), [
+                key + ':' + token
+                for key, token in zip(keys, GeoJsonWriter._to_json_tokens(
+                    self._nested[name].to_numpy()[rows]
+                ))
+            ])
+            for name in self._nested.columns
+            if name not in ('feature', 'asset')
+        ]
+        texts = []
+        for i in range(start, end):
+            first = boundaries[i] - boundaries[start]
+            last = boundaries[i + 1] - boundaries[start]
+            texts.append('{' + ','.join(
+                name + ':{' + ','.join(items[first:last]) + '}'
+                for name, items in columns
+            ) + '}')
+        return texts
+
+    def iterate_chunks(self):
+        '''
+        Returns an iterator over the text chunks of the geojson.
+        '''
+        n_features = len(self._geometries)
+        nested_order = boundaries = None
+        if self._nested is not None:
+            feature_column = self._nested['feature'].to_numpy()
+            nested_order = np.argsort(feature_column, kind='stable')
+            boundaries = np.searchsorted(
+                feature_column[nested_order],
+                np.arange(n_features + 1)
+            )
+        property_names = [
+            json.dumps(str(name)) for name in self._properties.columns
+        ]
+
+        yield '{"type":"FeatureCollection","features":['
+        for start in range(0, n_features, self._features_per_chunk):
+            end = min(start + self._features_per_chunk, n_features)
+            with _stage('GeoJsonWriter.format_features') as stage:
+                stage.count = end - start
+                geometries = self._format_geometries(
+                    self._geometries[start:end]
+                )
+                property_columns = [
+                    GeoJsonWriter._to_json_tokens(
+                        self._properties[name].to_numpy()[start:end]
+                    )
+                    for name in self._properties.columns
+                ]
+                nested = None
+                if self._nested is not None:
+                    nested = self._format_nested(
+                        start,
+                        end,
+                        nested_order,
+                        boundaries
+                    )
+                features = []
+                for i in range(end - start):
+                    items = [
+                        name + ':' + tokens[i]
+                        for name, tokens in zip(
+                            property_names,
+                            property_columns
+                        )
+                    ]
+                    if nested is not None:
+                        items.append(
+                            json.dumps(self._nested_name) + ':' + nested[i]
+                        )
+                    features.append(
+                        '{"type":"Feature","geometry":' + geometries[i] +
+                        ',"properties":{' + ','.join(items) + '}}'
+                    )
+            yield (',' if start > 0 else '') + ','.join(features)
+        yield ']'
+        if self._crs is not None:
+            yield ',"crs":' + json.dumps(self._crs, separators=(',', ':'))
+        yield '}'
+
+    def to_string(self):
+        '''
+        Returns the geojson text.
+        '''
+        return ''.join(self.iterate_chunks())
+
+    def write(self, target, compression='infer'):
+        '''
+        Writes the geojson chunk by chunk in the path or file object.
+        The compression can be None, 'gzip', 'zstd' or
+        'infer' (by the file extension).
+        '''
+        with _open_writer(target, compression) as writer:
+            for chunk in self.iterate_chunks():
+                writer.write(chunk.encode('utf-8'))
+
+
+class Exposure():
+    '''
+    Class for handling the exposure model data
+    (as given by assetmaster or deus).
+
+    The nested expo data of all the features
+    is stored in one long format table with
+    a feature column that points to the
+    position of the feature in the geojson.
+    The geometries are stored in a separate array.
+    '''
+    def __init__(self, expo, geometries, properties, crs=None):
+        self._expo = expo
+        self._geometries = geometries
+        self._properties = properties
+        self._crs = crs
+
+    @classmethod
+    def from_geojson(cls, geojson):
+        '''
+        Reads the content from the (already json parsed)
+        geojson feature collection.
+        '''
+        features = geojson['features']
+        geometries = np.empty(len(features), dtype=object)
+        expo_columns = collections.defaultdict(list)
+        property_columns = collections.defaultdict(list)
+        feature_column = []
+        asset_column = []
+
+        for i, feature in enumerate(features):
+            geometries[i] = feature.get('geometry')
+            properties = feature.get('properties') or {}
+            for name, value in properties.items():
+                if name != 'expo':
+                    _extend_column(property_columns, name, [value], i)
+            expo = properties.get('expo')
+            if not expo:
+                continue
+            offset = len(feature_column)
+            assets = None
+            for name, values in expo.items():
+                if assets is None:
+                    assets, getter = Exposure._get_assets_and_getter(values)
+                _extend_column(expo_columns, name, getter(values), offset)
+            feature_column.extend([i] * len(assets))
+            asset_column.extend(assets)
+
+        _pad_columns(expo_columns, len(feature_column))
+        _pad_columns(property_columns, len(features))
+
+        expo_dataframe = pd.DataFrame(expo_columns)
+        expo_dataframe.insert(
+            0, 'feature', np.array(feature_column, dtype=np.int64)
+        )
+        expo_dataframe.insert(1, 'asset', asset_column)
+        properties_dataframe = pd.DataFrame(
+            property_columns,
+            index=pd.RangeIndex(len(features))
+        )
+        return cls(
+            expo_dataframe,
+            geometries,
+            properties_dataframe,
+            geojson.get('crs')
+        )
+
+    @classmethod
+    def from_string(cls, geojson_string):
+        '''
+        Reads the content from a geojson string
+        (or gzip or zstd compressed bytes).
+        '''
+        return cls.from_geojson(json.loads(_read_content(geojson_string)))
+
+    @classmethod
+    def from_stream(cls, stream):
+        '''
+        Reads the content from a file object, a streaming
+        http response or an iterable of byte chunks.
+        '''
+        return cls.from_string(_read_content(stream))
+
+    @staticmethod
+    def _get_assets_and_getter(values):
+        '''
+        Returns the asset keys of an expo column
+        and a function to extract the values in
+        that order from the other columns.
+        The columns are either dicts (as written by
+        pandas to_dict) or lists.
+        '''
+        if isinstance(values, dict):
+            assets = list(values.keys())
+            if len(assets) == 1:
+                key = assets[0]
+                return assets, lambda column: [column[key]]
+            return assets, lambda column: operator.itemgetter(*assets)(column)
+        return [str(i) for i in range(len(values))], list
+
+    def to_expo_dataframe(self):
+        '''
+        Returns the expo data of all the features
+        as a long format dataframe.
+        The feature column contains the index of the
+        feature the row belongs to, the asset column
+        the key of the row in the original expo data.
+        '''
+        return self._expo
+
+    def to_properties_dataframe(self):
+        '''
+        Returns the feature level properties
+        (without the expo data) as a dataframe.
+        '''
+        return self._properties
+
+    def to_geometry_array(self):
+        '''
+        Returns the geojson geometries of the
+        features as numpy object array.
+        '''
+        return self._geometries
+
+    def get_crs(self):
+        '''
+        Returns the crs entry of the geojson
+        (or None if there was none).
+        '''
+        return self._crs
+
+    def to_geojson(self):
+        '''
+        Returns the exposure model as (not serialized)
+        geojson feature collection with the expo data
+        nested in the features again.
+        '''
+        n_features = len(self._geometries)
+        feature_column = self._expo['feature'].to_numpy()
+        order = np.argsort(feature_column, kind='stable')
+        boundaries = np.searchsorted(
+            feature_column[order],
+            np.arange(n_features + 1)
+        )
+        assets = self._expo['asset'].to_numpy()[order].tolist()
+        expo_columns = {
+            name: Exposure._to_json_values(self._expo[name].to_numpy()[order])
+            for name in self._expo.columns
+            if name not in ('feature', 'asset')
+        }
+        properties_columns = {
+            name: Exposure._to_json_values(self._properties[name].to_numpy())
+            for name in self._properties.columns
+        }
+
+        features = []
+        for i in range(n_features):
+            start, end = boundaries[i], boundaries[i + 1]
+            keys = assets[start:end]
+            properties = {
+                name: values[i]
+                for name, values in properties_columns.items()
+            }
+            properties['expo'] = {
+                name: dict(zip(keys, values[start:end]))
+                for name, values in expo_columns.items()
+            }
+            features.append({
+                'type': 'Feature',
+                'geometry': self._geometries[i],
+                'properties': properties,
+            })
+        geojson = {
+            'type': 'FeatureCollection',
+            'features': features,
+        }
+        if self._crs is not None:
+            geojson['crs'] = self._crs
+        return geojson
+
+    def to_string(self):
+        '''
+        Returns the exposure model as geojson string.
+        '''
+        return json.dumps(self.to_geojson())
+
+    def write(self, target, compression='infer', precision=None):
+        '''
+        Writes the geojson in the path or file object.
+        The compression can be None, 'gzip', 'zstd' or
+        'infer' (by the file extension).
+        The coordinates can be rounded to a precision (in digits).
+        '''
+        self.to_geojson_writer(precision).write(target, compression)
+
+    def to_geojson_writer(self, precision=None):
+        '''
+        Returns the writer to stream the geojson
+        (in the structure of the assetmaster output).
+        '''
+        return GeoJsonWriter(
+            self._geometries,
+            self._properties,
+            ('expo', self._expo),
+            self._crs,
+            precision
+        )
+
+    @staticmethod
+    def _to_json_values(values):
+        '''
+        Converts the numpy values to python values
+        with None for missing values.
+        '''
+        missing = pd.isna(values)
+        values = values.tolist()
+        if missing.any():
+            for index in np.flatnonzero(missing):
+                values[index] = None
+        return values
+
+    def to_damage_state_counts(self, damage_states, value_column='Buildings',
+                               damage_column='Damage'):
+        '''
+        Returns the sum of the value column per feature and
+        damage state as array with the shape
+        (n_features, n_damage_states).
+        Rows with other damage states are ignored.
+        '''
+        n_states = len(damage_states)
+        lookup = {state: index for index, state in enumerate(damage_states)}
+        state_indices = self._expo[damage_column].map(lookup).to_numpy(
+            dtype=np.float64,
+            na_value=-1
+        ).astype(np.int64)
+        known = state_indices >= 0
+        counts = np.bincount(
+            self._expo['feature'].to_numpy()[known] * n_states +
+            state_indices[known],
+            weights=self._expo[value_column].to_numpy(
+                dtype=np.float64
+            )[known],
+            minlength=len(self._geometries) * n_states
+        )
+        return counts.reshape(len(self._geometries), n_states)
+
+    def to_centroids(self):
+        '''
+        Returns the longitudes and latitudes of the
+        centroids of the feature geometries.
+        '''
+        centroids = self.to_geodataframe().geometry.centroid
+        return centroids.x.to_numpy(), centroids.y.to_numpy()
+
+    def to_geodataframe(self):
+        '''
+        Returns the feature level properties
+        together with the geometries as a geodataframe.
+        '''
+        return gpd.GeoDataFrame(
+            self._properties.copy(),
+            geometry=[
+                shapely.geometry.shape(geometry)
+                if geometry is not None
+                else None
+                for geometry in self._geometries
+            ]
+        )
+
+
+class Fragility():
+    '''
+    Class for handling the fragility functions
+    (as given by modelprop).
+
+    The lognormal parameters of all the fragility
+    functions are stored in matrices of
+    the shape (taxonomy, damage_state).
+
+    For the transitions of already damaged buildings
+    (columns like D1_2_mean) there are matrices
+    of the shape (taxonomy, from_state, damage_state) with
+    from state 0 being the state without damage.
+    '''
+    def __init__(self, taxonomies, damage_states, means, stddevs, meta=None,
+                 lookup_table=None, intensity_measures=None):
+        self._taxonomies = list(taxonomies)
+        self._damage_states = list(damage_states)
+        self._means = Fragility._as_transition_matrix(means)
+        self._stddevs = Fragility._as_transition_matrix(stddevs)
+        self._meta = meta or {}
+        self._taxonomy_lookup = Fragility._create_taxonomy_lookup(
+            self._taxonomies
+        )
+        self._lookup_table = lookup_table
+        if intensity_measures is None:
+            intensity_measures = [None] * len(self._taxonomies)
+        self._intensity_measures = list(intensity_measures)
+
+    @classmethod
+    def from_json(cls, fragility_json):
+        '''
+        Reads the content from the (already json parsed)
+        modelprop output.
+        '''
+        meta = fragility_json.get('meta', {})
+        data = pd.DataFrame(fragility_json['data'])
+        damage_states = meta.get('limit_states')
+        if not damage_states:
+            damage_states = Fragility._find_damage_states(data.columns)
+        means = Fragility._read_transition_matrix(
+            data, damage_states, '_mean'
+        )
+        stddevs = Fragility._read_transition_matrix(
+            data, damage_states, '_stddev'
+        )
+        if 'imt' in data.columns:
+            intensity_measures = data['imt'].tolist()
+        else:
+            intensity_measures = None
+        return cls(
+            data['taxonomy'].tolist(),
+            damage_states,
+            means,
+            stddevs,
+            meta,
+            intensity_measures=intensity_measures
+        )
+
+    @classmethod
+    def from_string(cls, fragility_string):
+        '''
+        Reads the content from a json string
+        (or gzip or zstd compressed bytes).
+        '''
+        return cls.from_json(json.loads(_read_content(fragility_string)))
+
+    @classmethod
+    def from_stream(cls, stream):
+        '''
+        Reads the content from a file object, a streaming
+        http response or an iterable of byte chunks.
+        '''
+        return cls.from_string(_read_content(stream))
+
+    @staticmethod
+    def _read_transition_matrix(data, damage_states, suffix):
+        '''
+        Reads the columns like D2_mean (from no damage)
+        and D1_2_mean (from D1 to D2) in a matrix of
+        the shape (taxonomy, from_state, damage_state).
+        If there is no specific function for a transition
+        the function from no damage is used.
+        Transitions to the same or a lower state are NaN.
+        '''
+        from_no_damage = data.reindex(
+            columns=[state + suffix for state in damage_states]
+        ).to_numpy(dtype=np.float64)
+        matrix = np.repeat(
+            from_no_damage[:, np.newaxis, :],
+            len(damage_states) + 1,
+            axis=1
+        )
+        for from_index, from_state in enumerate(damage_states, start=1):
+            for to_index, to_state in enumerate(damage_states):
+                if to_index + 1 <= from_index:
+                    matrix[:, from_index, to_index] = np.nan
+                    continue
+                column = from_state + '_' + to_state[1:] + suffix
+                if column in data.columns:
+                    matrix[:, from_index, to_index] = data[column].to_numpy(
+                        dtype=np.float64
+                    )
+        return matrix
+
+    @staticmethod
+    def _as_transition_matrix(matrix):
+        '''
+        Matrices with the shape (taxonomy, damage_state)
+        are used for all the from states.
+        '''
+        matrix = np.asarray(matrix, dtype=np.float64)
+        if matrix.ndim == 3:
+            return matrix
+        return np.repeat(
+            matrix[:, np.newaxis, :],
+            matrix.shape[1] + 1,
+            axis=1
+        )
+
+    @staticmethod
+    def _find_damage_states(column_names):
+        '''
+        Returns the damage states for which there are
+        columns like D1_mean (but not D1_2_mean)
+        in the order of their number.
+        '''
+        damage_states = []
+        for column_name in column_names:
+            if not column_name.endswith('_mean'):
+                continue
+            state = column_name[:-len('_mean')]
+            if state[:1] == 'D' and state[1:].isdigit():
+                damage_states.append(state)
+        return sorted(damage_states, key=lambda state: int(state[1:]))
+
+    @staticmethod
+    def _normalize_taxonomy(taxonomy):
+        '''
+        The taxonomies in the fragility functions
+        and in the exposure model are not always
+        consistent in using - or _ as separator.
+        '''
+        return taxonomy.replace('_', '-')
+
+    @staticmethod
+    def _create_taxonomy_lookup(taxonomies):
+        lookup = {}
+        for index, taxonomy in enumerate(taxonomies):
+            lookup.setdefault(Fragility._normalize_taxonomy(taxonomy), index)
+        for index, taxonomy in enumerate(taxonomies):
+            lookup[taxonomy] = index
+        return lookup
+
+    def get_taxonomies(self):
+        '''
+        Returns the list of taxonomies in the
+        order of the rows of the matrices.
+        '''
+        return self._taxonomies
+
+    def get_damage_states(self):
+        '''
+        Returns the list of damage states in the
+        order of the columns of the matrices.
+        '''
+        return self._damage_states
+
+    def get_no_damage_state(self):
+        '''
+        Returns the name of the damage state
+        without any damage.
+        '''
+        return self._meta.get('no_damage', 'D0')
+
+    def get_all_damage_states(self):
+        '''
+        Returns the list of the damage states
+        starting with the state without damage.
+        The positions in this list are the from state
+        indices.
+        '''
+        return [self.get_no_damage_state()] + self._damage_states
+
+    def get_intensity_measures(self):
+        '''
+        Returns the intensity measure (imt) for every
+        taxonomy (None if it is not given).
+        '''
+        return self._intensity_measures
+
+    def get_mean_matrix(self, from_state_index=0):
+        '''
+        Returns the means of the log intensities
+        with shape (taxonomy, damage_state).
+        '''
+        return self._means[:, from_state_index, :]
+
+    def get_stddev_matrix(self, from_state_index=0):
+        '''
+        Returns the standard deviations of the log intensities
+        with shape (taxonomy, damage_state).
+        '''
+        return self._stddevs[:, from_state_index, :]
+
+    def to_taxonomy_indices(self, taxonomies):
+        '''
+        Returns the row indices in the matrices
+        for the given taxonomies.
+        Unknown taxonomies get -1.
+        '''
+        lookup = self._taxonomy_lookup
+        codes, uniques = pd.factorize(pd.Series(taxonomies, dtype=object))
+        unique_indices = np.array([
+            lookup.get(
+                taxonomy,
+                lookup.get(Fragility._normalize_taxonomy(str(taxonomy)), -1)
+            )
+            for taxonomy in uniques
+        ] + [-1], dtype=np.int64)
+        # codes are -1 for missing values, so they point to the last entry
+        return unique_indices[codes]
+
+    def to_from_state_indices(self, damage_states):
+        '''
+        Returns the from state indices for the
+        given damage state names.
+        Unknown damage states get -1.
+        '''
+        lookup = {
+            state: index
+            for index, state in enumerate(self.get_all_damage_states())
+        }
+        codes, uniques = pd.factorize(pd.Series(damage_states, dtype=object))
+        unique_indices = np.array(
+            [lookup.get(state, -1) for state in uniques] + [-1],
+            dtype=np.int64
+        )
+        return unique_indices[codes]
+
+    def with_lookup_table(self, intensity_max, intensity_min=0.0,
+                          n_points=1024):
+        '''
+        Returns a copy of the fragility model that evaluates
+        the functions by linear interpolation in a table
+        precomputed for n_points equally spaced intensities
+        between intensity_min and intensity_max.
+
+        Intensities outside of this range are clamped to it.
+        The maximum absolute error of the interpolation against
+        the exact cdf (inside of the range) is measured on a
+        finer grid and can be read with
+        get_lookup_table_max_error.
+        '''
+        if n_points < 2 or intensity_max <= intensity_min:
+            raise Exception(
+                'Lookup table needs at least two points in a non empty range'
+            )
+        n_states = len(self._damage_states)
+        means = self._means.reshape(-1, n_states)
+        stddevs = self._stddevs.reshape(-1, n_states)
+
+        grid = np.linspace(intensity_min, intensity_max, n_points)
+        # shape (curve row, intensity, damage_state) so that
+        # a lookup for an asset gives all the damage states at once
+        lookup_table = _FragilityLookupTable(
+            intensity_min,
+            grid[1] - grid[0],
+            np.transpose(
+                Fragility._evaluate_all(grid, means, stddevs),
+                (1, 0, 2)
+            )
+        )
+        # compare with the exact cdf on a grid
+        # with 8 points per table interval
+        fine_grid = np.linspace(
+            intensity_min,
+            intensity_max,
+            (n_points - 1) * 8 + 1
+        )
+        all_rows = np.arange(len(means))[np.newaxis, :]
+        lookup_table.max_error = float(np.nanmax(np.abs(
+            lookup_table.interpolate(fine_grid, all_rows) -
+            Fragility._evaluate_all(fine_grid, means, stddevs)
+        )))
+        return Fragility(
+            self._taxonomies,
+            self._damage_states,
+            self._means,
+            self._stddevs,
+            self._meta,
+            lookup_table,
+            self._intensity_measures
+        )
+
+    def get_lookup_table_max_error(self):
+        '''
+        Returns the maximum absolute error of the lookup
+        table against the exact cdf or None if there is
+        no lookup table.
+        '''
+        if self._lookup_table is None:
+            return None
+        return self._lookup_table.max_error
+
+    @staticmethod
+    def _to_log_intensities(intensities):
+        '''
+        Returns the log of the intensities.
+        Intensities of 0 or below give -inf (so nothing is
+        exceeded), NaN intensities stay NaN.
+        '''
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.log(np.maximum(intensities, 0.0))
+
+    @staticmethod
+    def _evaluate_all(intensities, means, stddevs):
+        '''
+        Evaluates the lognormal cdfs with the parameters
+        of shape (curve, damage_state) for all intensities.
+        Result has the shape (intensity, curve, damage_state).
+        '''
+        log_intensities = Fragility._to_log_intensities(intensities)
+        return scipy.special.ndtr(
+            (log_intensities[:, np.newaxis, np.newaxis] - means) / stddevs
+        )
+
+    def to_exceedance_probabilities(self, intensities, taxonomy_indices=None,
+                                    from_state_indices=None):
+        '''
+        Evaluates the fragility functions for the
+        intensities.
+
+        If the taxonomy indices are given there must be one
+        for each intensity and the result has the shape
+        (n_assets, n_states). Rows with an unknown taxonomy
+        (-1) are NaN.
+        Without taxonomy indices all the functions are evaluated
+        and the result has the shape (n_assets, n_taxonomies, n_states).
+
+        With from state indices (one per intensity,
+        only together with the taxonomy indices) the functions
+        for the transitions from the actual damage state are used.
+        The probability for damage states that are already
+        reached is 1.
+
+        Intensities of 0 or below (also negative ones) exceed
+        no damage state, NaN intensities give NaN probabilities.
+
+        If there is a lookup table (see with_lookup_table)
+        the values are interpolated from the table.
+        '''
+        intensities = np.asarray(intensities, dtype=np.float64)
+        n_from_states = self._means.shape[1]
+
+        if taxonomy_indices is None:
+            if from_state_indices is not None:
+                raise Exception(
+                    'From state indices need the taxonomy indices'
+                )
+            if self._lookup_table is not None:
+                return self._lookup_table.interpolate(
+                    intensities,
+                    np.arange(len(self._taxonomies))[np.newaxis, :] *
+                    n_from_states
+                )
+            return Fragility._evaluate_all(
+                intensities,
+                self._means[:, 0, :],
+                self._stddevs[:, 0, :]
+            )
+
+        taxonomy_indices = np.asarray(taxonomy_indices, dtype=np.int64)
+        if from_state_indices is None:
+            unknown = taxonomy_indices < 0
+            row_indices = taxonomy_indices * n_from_states
+        else:
+            from_state_indices = np.asarray(
+                from_state_indices,
+                dtype=np.int64
+            )
+            unknown = (taxonomy_indices < 0) | (from_state_indices < 0)
+            row_indices = np.where(
+                unknown,
+                -1,
+                taxonomy_indices * n_from_states + from_state_indices
+            )
+
+        if self._lookup_table is not None:
+            probabilities = self._lookup_table.interpolate(
+                intensities,
+                row_indices
+            )
+        else:
+            log_intensities = Fragility._to_log_intensities(intensities)
+            n_states = len(self._damage_states)
+            means = np.take(
+                self._means.reshape(-1, n_states), row_indices, axis=0
+            )
+            stddevs = np.take(
+                self._stddevs.reshape(-1, n_states), row_indices, axis=0
+            )
+            probabilities = scipy.special.ndtr(
+                (log_intensities[:, np.newaxis] - means) / stddevs
+            )
+
+        if from_state_indices is not None:
+            reached = (
+                np.arange(len(self._damage_states))[np.newaxis, :] <
+                from_state_indices[:, np.newaxis]
+            )
+            probabilities[reached] = 1.0
+        probabilities[unknown] = np.nan
+        return probabilities
+
+    def to_damage_state_probabilities(self, intensities, taxonomy_indices,
+                                      from_state_indices=None):
+        '''
+        Returns the probabilities to end in each of the
+        damage states (including the state without damage)
+        with shape (n_assets, n_states + 1).
+        Crossing fragility functions can not lead to
+        negative probabilities.
+        '''
+        exceedance = self.to_exceedance_probabilities(
+            intensities,
+            taxonomy_indices,
+            from_state_indices
+        )
+        # make sure the exceedance probabilities are decreasing
+        exceedance = np.minimum.accumulate(exceedance, axis=1)
+        n_assets = exceedance.shape[0]
+        bounded = np.concatenate([
+            np.ones((n_assets, 1)),
+            exceedance,
+            np.zeros((n_assets, 1))
+        ], axis=1)
+        return bounded[:, :-1] - bounded[:, 1:]
+
+
+class _FragilityLookupTable():
+    '''
+    Table with precomputed values of the fragility
+    functions on an equally spaced intensity grid.
+
+    The table has the shape (curve row, intensity, damage_state).
+    It is stored flattened to (curve row * intensity, damage_state)
+    together with the slopes to the next intensity, so that the
+    interpolation needs just two gathers of contiguous rows.
+    '''
+    def __init__(self, intensity_min, step, table):
+        self.intensity_min = intensity_min
+        self.step = step
+        _, self.n_points, n_states = table.shape
+        slopes = np.diff(table, axis=1, append=table[:, -1:])
+        # single precision is far below the interpolation error
+        # and keeps more of the table in the cache
+        self.values = table.reshape(-1, n_states).astype(np.float32)
+        self.slopes = slopes.reshape(-1, n_states).astype(np.float32)
+        self.max_error = None
+
+    def interpolate(self, intensities, row_indices):
+        '''
+        Interpolates linear between the table values.
+
+        The row indices are either one per intensity
+        (result has the shape (n_intensities, n_states))
+        or have the shape (1, n_rows) to evaluate all those rows
+        (result has the shape (n_intensities, n_rows, n_states)).
+        Rows with a negative index are NaN.
+        '''
+        intensities = np.asarray(intensities, dtype=np.float64)
+        row_indices = np.asarray(row_indices, dtype=np.int64)
+        position = (intensities - self.intensity_min) / self.step
+        missing = np.isnan(position)
+        position = np.clip(
+            np.where(missing, 0.0, position),
+            0.0,
+            self.n_points - 1
+        )
+        index = position.astype(np.int64)
+        weight = position - index
+
+        # broadcast the intensities against the rows
+        extra_dimensions = (1,) * (row_indices.ndim - 1)
+        index = index.reshape(index.shape + extra_dimensions)
+        weight = weight.reshape(weight.shape + extra_dimensions + (1,))
+        unknown = row_indices < 0
+        has_unknown = unknown.any()
+        if has_unknown:
+            row_indices = np.where(unknown, 0, row_indices)
+        index = row_indices * self.n_points + index
+
+        probabilities = np.take(self.values, index, axis=0) + \
+            weight * np.take(self.slopes, index, axis=0)
+        if has_unknown:
+            probabilities[np.broadcast_to(unknown, index.shape)] = np.nan
+        probabilities[missing] = np.nan
+        return probabilities
+
+
+class DamageEngine():
+    '''
+    Class for computing the damage of an
+    exposure model for an intensity map locally
+    (as done by the deus process on the wps server).
+
+    The intensity for an asset is taken from the grid cell
+    nearest to the centroid of its feature geometry.
+    The intensity measure is given by the imt of the
+    fragility functions of the taxonomy (or the
+    intensity column if given).
+
+    Buildings are distributed over the damage states
+    by the differences of the exceedance probabilities.
+    The loss of a transition is the replacement cost
+    multiplied with the difference of the loss ratios.
+    The default loss ratios are the mean damage ratios
+    of the hazus structural damage states.
+    '''
+    TAXONOMY_COLUMN = 'Taxonomy'
+    DAMAGE_COLUMN = 'Damage'
+    BUILDINGS_COLUMN = 'Buildings'
+    REPLACEMENT_COST_COLUMN = 'Repl-cost-USD-bdg'
+    COUNT_COLUMNS = ('Buildings', 'Dwellings', 'Population')
+    DEFAULT_LOSS_RATIOS = {
+        'D0': 0.0,
+        'D1': 0.02,
+        'D2': 0.1,
+        'D3': 0.5,
+        'D4': 1.0,
+    }
+
+    def __init__(self, exposure, fragility, intensity_column=None,
+                 loss_ratios=None, loss_unit='USD'):
+        self._exposure = exposure
+        self._fragility = fragility
+        self._intensity_column = intensity_column
+        self._loss_unit = loss_unit
+
+        expo = exposure.to_expo_dataframe()
+        self._taxonomy_indices = fragility.to_taxonomy_indices(
+            expo[DamageEngine.TAXONOMY_COLUMN]
+        )
+        if DamageEngine.DAMAGE_COLUMN in expo.columns:
+            self._from_state_indices = fragility.to_from_state_indices(
+                expo[DamageEngine.DAMAGE_COLUMN]
+            )
+        else:
+            self._from_state_indices = np.zeros(len(expo), dtype=np.int64)
+        self._features = expo['feature'].to_numpy()
+        self._lons, self._lats = exposure.to_centroids()
+
+        if loss_ratios is None:
+            loss_ratios = DamageEngine.DEFAULT_LOSS_RATIOS
+        self._loss_ratios = np.array([
+            loss_ratios.get(state, np.nan)
+            for state in fragility.get_all_damage_states()
+        ])
+
+    def _to_intensities(self, shakemap, rows):
+        '''
+        Returns the intensity for the given expo rows.
+        Only the features of these rows are looked up
+        in the shakemap.
+        '''
+        field_names = {
+            name.upper(): name
+            for name in shakemap.to_grid_field_names()
+        }
+        intensities = np.full(len(rows), np.nan)
+        features, feature_indices = np.unique(
+            self._features[rows],
+            return_inverse=True
+        )
+
+        if self._intensity_column is not None:
+            intensity_measures = np.full(
+                len(rows),
+                self._intensity_column,
+                dtype=object
+            )
+        else:
+            intensity_measures = np.array(
+                self._fragility.get_intensity_measures() + [None],
+                dtype=object
+            )[self._taxonomy_indices[rows]]
+
+        for intensity_measure in pd.unique(intensity_measures):
+            if intensity_measure is None:
+                continue
+            field_name = field_names.get(str(intensity_measure).upper())
+            if field_name is None:
+                continue
+            feature_values = shakemap.to_values_at(
+                self._lons[features],
+                self._lats[features],
+                field_name
+            )
+            mask = intensity_measures == intensity_measure
+            intensities[mask] = feature_values[feature_indices[mask]]
+        return intensities
+
+    def compute(self, shakemap):
+        '''
+        Computes the damage for the intensities
+        of the shakemap.
+        '''
+        return self._to_result(*self._compute_rows(
+            shakemap,
+            np.arange(len(self._features))
+        ))
+
+    def update(self, previous_result, shakemap, diff):
+        '''
+        Computes the damage for a new version of the shakemap
+        by recomputing only the features with a changed grid
+        cell in the diff (from the shakemap of the previous result).
+        The other features are taken from the previous result
+        (computed by this engine).
+        '''
+        changed_features = np.flatnonzero(
+            diff.is_changed_at(self._lons, self._lats)
+        )
+        if len(changed_features) == 0:
+            return previous_result
+        rows = np.flatnonzero(np.isin(self._features, changed_features))
+        with _stage('DamageEngine.update') as stage:
+            stage.count = len(rows)
+            updated_expo, transitions, taxonomy_losses = self._compute_rows(
+                shakemap,
+                rows
+            )
+
+            previous_expo = previous_result.to_updated_exposure(
+            ).to_expo_dataframe()
+            previous_transitions = previous_result.to_transition_dataframe()
+            updated_expo = DamageEngine._merge_features(
+                previous_expo,
+                updated_expo,
+                changed_features
+            )
+            # the order of the features in the updated exposure
+            # and the sorting of the grouped transitions
+            updated_expo = updated_expo.iloc[np.argsort(
+                updated_expo['feature'].to_numpy(),
+                kind='stable'
+            )].reset_index(drop=True)
+            transitions = DamageEngine._merge_features(
+                previous_transitions,
+                transitions,
+                changed_features
+            ).sort_values(
+                ['feature', 'from_damage_state', 'to_damage_state']
+            ).reset_index(drop=True)
+            taxonomy_losses = DamageEngine._merge_features(
+                previous_result.to_taxonomy_loss_dataframe(),
+                taxonomy_losses,
+                changed_features
+            ).sort_values(
+                ['feature', DamageEngine.TAXONOMY_COLUMN]
+            ).reset_index(drop=True)
+        return self._to_result(updated_expo, transitions, taxonomy_losses)
+
+    @staticmethod
+    def _merge_features(previous, recomputed, changed_features):
+        '''
+        Replaces the rows of the changed features
+        with the recomputed ones.
+        '''
+        kept = previous[~previous['feature'].isin(changed_features)]
+        parts = [part for part in (kept, recomputed) if len(part) > 0]
+        if not parts:
+            return previous.iloc[:0].copy()
+        return pd.concat(parts, ignore_index=True)
+
+    def _compute_rows(self, shakemap, rows):
+        '''
+        Returns the updated expo data, the transitions
+        and the losses per feature and taxonomy
+        for the given rows of the expo data.
+        '''
+        expo = self._exposure.to_expo_dataframe()
+        all_damage_states = np.array(
+            self._fragility.get_all_damage_states(),
+            dtype=object
+        )
+        from_states = self._from_state_indices[rows]
+        known = from_states >= 0
+
+        probabilities = np.zeros((len(rows), len(all_damage_states)))
+        probabilities[known] = self._fragility.to_damage_state_probabilities(
+            self._to_intensities(shakemap, rows)[known],
+            self._taxonomy_indices[rows][known],
+            from_states[known]
+        )
+        # assets without intensity or fragility functions keep their state
+        unchanged = known & np.isnan(probabilities).any(axis=1)
+        probabilities[unchanged] = 0.0
+        probabilities[unchanged, from_states[unchanged]] = 1.0
+
+        row_indices, state_indices = np.nonzero(probabilities > 0.0)
+        fractions = probabilities[row_indices, state_indices]
+        damage_states = all_damage_states[state_indices]
+
+        # assets with an unknown damage state can't be updated
+        unknown_rows = np.flatnonzero(~known)
+        if len(unknown_rows):
+            row_indices = np.concatenate([row_indices, unknown_rows])
+            fractions = np.concatenate([fractions, np.ones(len(unknown_rows))])
+            damage_states = np.concatenate([
+                damage_states,
+                expo[DamageEngine.DAMAGE_COLUMN].to_numpy()[rows[unknown_rows]]
+            ])
+            order = np.argsort(row_indices, kind='stable')
+            row_indices = row_indices[order]
+            fractions = fractions[order]
+            damage_states = damage_states[order]
+            state_indices = np.concatenate([
+                state_indices,
+                np.full(len(unknown_rows), -1)
+            ])[order]
+
+        row_indices = rows[row_indices]
+        updated_expo = expo.iloc[row_indices].reset_index(drop=True)
+        updated_expo[DamageEngine.DAMAGE_COLUMN] = damage_states
+        for column in DamageEngine.COUNT_COLUMNS:
+            if column in updated_expo.columns:
+                updated_expo[column] = updated_expo[column] * fractions
+
+        transitions, taxonomy_losses = self._to_transitions(
+            updated_expo,
+            row_indices,
+            state_indices
+        )
+        return (
+            DamageEngine._aggregate_rows(updated_expo),
+            transitions,
+            taxonomy_losses
+        )
+
+    @staticmethod
+    def _aggregate_rows(updated_expo):
+        '''
+        Sums up the counts of the rows with the same
+        feature, taxonomy and damage state, so that
+        the updated exposure doesn't grow if it is
+        used for another computation.
+        '''
+        keys = [
+            column
+            for column in (
+                'gc_id',
+                'feature',
+                DamageEngine.TAXONOMY_COLUMN,
+                DamageEngine.DAMAGE_COLUMN
+            )
+            if column in updated_expo.columns
+        ]
+        aggregations = {
+            column: 'sum' if column in DamageEngine.COUNT_COLUMNS else 'first'
+            for column in updated_expo.columns
+            if column not in keys
+        }
+        aggregated = updated_expo.groupby(
+            keys,
+            as_index=False,
+            sort=False,
+            dropna=False
+        ).agg(aggregations)
+        return aggregated[list(updated_expo.columns)]
+
+    def _to_result(self, updated_expo, transitions, taxonomy_losses):
+        updated_expo['asset'] = np.arange(len(updated_expo)).astype(str)
+        loss_values = np.bincount(
+            transitions['feature'].to_numpy(dtype=np.int64),
+            weights=transitions['loss_value'].to_numpy(dtype=np.float64),
+            minlength=len(self._exposure.to_geometry_array())
+        ).astype(np.float64)
+        return DamageEngineResult(
+            Exposure(
+                updated_expo,
+                self._exposure.to_geometry_array(),
+                self._exposure.to_properties_dataframe(),
+                self._exposure.get_crs()
+            ),
+            transitions,
+            loss_values,
+            self._loss_unit,
+            self._fragility.get_all_damage_states(),
+            taxonomy_losses
+        )
+
+    def _to_transitions(self, updated_expo, row_indices, state_indices):
+        '''
+        Returns the transitions (summed up per feature,
+        from & to damage state) together with their loss
+        and the losses summed up per feature and taxonomy.
+        '''
+        from_states = self._from_state_indices[row_indices]
+        changed = (state_indices >= 0) & (state_indices != from_states)
+        changed_rows = row_indices[changed]
+        from_states = from_states[changed]
+        to_states = state_indices[changed]
+        n_buildings = updated_expo[DamageEngine.BUILDINGS_COLUMN].to_numpy(
+            dtype=np.float64
+        )[changed]
+
+        expo = self._exposure.to_expo_dataframe()
+        if DamageEngine.REPLACEMENT_COST_COLUMN in expo.columns:
+            replacement_costs = expo[
+                DamageEngine.REPLACEMENT_COST_COLUMN
+            ].to_numpy(dtype=np.float64)[changed_rows]
+        else:
+            replacement_costs = np.full(len(changed_rows), np.nan)
+        loss_values = n_buildings * replacement_costs * (
+            self._loss_ratios[to_states] - self._loss_ratios[from_states]
+        )
+
+        all_damage_states = np.array(
+            self._fragility.get_all_damage_states(),
+            dtype=object
+        )
+        transitions = pd.DataFrame({
+            'feature': self._features[changed_rows],
+            'from_damage_state': all_damage_states[from_states],
+            'to_damage_state': all_damage_states[to_states],
+            'n_buildings': n_buildings,
+            'loss_value': loss_values,
+        })
+        taxonomy_losses = pd.DataFrame({
+            'feature': self._features[changed_rows],
+            DamageEngine.TAXONOMY_COLUMN: expo[
+                DamageEngine.TAXONOMY_COLUMN
+            ].to_numpy()[changed_rows],
+            'loss_value': loss_values,
+        })
+        return (
+            transitions.groupby(
+                ['feature', 'from_damage_state', 'to_damage_state'],
+                as_index=False,
+                sort=True
+            ).sum(),
+            taxonomy_losses.groupby(
+                ['feature', DamageEngine.TAXONOMY_COLUMN],
+                as_index=False,
+                sort=True
+            ).sum()
+        )
+
+
+class DamageEngineResult():
+    '''
+    Class for the result of the local damage computation.
+    It can be converted to the outputs of the deus process.
+    '''
+    def __init__(self, updated_exposure, transitions, loss_values,
+                 loss_unit, damage_states, taxonomy_losses=None):
+        self._updated_exposure = updated_exposure
+        self._transitions = transitions
+        self._loss_values = loss_values
+        self._loss_unit = loss_unit
+        self._damage_states = damage_states
+        self._taxonomy_losses = taxonomy_losses
+
+    def to_updated_exposure(self):
+        '''
+        Returns the updated exposure model.
+        '''
+        return self._updated_exposure
+
+    def to_transition_dataframe(self):
+        '''
+        Returns the transitions as dataframe with the columns
+        feature, from_damage_state, to_damage_state,
+        n_buildings and loss_value.
+        '''
+        return self._transitions
+
+    def to_loss_array(self):
+        '''
+        Returns the loss value for every feature.
+        '''
+        return self._loss_values
+
+    def get_loss_unit(self):
+        '''
+        Returns the unit of the loss values.
+        '''
+        return self._loss_unit
+
+    def to_taxonomy_loss_dataframe(self):
+        '''
+        Returns the loss values summed up per
+        feature and taxonomy.
+        '''
+        return self._taxonomy_losses
+
+    def to_damage_result(self):
+        '''
+        Returns the result as DamageResult.
+        '''
+        return DamageResult.from_engine_result(self)
+
+    def to_transitions(self):
+        '''
+        Returns the transitions as sparse Transitions.
+        '''
+        return Transitions.from_dataframe(
+            self._transitions,
+            len(self._updated_exposure.to_geometry_array()),
+            self._damage_states
+        )
+
+    def write_deus_output(self, output_name, target, compression='infer'):
+        '''
+        Writes one of the deus outputs (updated_exposure,
+        transition or damage) as geojson in the path or file object.
+        The compression can be None, 'gzip', 'zstd' or
+        'infer' (by the file extension).
+        '''
+        _write_json(self.to_deus_output()[output_name], target, compression)
+
+    def to_deus_output(self):
+        '''
+        Returns the (not serialized) geojson outputs
+        in the same structure as the deus process
+        (updated_exposure, transition and damage).
+        '''
+        exposure = self._updated_exposure
+        properties = exposure.to_properties_dataframe().to_dict('records')
+        geometries = exposure.to_geometry_array()
+
+        transitions = self._transitions
+        boundaries = np.searchsorted(
+            transitions['feature'].to_numpy(),
+            np.arange(len(geometries) + 1)
+        )
+        from_states = transitions['from_damage_state'].tolist()
+        to_states = transitions['to_damage_state'].tolist()
+        n_buildings = transitions['n_buildings'].tolist()
+
+        transition_features = []
+        damage_features = []
+        for i, geometry in enumerate(geometries):
+            start, end = boundaries[i], boundaries[i + 1]
+            transition_properties = dict(properties[i])
+            transition_properties['transitions'] = {
+                'from_damage_state': from_states[start:end],
+                'to_damage_state': to_states[start:end],
+                'n_buildings': n_buildings[start:end],
+            }
+            transition_features.append({
+                'type': 'Feature',
+                'geometry': geometry,
+                'properties': transition_properties,
+            })
+            damage_properties = dict(properties[i])
+            damage_properties['loss_value'] = float(self._loss_values[i])
+            damage_properties['loss_unit'] = self._loss_unit
+            damage_features.append({
+                'type': 'Feature',
+                'geometry': geometry,
+                'properties': damage_properties,
+            })
+
+        return {
+            'updated_exposure': exposure.to_geojson(),
+            'transition': {
+                'type': 'FeatureCollection',
+                'features': transition_features,
+            },
+            'damage': {
+                'type': 'FeatureCollection',
+                'features': damage_features,
+            },
+        }
+
+
+class LossTable():
+    '''
+    Class for the losses of many damage
+    computations (for example one per event).
+
+    Only the loss values per feature are kept,
+    not the updated exposures or the transitions.
+    '''
+    def __init__(self, dtype=np.float64):
+        self._dtype = dtype
+        self._loss_unit = None
+        self._event_ids = []
+        self._losses = []
+
+    def add(self, event_id, result):
+        '''
+        Adds the losses of the DamageEngineResult.
+        Raises an exception if the loss unit or the
+        number of features differs from the results before.
+        '''
+        loss_values = np.asarray(result.to_loss_array(), dtype=self._dtype)
+        if self._losses and (
+                result.get_loss_unit() != self._loss_unit or
+                len(loss_values) != len(self._losses[0])):
+            raise Exception(
+                'The losses for {} differ from the table'.format(event_id)
+            )
+        self._loss_unit = result.get_loss_unit()
+        self._event_ids.append(event_id)
+        self._losses.append(loss_values)
+
+    def get_event_ids(self):
+        '''
+        Returns the event ids in the order of the table.
+        '''
+        return list(self._event_ids)
+
+    def get_loss_unit(self):
+        '''
+        Returns the unit of the loss values.
+        '''
+        return self._loss_unit
+
+    def to_dataframe(self):
+        '''
+        Returns a dataframe with one row per event
+        and one column per feature.
+        '''
+        if not self._losses:
+            return pd.DataFrame(index=pd.Index([], name='eventID'))
+        return pd.DataFrame(
+            np.stack(self._losses),
+            index=pd.Index(self._event_ids, name='eventID')
+        )
+
+    def to_total_losses(self):
+        '''
+        Returns the total loss of every event.
+        '''
+        return self.to_dataframe().sum(axis=1)
+
+
+class DamageResult():
+    '''
+    Class for handling the damage output of deus
+    (and optionally the updated exposure) in
+    a columnar way.
+
+    There is one row per feature with the
+    feature properties (including the loss_value).
+    The geometries are stored in a separate array.
+    '''
+    LOSS_COLUMN = 'loss_value'
+
+    def __init__(self, damage, geometries, updated_exposure=None,
+                 taxonomy_losses=None):
+        self._damage = damage
+        self._geometries = geometries
+        self._updated_exposure = updated_exposure
+        self._taxonomy_losses = taxonomy_losses
+
+    @classmethod
+    def from_geojson(cls, damage_geojson, updated_exposure_geojson=None):
+        '''
+        Reads the content from the (already json parsed)
+        damage and updated exposure geojson feature collections.
+        '''
+        features = damage_geojson['features']
+        geometries = np.empty(len(features), dtype=object)
+        geometries[:] = [feature.get('geometry') for feature in features]
+        damage = pd.DataFrame(
+            _properties_to_columns([
+                feature.get('properties') or {}
+                for feature in features
+            ]),
+            index=pd.RangeIndex(len(features))
+        )
+        if DamageResult.LOSS_COLUMN in damage.columns:
+            damage[DamageResult.LOSS_COLUMN] = pd.to_numeric(
+                damage[DamageResult.LOSS_COLUMN]
+            ).astype(np.float64)
+        updated_exposure = None
+        if updated_exposure_geojson is not None:
+            updated_exposure = Exposure.from_geojson(updated_exposure_geojson)
+        return cls(damage, geometries, updated_exposure)
+
+    @classmethod
+    def from_string(cls, damage_string, updated_exposure_string=None):
+        '''
+        Reads the content from the damage and updated
+        exposure geojson strings (or gzip or zstd compressed bytes).
+        '''
+        updated_exposure_geojson = None
+        if updated_exposure_string is not None:
+            updated_exposure_geojson = json.loads(
+                _read_content(updated_exposure_string)
+            )
+        return cls.from_geojson(
+            json.loads(_read_content(damage_string)),
+            updated_exposure_geojson
+        )
+
+    @classmethod
+    def from_stream(cls, damage_stream, updated_exposure_stream=None):
+        '''
+        Reads the content from file objects, streaming
+        http responses or iterables of byte chunks.
+        '''
+        updated_exposure_string = None
+        if updated_exposure_stream is not None:
+            updated_exposure_string = _read_content(updated_exposure_stream)
+        return cls.from_string(
+            _read_content(damage_stream),
+            updated_exposure_string
+        )
+
+    @classmethod
+    def from_engine_result(cls, engine_result):
+        '''
+        Reads the content from the result of the
+        local damage engine.
+        '''
+        updated_exposure = engine_result.to_updated_exposure()
+        damage = updated_exposure.to_properties_dataframe().copy()
+        damage[DamageResult.LOSS_COLUMN] = engine_result.to_loss_array()
+        damage['loss_unit'] = engine_result.get_loss_unit()
+        return cls(
+            damage,
+            updated_exposure.to_geometry_array(),
+            updated_exposure,
+            engine_result.to_taxonomy_loss_dataframe()
+        )
+
+    def to_dataframe(self):
+        '''
+        Returns the damage properties with
+        one row per feature.
+        '''
+        return self._damage
+
+    def to_geometry_array(self):
+        '''
+        Returns the geojson geometries of the
+        features as numpy object array.
+        '''
+        return self._geometries
+
+    def write(self, target, compression='infer', precision=None):
+        '''
+        Writes the damage geojson in the path or file object.
+        The compression can be None, 'gzip', 'zstd' or
+        'infer' (by the file extension).
+        The coordinates can be rounded to a precision (in digits).
+        '''
+        GeoJsonWriter(
+            self._geometries,
+            self._damage,
+            precision=precision
+        ).write(target, compression)
+
+    def get_updated_exposure(self):
+        '''
+        Returns the updated exposure model
+        (or None if it was not given).
+        '''
+        return self._updated_exposure
+
+    def to_loss_array(self):
+        '''
+        Returns the loss values of all the features.
+        '''
+        return self._damage[DamageResult.LOSS_COLUMN].to_numpy()
+
+    def get_total_loss(self):
+        '''
+        Returns the sum of the loss values.
+        '''
+        return float(np.nansum(self.to_loss_array()))
+
+    def get_max_loss(self):
+        '''
+        Returns the maximum of the loss values.
+        '''
+        loss_values = self.to_loss_array()
+        if len(loss_values) == 0:
+            return math.nan
+        return float(np.nanmax(loss_values))
+
+    def get_loss_quantiles(self, quantiles):
+        '''
+        Returns the quantiles of the loss values.
+        '''
+        return np.nanquantile(self.to_loss_array(), quantiles)
+
+    def to_loss_by(self, column):
+        '''
+        Returns the sum of the loss values grouped
+        by a feature property (for example the name
+        of the admin polygon).
+        '''
+        return self._damage.groupby(column)[DamageResult.LOSS_COLUMN].sum()
+
+    def to_loss_by_taxonomy(self):
+        '''
+        Returns the sum of the loss values grouped by
+        the taxonomy of the assets.
+        The losses of the transitions are only known
+        for results of the local damage engine.
+        '''
+        if self._taxonomy_losses is None:
+            raise Exception('There are no losses per taxonomy')
+        return self._taxonomy_losses.groupby(
+            DamageEngine.TAXONOMY_COLUMN
+        )[DamageResult.LOSS_COLUMN].sum()
+
+    def to_exposure_aggregation(self, by, value_column='Buildings',
+                                aggfunc='sum'):
+        '''
+        Aggregates a column of the updated exposure
+        grouped by expo columns (like Taxonomy or Damage)
+        and / or feature properties (like the name of the
+        admin polygon).
+        '''
+        if self._updated_exposure is None:
+            raise Exception('There is no updated exposure')
+        if isinstance(by, str):
+            by = [by]
+        expo = self._updated_exposure.to_expo_dataframe()
+        features = expo['feature'].to_numpy()
+        keys = []
+        for column in by:
+            if column in expo.columns:
+                keys.append(expo[column].rename(column))
+            else:
+                keys.append(pd.Series(
+                    self._damage[column].to_numpy()[features],
+                    index=expo.index,
+                    name=column
+                ))
+        return expo[value_column].groupby(keys).agg(aggfunc)
+
+
+class MapPayload():
+    '''
+    Class to build small geojson payloads of damage or
+    exposure results for web maps (like the GeoJSON
+    layer of ipyleaflet).
+
+    The geometries are simplified, the coordinates are
+    rounded and every feature gets a style with the fill
+    color of a color ramp for the value column.
+    '''
+    # ylorrd from colorbrewer
+    COLOR_RAMP = ('#ffffb2', '#fecc5c', '#fd8d3c', '#f03b20', '#bd0026')
+    MISSING_COLOR = '#808080'
+    STYLE = {
+        'color': 'grey',
+        'weight': 1,
+        'fillOpacity': 0.7,
+    }
+    # closed rings of polygons need 4 positions, lines 2
+    MIN_POSITIONS = {
+        'LineString': 2,
+        'MultiLineString': 2,
+        'Polygon': 4,
+        'MultiPolygon': 4,
+    }
+
+    def __init__(self, geometries, properties):
+        self._geometries = geometries
+        self._properties = properties
+        self._shapes = None
+
+    @classmethod
+    def from_damage_result(cls, damage_result):
+        '''
+        Creates the payload for the features of the damage result.
+        '''
+        return cls(
+            damage_result.to_geometry_array(),
+            damage_result.to_dataframe()
+        )
+
+    @classmethod
+    def from_exposure(cls, exposure):
+        '''
+        Creates the payload for the features of the exposure model
+        (with the feature level properties).
+        '''
+        return cls(
+            exposure.to_geometry_array(),
+            exposure.to_properties_dataframe()
+        )
+
+    @staticmethod
+    def to_colors(values, color_ramp=COLOR_RAMP, value_min=None,
+                  value_max=None):
+        '''
+        Returns the hex colors for the values by a linear
+        interpolation in the color ramp between value_min
+        and value_max (by default the range of the values).
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        missing = np.isnan(values)
+        if missing.all():
+            return np.full(len(values), MapPayload.MISSING_COLOR, dtype=object)
+        if value_min is None:
+            value_min = np.nanmin(values)
+        if value_max is None:
+            value_max = np.nanmax(values)
+        if value_max > value_min:
+            scaled = np.clip(
+                (values - value_min) / (value_max - value_min),
+                0,
+                1
+            )
+        else:
+            scaled = np.zeros(len(values))
+        rgb = np.array([
+            [int(color[i:i + 2], 16) for i in (1, 3, 5)]
+            for color in color_ramp
+        ], dtype=np.float64)
+        positions = np.where(missing, 0, scaled) * (len(color_ramp) - 1)
+        channels = np.rint(np.column_stack([
+            np.interp(positions, np.arange(len(color_ramp)), rgb[:, i])
+            for i in range(3)
+        ])).astype(np.int64)
+        colors = np.char.mod(
+            '#%06x',
+            (channels[:, 0] << 16) | (channels[:, 1] << 8) | channels[:, 2]
+        ).astype(object)
+        colors[missing] = MapPayload.MISSING_COLOR
+        return colors
+
+    @staticmethod
+    def _round_coordinates(coordinates, precision, geometry_type):
+        '''
+        Rounds the nested geojson coordinates (to decimal digits)
+        and removes the points that are equal to the point before.
+        Rings of polygons stay closed with at least 4 positions
+        and lines keep at least 2 positions: if they would collapse
+        only the rounded coordinates are used.
+        '''
+        if isinstance(coordinates[0], (int, float)):
+            return np.round(coordinates, precision).tolist()
+        if isinstance(coordinates[0][0], (int, float)):
+            points = np.round(
+                np.asarray(coordinates, dtype=np.float64),
+                precision
+            )
+            changed = np.any(points[1:] != points[:-1], axis=1)
+            kept = points[np.concatenate([[True], changed])]
+            min_count = MapPayload.MIN_POSITIONS.get(geometry_type, 1)
+            if len(kept) < min_count:
+                return points.tolist()
+            return kept.tolist()
+        return [
+            MapPayload._round_coordinates(part, precision, geometry_type)
+            for part in coordinates
+        ]
+
+    def _to_geometries(self, tolerance, precision):
+        if self._shapes is None:
+            self._shapes = [
+                shapely.geometry.shape(geometry)
+                if geometry is not None else None
+                for geometry in self._geometries
+            ]
+        geometries = []
+        for shape in self._shapes:
+            if shape is None or shape.is_empty:
+                geometries.append(None)
+                continue
+            if tolerance > 0:
+                shape = shape.simplify(tolerance, preserve_topology=True)
+            geometry = shapely.geometry.mapping(shape)
+            geometries.append({
+                'type': geometry['type'],
+                'coordinates': MapPayload._round_coordinates(
+                    geometry['coordinates'],
+                    precision,
+                    geometry['type']
+                ),
+            })
+        return geometries
+
+    def to_geojson(self, value_column=DamageResult.LOSS_COLUMN, columns=None,
+                   tolerance=0.0, precision=5, color_ramp=COLOR_RAMP):
+        '''
+        Returns the (not serialized) geojson feature collection
+        with the geometries simplified with the tolerance
+        and the coordinates rounded to the precision (in digits).
+        The properties are the given columns (all by default)
+        and the style.
+        '''
+        if columns is None:
+            columns = list(self._properties.columns)
+        with _stage('MapPayload.build_features') as stage:
+            stage.count = len(self._geometries)
+            colors = MapPayload.to_colors(
+                self._properties[value_column],
+                color_ramp
+            )
+            property_columns = [
+                Exposure._to_json_values(self._properties[column].to_numpy())
+                for column in columns
+            ]
+            features = []
+            for index, geometry in enumerate(
+                    self._to_geometries(tolerance, precision)):
+                properties = {
+                    column: values[index]
+                    for column, values in zip(columns, property_columns)
+                }
+                properties['style'] = dict(
+                    MapPayload.STYLE,
+                    fillColor=colors[index]
+                )
+                features.append({
+                    'type': 'Feature',
+                    'geometry': geometry,
+                    'properties': properties,
+                })
+        return {
+            'type': 'FeatureCollection',
+            'features': features,
+        }
+
+    def to_string(self, value_column=DamageResult.LOSS_COLUMN, columns=None,
+                  tolerance=0.0, precision=5, color_ramp=COLOR_RAMP,
+                  max_bytes=None, max_steps=12):
+        '''
+        Returns the compact geojson text.
+        With max_bytes the tolerance is increased (and the
+        precision reduced) step by step until the text fits.
+        Raises an exception if it doesn't fit after max_steps.
+        '''
+        for _ in range(max_steps + 1):
+            text = json.dumps(
+                self.to_geojson(
+                    value_column,
+                    columns,
+                    tolerance,
+                    precision,
+                    color_ramp
+                ),
+                separators=(',', ':')
+            )
+            if max_bytes is None or len(text.encode('utf-8')) <= max_bytes:
+                return text
+            tolerance = max(tolerance * 4, 10 ** -precision)
+            # more digits than the tolerance are not visible
+            precision = max(1, min(
+                precision,
+                int(math.ceil(-math.log10(tolerance))) + 1
+            ))
+        raise Exception(
+            'The map payload does not fit in {} bytes'.format(max_bytes)
+        )
+
+
+class Transitions():
+    '''
+    Class for handling the transition output
+    of deus as sparse matrix.
+
+    The matrix has one row per feature and one column
+    per pair of damage states (from_index * n_states + to_index).
+    The values are the number of buildings that
+    changed from one state to the other.
+    '''
+    def __init__(self, matrix, damage_states):
+        self._matrix = scipy.sparse.csr_matrix(matrix)
+        self._damage_states = list(damage_states)
+
+    @classmethod
+    def from_dataframe(cls, dataframe, n_features, damage_states=None):
+        '''
+        Reads the content from a dataframe with the columns
+        feature, from_damage_state, to_damage_state and n_buildings.
+        '''
+        return cls._from_columns(
+            dataframe['feature'].to_numpy(),
+            dataframe['from_damage_state'].to_numpy(),
+            dataframe['to_damage_state'].to_numpy(),
+            dataframe['n_buildings'].to_numpy(dtype=np.float64),
+            n_features,
+            damage_states
+        )
+
+    @classmethod
+    def from_geojson(cls, transition_geojson, damage_states=None):
+        '''
+        Reads the content from the (already json parsed)
+        transition output of deus.
+        '''
+        features = []
+        from_states = []
+        to_states = []
+        n_buildings = []
+        for i, feature in enumerate(transition_geojson['features']):
+            transitions = (feature.get('properties') or {}).get('transitions')
+            if not transitions:
+                continue
+            count = len(transitions['n_buildings'])
+            features.extend([i] * count)
+            from_states.extend(transitions['from_damage_state'])
+            to_states.extend(transitions['to_damage_state'])
+            n_buildings.extend(transitions['n_buildings'])
+        return cls._from_columns(
+            np.array(features, dtype=np.int64),
+            np.array(from_states, dtype=object),
+            np.array(to_states, dtype=object),
+            np.array(n_buildings, dtype=np.float64),
+            len(transition_geojson['features']),
+            damage_states
+        )
+
+    @classmethod
+    def from_string(cls, transition_string, damage_states=None):
+        '''
+        Reads the content from the transition geojson string
+        (or gzip or zstd compressed bytes).
+        '''
+        return cls.from_geojson(
+            json.loads(_read_content(transition_string)),
+            damage_states
+        )
+
+    @classmethod
+    def from_stream(cls, stream, damage_states=None):
+        '''
+        Reads the content from a file object, a streaming
+        http response or an iterable of byte chunks.
+        '''
+        return cls.from_string(_read_content(stream), damage_states)
+
+    @classmethod
+    def _from_columns(cls, features, from_states, to_states, n_buildings,
+                      n_features, damage_states):
+        if damage_states is None:
+            damage_states = sorted(
+                set(from_states) | set(to_states),
+                key=Transitions._damage_state_sort_key
+            )
+        n_states = len(damage_states)
+        lookup = {state: index for index, state in enumerate(damage_states)}
+        from_indices = pd.Series(from_states, dtype=object).map(lookup)
+        to_indices = pd.Series(to_states, dtype=object).map(lookup)
+        if from_indices.isna().any() or to_indices.isna().any():
+            raise Exception('Transitions with unknown damage states')
+        matrix = scipy.sparse.coo_matrix(
+            (
+                n_buildings,
+                (
+                    features,
+                    from_indices.to_numpy(dtype=np.int64) * n_states +
+                    to_indices.to_numpy(dtype=np.int64)
+                )
+            ),
+            shape=(n_features, n_states * n_states)
+        )
+        # duplicated entries are summed up by the conversion
+        return cls(matrix.tocsr(), damage_states)
+
+    @staticmethod
+    def _damage_state_sort_key(damage_state):
+        number = str(damage_state).lstrip('D')
+        if number.isdigit():
+            return (0, int(number), '')
+        return (1, 0, str(damage_state))
+
+    def get_damage_states(self):
+        '''
+        Returns the list of damage states in the order
+        of the state indices.
+        '''
+        return self._damage_states
+
+    def to_csr(self):
+        '''
+        Returns the sparse matrix with the shape
+        (n_features, n_states * n_states).
+        '''
+        return self._matrix
+
+    def to_coo(self):
+        '''
+        Returns the sparse matrix in the coordinate format.
+        '''
+        return self._matrix.tocoo()
+
+    def to_dataframe(self):
+        '''
+        Returns the transitions in a long format dataframe with
+        the columns feature, from_damage_state, to_damage_state
+        and n_buildings.
+        '''
+        coo = self.to_coo()
+        n_states = len(self._damage_states)
+        damage_states = np.array(self._damage_states, dtype=object)
+        return pd.DataFrame({
+            'feature': coo.row,
+            'from_damage_state': damage_states[coo.col // n_states],
+            'to_damage_state': damage_states[coo.col % n_states],
+            'n_buildings': coo.data,
+        })
+
+    def _to_state_matrices(self):
+        '''
+        Returns the sparse matrices to sum the transitions
+        up per from state and per to state.
+        '''
+        n_states = len(self._damage_states)
+        pairs = np.arange(n_states * n_states)
+        from_matrix = scipy.sparse.csr_matrix(
+            (np.ones(len(pairs)), (pairs, pairs // n_states)),
+            shape=(len(pairs), n_states)
+        )
+        to_matrix = scipy.sparse.csr_matrix(
+            (np.ones(len(pairs)), (pairs, pairs % n_states)),
+            shape=(len(pairs), n_states)
+        )
+        return from_matrix, to_matrix
+
+    def to_outflow(self):
+        '''
+        Returns the number of buildings that left a state
+        with the shape (n_features, n_states).
+        '''
+        from_matrix, _ = self._to_state_matrices()
+        return np.asarray((self._matrix @ from_matrix).todense())
+
+    def to_inflow(self):
+        '''
+        Returns the number of buildings that reached a state
+        with the shape (n_features, n_states).
+        '''
+        _, to_matrix = self._to_state_matrices()
+        return np.asarray((self._matrix @ to_matrix).todense())
+
+    def apply(self, state_counts):
+        '''
+        Applies the transitions to the number of buildings
+        per feature and damage state
+        (shape (n_features, n_states)) and returns the
+        updated numbers.
+        '''
+        return np.asarray(state_counts, dtype=np.float64) - \
+            self.to_outflow() + self.to_inflow()
+
+    def apply_to_exposure(self, exposure, value_column='Buildings'):
+        '''
+        Applies the transitions to the exposure model
+        and returns a table with the number of buildings per
+        feature (rows) and damage state (columns).
+        '''
+        state_counts = exposure.to_damage_state_counts(
+            self._damage_states,
+            value_column
+        )
+        return pd.DataFrame(
+            self.apply(state_counts),
+            columns=self._damage_states
+        )
+
+    def compose(self, other, state_counts):
+        '''
+        Returns the transitions of two consecutive hazards
+        (first self then other) as one transition from
+        the states before the first hazard to the states
+        after the second one.
+
+        The state counts are the number of buildings per feature
+        and damage state before the first hazard. The buildings
+        that are in a state after the first hazard are
+        assumed to follow the transitions of the second hazard
+        with the same probabilities, regardless of the state
+        they came from.
+        '''
+        if self._damage_states != other.get_damage_states():
+            raise Exception('Transitions use different damage states')
+        n_states = len(self._damage_states)
+        state_counts = np.asarray(state_counts, dtype=np.float64)
+        other_matrix = other.to_csr()
+
+        # only the features with transitions need to be computed
+        rows = np.union1d(
+            np.flatnonzero(self._matrix.getnnz(axis=1)),
+            np.flatnonzero(other_matrix.getnnz(axis=1))
+        )
+        diagonal = np.arange(n_states)
+
+        first = self._matrix[rows].toarray().reshape(-1, n_states, n_states)
+        first[:, diagonal, diagonal] = 0.0
+        first[:, diagonal, diagonal] = state_counts[rows] - first.sum(axis=2)
+        counts_between = first.sum(axis=1)
+
+        second = other_matrix[rows].toarray().reshape(-1, n_states, n_states)
+        second[:, diagonal, diagonal] = 0.0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            probabilities = np.where(
+                counts_between[:, :, np.newaxis] > 0.0,
+                second / counts_between[:, :, np.newaxis],
+                0.0
+            )
+        probabilities[:, diagonal, diagonal] = 1.0 - probabilities.sum(axis=2)
+
+        composed = np.einsum('fik,fkj->fij', first, probabilities)
+        composed[:, diagonal, diagonal] = 0.0
+        composed = composed.reshape(len(rows), n_states * n_states)
+        nonzero_rows, nonzero_columns = np.nonzero(composed)
+        matrix = scipy.sparse.coo_matrix(
+            (
+                composed[nonzero_rows, nonzero_columns],
+                (rows[nonzero_rows], nonzero_columns)
+            ),
+            shape=self._matrix.shape
+        )
+        return Transitions(matrix.tocsr(), self._damage_states)
+
+
+SHAKEMAP_NAMESPACE = 'http://earthquake.usgs.gov/eqcenter/shakemap'
+
+SHAKEMAP_FIELD_UNITS = {
+    'PGA': 'g',
+    'PGV': 'cms',
+    'MI': 'intensity',
+    'MWH': 'm',
+}
+
+
+def generate_event_dataframe(n_events, seed=0, with_uncertainties=False,
+                             first_index=0):
+    '''
+    Returns a dataframe with n_events synthetic events
+    in the columns of QuakeML.to_dataframe.
+    The uncertainties are NaN unless with_uncertainties is true.
+    '''
+    random = np.random.default_rng(seed)
+
+    def uncertainty(scale):
+        if with_uncertainties:
+            return random.uniform(0.0, scale, n_events)
+        return np.full(n_events, math.nan)
+
+    return pd.DataFrame({
+        'eventID': [
+            'quakeml:quakeledger/synthetic_{}'.format(i)
+            for i in range(first_index, first_index + n_events)
+        ],
+        'agency': ['GFZ'] * n_events,
+        'Identifier': np.full(n_events, math.nan),
+        'year': random.integers(1900, 2020, n_events),
+        'month': random.integers(1, 13, n_events),
+        'day': random.integers(1, 29, n_events),
+        'hour': random.integers(0, 24, n_events),
+        'minute': random.integers(0, 60, n_events),
+        'second': random.integers(0, 60, n_events),
+        'timeUncertainty': uncertainty(10.0),
+        'longitude': random.uniform(-75.0, -68.0, n_events).round(4),
+        'longitudeUncertainty': uncertainty(0.1),
+        'latitude': random.uniform(-35.0, -18.0, n_events).round(4),
+        'latitudeUncertainty': uncertainty(0.1),
+        'horizontalUncertainty': uncertainty(10.0),
+        'maxHorizontalUncertainty': uncertainty(10.0),
+        'minHorizontalUncertainty': uncertainty(5.0),
+        'azimuthMaxHorizontalUncertainty': uncertainty(180.0),
+        'depth': random.uniform(5.0, 150.0, n_events).round(2),
+        'depthUncertainty': uncertainty(5.0),
+        'magnitude': random.uniform(5.0, 9.5, n_events).round(1),
+        'magnitudeUncertainty': uncertainty(0.3),
+        'rake': random.uniform(-180.0, 180.0, n_events).round(1),
+        'rakeUncertainty': uncertainty(10.0),
+        'dip': random.uniform(5.0, 90.0, n_events).round(1),
+        'dipUncertainty': uncertainty(5.0),
+        'strike': random.uniform(0.0, 360.0, n_events).round(1),
+        'strikeUncertainty': uncertainty(10.0),
+        'type': ['expert'] * n_events,
+        'probability': random.uniform(0.0, 1.0, n_events),
+    })
+
+
+def generate_quakeml(n_events, seed=0, with_uncertainties=False,
+                     events_per_chunk=1000):
+    '''
+    Returns an iterator over the byte chunks of a synthetic
+    quakeml eventParameters document with n_events events.
+    Only one chunk of events is in memory at a time.
+    The same arguments give the same document.
+    '''
+    yield (
+        '<?xml version=\'1.0\' encoding=\'UTF-8\'?>\n'
+        '<eventParameters xmlns="http://quakeml.org/xmlns/bed/1.2" '
+        'publicID="quakeml:quakeledger/0">'
+    ).encode('utf-8')
+    random = np.random.default_rng(seed)
+    for first_index in range(0, n_events, events_per_chunk):
+        dataframe = generate_event_dataframe(
+            min(events_per_chunk, n_events - first_index),
+            seed=random.integers(0, 2 ** 32),
+            with_uncertainties=with_uncertainties,
+            first_index=first_index
+        )
+        # move the events to a root with the default namespace
+        # to write them without prefixes
+        root = le.Element(
+            _add_quakeml_namespace('eventParameters'),
+            nsmap={None: 'http://quakeml.org/xmlns/bed/1.2'}
+        )
+        root.extend(list(QuakeMLDataframe.from_dataframe(dataframe).to_xml()))
+        content = le.tostring(root)
+        # only the events without the surrounding eventParameters
+        yield content[content.index(b'>') + 1:content.rindex(b'</')]
+    yield b'</eventParameters>\n'
+
+
+def _create_shakemap_values(field, lons, lats, event_lon, event_lat, random):
+    '''
+    Returns values for a shakemap field that decrease
+    with the distance to the event.
+    '''
+    if field.startswith('STD'):
+        return np.full(lons.shape, 0.7362585)
+    distance = np.hypot(lons - event_lon, lats - event_lat)
+    decay = np.exp(-distance / 0.5)
+    noise = random.lognormal(0.0, 0.3, lons.shape)
+    if field == 'MI':
+        return np.clip(2.0 + 7.0 * decay * noise, 1.0, 10.0)
+    if field == 'PGV':
+        return 80.0 * decay * noise
+    return 0.8 * decay * noise
+
+
+def generate_shakemap(nlat, nlon, fields=('PGA', 'STDPGA'), seed=0,
+                      lon_min=-71.225, lat_max=-32.65, spacing=0.008333,
+                      rows_per_chunk=64):
+    '''
+    Returns an iterator over the byte chunks of a synthetic
+    shakemap_grid document with nlat x nlon grid cells
+    in the layout of the shakemaps of shakyground.
+    The grid starts in the north west corner and the
+    values decrease with the distance to the event in the
+    center of the grid. The same arguments give the same
+    document.
+    '''
+    random = np.random.default_rng(seed)
+    lon_max = lon_min + (nlon - 1) * spacing
+    lat_min = lat_max - (nlat - 1) * spacing
+    event_lon = (lon_min + lon_max) / 2
+    event_lat = (lat_min + lat_max) / 2
+    event_id = 'quakeml:quakeledger/synthetic_{}'.format(seed)
+
+    header = [
+        '<?xml version=\'1.0\' encoding=\'UTF-8\'?>',
+        '<ns1:shakemap_grid xmlns:ns1="{0}" '
+        'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+        'xmlns="{0}" code_version="shakyground 0.1" event_id="{1}" '
+        'map_status="RELEASED" '
+        'process_timestamp="2019-08-08T12:31:27.890823Z" '
+        'shakemap_event_type="stochastic" shakemap_id="{1}" '
+        'shakemap_originator="GFZ" shakemap_version="1" '
+        'xsi:schemaLocation="http://earthquake.usgs.gov '
+        'http://earthquake.usgs.gov/eqcenter/shakemap/xml/schemas/'
+        'shakemap.xsd">'
+        .format(SHAKEMAP_NAMESPACE, event_id),
+        '<event depth="30.0" event_description="" event_id="{}" '
+        'event_network="nan" event_timestamp="2019-01-01T00:00:00.000000Z" '
+        'lat="{}" lon="{}" magnitude="8.0"/>'.format(
+            event_id,
+            event_lat,
+            event_lon
+        ),
+        '<grid_specification lat_max="{}" lat_min="{}" lon_max="{}" '
+        'lon_min="{}" nlat="{}" nlon="{}" nominal_lat_spacing="{}" '
+        'nominal_lon_spacing="{}" regular_grid="1"/>'.format(
+            lat_max, lat_min, lon_max, lon_min, nlat, nlon, spacing, spacing
+        ),
+    ]
+    for field in fields:
+        if not field.startswith('STD'):
+            header.append(
+                '<event_specific_uncertainty name="{}" numsta="" '
+                'value="0.0"/>'.format(field.lower())
+            )
+    for index, (field, units) in enumerate(
+            [('LON', 'dd'), ('LAT', 'dd')] + [
+                (
+                    field,
+                    SHAKEMAP_FIELD_UNITS.get(
+                        field[3:] if field.startswith('STD') else field,
+                        'g'
+                    )
+                )
+                for field in fields
+            ]):
+        header.append('<grid_field index="{}" name="{}" units="{}"/>'.format(
+            index + 1,
+            field,
+            units
+        ))
+    header.append('<grid_data>\n')
+    yield ''.join(header).encode('utf-8')
+
+    lons = lon_min + np.arange(nlon) * spacing
+    for first_row in range(0, nlat, rows_per_chunk):
+        n_rows = min(rows_per_chunk, nlat - first_row)
+        chunk_lons, chunk_lats = np.meshgrid(
+            lons,
+            lat_max - (first_row + np.arange(n_rows)) * spacing
+        )
+        chunk_lons = chunk_lons.ravel()
+        chunk_lats = chunk_lats.ravel()
+        grid = np.column_stack([chunk_lons, chunk_lats] + [
+            _create_shakemap_values(
+                field,
+                chunk_lons,
+                chunk_lats,
+                event_lon,
+                event_lat,
+                random
+            )
+            for field in fields
+        ])
+        lines = io.StringIO()
+        np.savetxt(lines, grid, fmt='%.10g')
+        yield lines.getvalue().encode('utf-8')
+    yield b'</grid_data></ns1:shakemap_grid>\n'
@@ -0,0 +1,1819 @@
+#!/usr/bin/env python3
+
+'''
+This is a module
+for the execution of
+wps processes in the
+riesgos pipeline.
+
+The processes are executed
+with asyncio, so that independent
+processes run concurrently.
+'''
+
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import gzip
+import hashlib
+import heapq
+import http.server
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+import zlib
+
+import lxml.etree as le
+import numpy as np
+import pandas as pd
+import requests
+import requests.adapters
+import urllib3.util.request
+
+import gfzwpsformatconversions
+
+WPS_NAMESPACE = 'http://www.opengis.net/wps/1.0.0'
+OWS_NAMESPACE = 'http://www.opengis.net/ows/1.1'
+XLINK_NAMESPACE = 'http://www.w3.org/1999/xlink'
+
+NSMAP = {
+    'wps': WPS_NAMESPACE,
+    'ows': OWS_NAMESPACE,
+    'xlink': XLINK_NAMESPACE,
+}
+
+STATUS_ACCEPTED = 'ProcessAccepted'
+STATUS_STARTED = 'ProcessStarted'
+STATUS_PAUSED = 'ProcessPaused'
+STATUS_SUCCEEDED = 'ProcessSucceeded'
+STATUS_FAILED = 'ProcessFailed'
+
+# placeholder for xml documents that are inserted
+# into the execute request without parsing
+EMBEDDED_MARKER = b'embedded-' + uuid.uuid4().hex.encode('ascii')
+
+
+def _add_wps_namespace(element):
+    '''
+    Adds the namespace to the wps xml elements.
+    '''
+    return '{' + WPS_NAMESPACE + '}' + element
+
+
+def _add_ows_namespace(element):
+    '''
+    Adds the namespace to the ows xml elements.
+    '''
+    return '{' + OWS_NAMESPACE + '}' + element
+
+
+def _as_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, WpsOutput):
+        return value.content
+    return str(value).encode('utf-8')
+
+
+def _strip_xml_declaration(content):
+    '''
+    Returns the xml document without the xml declaration,
+    so that it can be embedded in another utf-8 document.
+    Returns None if the document has another encoding.
+    '''
+    if content.startswith(b'\xef\xbb\xbf'):
+        content = content[3:]
+    stripped = content.lstrip()
+    if not stripped.startswith(b'<?xml'):
+        return stripped
+    end = stripped.find(b'?>')
+    declaration = stripped[:end].lower()
+    if b'encoding' in declaration and not (
+            b'utf-8' in declaration or b'utf8' in declaration):
+        return None
+    return stripped[end + 2:].lstrip()
+
+
+class WpsOutput():
+    '''
+    Class for the content of a process output.
+
+    The content is downloaded only once and the
+    parsed views (text, json, xml, ...) are created
+    on first access and kept.
+    '''
+    def __init__(self, content, reference=None, mime_type=None):
+        self.content = content
+        self.reference = reference
+        self.mime_type = mime_type
+        self._views = {}
+
+    @classmethod
+    def from_reference(cls, reference, session=None, timeout=60.0):
+        '''
+        Downloads the content of the output reference.
+        '''
+        if session is None:
+            session = requests
+        response = session.get(reference, timeout=timeout)
+        response.raise_for_status()
+        return cls.from_response(response, reference)
+
+    @classmethod
+    def from_response(cls, response, reference=None):
+        '''
+        Creates the output from a response of the requests library.
+        '''
+        mime_type = response.headers.get('Content-Type')
+        if mime_type is not None:
+            mime_type = mime_type.split(';')[0].strip()
+        return cls(response.content, reference or response.url, mime_type)
+
+    def _get_view(self, name, create):
+        if name not in self._views:
+            self._views[name] = create()
+        return self._views[name]
+
+    @property
+    def text(self):
+        '''
+        The content as string.
+        '''
+        return self._get_view('text', lambda: self.content.decode('utf-8'))
+
+    def json(self):
+        '''
+        Returns the parsed json content.
+        '''
+        return self._get_view('json', lambda: json.loads(self.content))
+
+    @property
+    def xml(self):
+        '''
+        The parsed xml element.
+        '''
+        return self._get_view('xml', lambda: le.fromstring(self.content))
+
+    @property
+    def geodataframe(self):
+        '''
+        The geojson content as geodataframe.
+        '''
+        return self._get_view('geodataframe', self._to_geodataframe)
+
+    def _to_geodataframe(self):
+        # geopandas is slow to import and not needed for the other views
+        import geopandas as gpd  # pylint: disable=import-outside-toplevel
+        geojson = self.json()
+        crs = geojson.get('crs', {}).get('properties', {}).get(
+            'name',
+            'EPSG:4326'
+        )
+        return gpd.GeoDataFrame.from_features(geojson, crs=crs)
+
+    @property
+    def shakemap(self):
+        '''
+        The xml content as shakemap.
+        '''
+        return self._get_view(
+            'shakemap',
+            lambda: gfzwpsformatconversions.Shakemap.from_xml(self.xml)
+        )
+
+    @property
+    def quakeml(self):
+        '''
+        The xml content as quakeml.
+        '''
+        return self._get_view(
+            'quakeml',
+            lambda: gfzwpsformatconversions.QuakeML.from_xml(self.xml)
+        )
+
+    def to_complex_input(self, mime_type=None):
+        '''
+        Returns the output as input for another process.
+        The original bytes are given to the process unchanged.
+        '''
+        # the content type of the http response is often
+        # just application/octet-stream, so it is not used here
+        return ComplexDataInput(self, mime_type)
+
+
+class ComplexDataInput():
+    '''
+    Class for complex input data
+    (like xml or json documents).
+    '''
+    def __init__(self, value, mime_type=None):
+        self.value = value
+        self.mime_type = mime_type
+
+    def is_xml(self):
+        '''
+        Returns true if the value should be embedded
+        as xml in the execute request.
+        '''
+        if self.mime_type is not None:
+            return 'xml' in self.mime_type
+        return _as_bytes(self.value).lstrip()[:1] == b'<'
+
+
+class BoundingBoxDataInput():
+    '''
+    Class for bounding box input data.
+    The data contains the lower corner
+    followed by the upper corner.
+    '''
+    def __init__(self, data, crs='EPSG:4326', dimensions=2):
+        self.data = data
+        self.crs = crs
+        self.dimensions = dimensions
+
+
+class WpsExecution():
+    '''
+    Class for the state of a process execution.
+    '''
+    def __init__(self, identifier, status, status_location=None,
+                 outputs=None, message=None):
+        self.identifier = identifier
+        self.status = status
+        self.status_location = status_location
+        self.outputs = outputs or {}
+        self.message = message
+
+    def is_finished(self):
+        '''
+        Returns true if the process has succeeded or failed.
+        '''
+        return self.status in (STATUS_SUCCEEDED, STATUS_FAILED)
+
+    def is_succeeded(self):
+        '''
+        Returns true if the process has succeeded.
+        '''
+        return self.status == STATUS_SUCCEEDED
+
+    def get_output_reference(self, output_identifier):
+        '''
+        Returns the reference (url) of an output.
+        '''
+        return self.outputs[output_identifier]
+
+
+class WpsExecuteRequest():
+    '''
+    Class for the content of an execute request.
+    The inputs are pairs of identifier and value,
+    the outputs pairs of identifier and the flag if the output
+    should be given as reference.
+    '''
+    def __init__(self, identifier, inputs, outputs):
+        self.identifier = identifier
+        self.inputs = inputs
+        self.outputs = outputs
+
+    def to_xml(self):
+        '''
+        Returns the execute request as xml.
+        '''
+        return self._to_xml(None)
+
+    def _to_xml(self, embedded_documents):
+        execute = le.Element(
+            _add_wps_namespace('Execute'),
+            {'service': 'WPS', 'version': '1.0.0'},
+            nsmap=NSMAP
+        )
+        identifier = le.SubElement(execute, _add_ows_namespace('Identifier'))
+        identifier.text = self.identifier
+        data_inputs = le.SubElement(execute, _add_wps_namespace('DataInputs'))
+        for input_identifier, value in self.inputs:
+            WpsExecuteRequest._add_input_element(
+                data_inputs,
+                input_identifier,
+                value,
+                embedded_documents
+            )
+        response_form = le.SubElement(
+            execute,
+            _add_wps_namespace('ResponseForm')
+        )
+        response_document = le.SubElement(
+            response_form,
+            _add_wps_namespace('ResponseDocument'),
+            {'storeExecuteResponse': 'true', 'status': 'true'}
+        )
+        for output_identifier, as_reference in self.outputs:
+            output = le.SubElement(
+                response_document,
+                _add_wps_namespace('Output'),
+                {'asReference': 'true' if as_reference else 'false'}
+            )
+            identifier = le.SubElement(
+                output,
+                _add_ows_namespace('Identifier')
+            )
+            identifier.text = output_identifier
+        return execute
+
+    def to_xml_string(self):
+        '''
+        Returns the execute request as xml bytes.
+
+        Xml documents of complex inputs are inserted as they
+        are, without parsing and serializing them again.
+        '''
+        embedded_documents = []
+        content = le.tostring(
+            self._to_xml(embedded_documents),
+            xml_declaration=True,
+            encoding='UTF-8'
+        )
+        if not embedded_documents:
+            return content
+        parts = content.split(b'<!--' + EMBEDDED_MARKER + b'-->')
+        result = [parts[0]]
+        for document, part in zip(embedded_documents, parts[1:]):
+            result.append(document)
+            result.append(part)
+        return b''.join(result)
+
+    @staticmethod
+    def _add_input_element(data_inputs, input_identifier, value,
+                           embedded_documents=None):
+        wps_input = le.SubElement(data_inputs, _add_wps_namespace('Input'))
+        identifier = le.SubElement(wps_input, _add_ows_namespace('Identifier'))
+        identifier.text = input_identifier
+        data = le.SubElement(wps_input, _add_wps_namespace('Data'))
+
+        if isinstance(value, ComplexDataInput):
+            attributes = {}
+            if value.mime_type is not None:
+                attributes['mimeType'] = value.mime_type
+            complex_data = le.SubElement(
+                data,
+                _add_wps_namespace('ComplexData'),
+                attributes
+            )
+            if value.is_xml():
+                document = None
+                if embedded_documents is not None:
+                    document = _strip_xml_declaration(_as_bytes(value.value))
+                if document is not None:
+                    complex_data.append(
+                        le.Comment(EMBEDDED_MARKER.decode('ascii'))
+                    )
+                    embedded_documents.append(document)
+                else:
+                    complex_data.append(
+                        le.fromstring(_as_bytes(value.value))
+                    )
+            else:
+                complex_data.text = _as_bytes(value.value).decode('utf-8')
+        elif isinstance(value, BoundingBoxDataInput):
+            bounding_box = le.SubElement(
+                data,
+                _add_wps_namespace('BoundingBoxData'),
+                {
+                    'crs': value.crs,
+                    'dimensions': str(value.dimensions),
+                }
+            )
+            lower_corner = le.SubElement(
+                bounding_box,
+                _add_ows_namespace('LowerCorner')
+            )
+            lower_corner.text = ' '.join(
+                str(x) for x in value.data[:value.dimensions]
+            )
+            upper_corner = le.SubElement(
+                bounding_box,
+                _add_ows_namespace('UpperCorner')
+            )
+            upper_corner.text = ' '.join(
+                str(x) for x in value.data[value.dimensions:]
+            )
+        else:
+            literal_data = le.SubElement(
+                data,
+                _add_wps_namespace('LiteralData')
+            )
+            literal_data.text = str(value)
+
+
+def parse_execute_response(identifier, content):
+    '''
+    Reads the status, the status location and the
+    outputs from an execute response document.
+    Outputs given as reference are stored with their url,
+    all the other ones with their data (bytes).
+    '''
+    xml = le.fromstring(content)
+    if xml.tag == _add_ows_namespace('ExceptionReport'):
+        return WpsExecution(
+            identifier,
+            STATUS_FAILED,
+            message=' '.join(
+                text.strip()
+                for text in xml.itertext()
+                if text.strip()
+            )
+        )
+
+    status_element = xml.find(_add_wps_namespace('Status'))
+    status = STATUS_ACCEPTED
+    message = None
+    if status_element is not None and len(status_element):
+        status_child = status_element[0]
+        status = le.QName(status_child).localname
+        message = ' '.join(
+            text.strip()
+            for text in status_child.itertext()
+            if text.strip()
+        ) or None
+
+    outputs = {}
+    process_outputs = xml.find(_add_wps_namespace('ProcessOutputs'))
+    if process_outputs is not None:
+        for output in process_outputs.findall(_add_wps_namespace('Output')):
+            output_identifier = output.findtext(
+                _add_ows_namespace('Identifier')
+            )
+            reference = output.find(_add_wps_namespace('Reference'))
+            if reference is not None:
+                outputs[output_identifier] = reference.get(
+                    'href',
+                    reference.get('{' + XLINK_NAMESPACE + '}href')
+                )
+                continue
+            data = output.find(_add_wps_namespace('Data'))
+            if data is not None and len(data):
+                value = data[0]
+                if len(value):
+                    outputs[output_identifier] = le.tostring(value[0])
+                else:
+                    outputs[output_identifier] = _as_bytes(value.text or '')
+
+    return WpsExecution(
+        identifier,
+        status,
+        xml.get('statusLocation'),
+        outputs,
+        message
+    )
+
+
+class OutputCache():
+    '''
+    Class for a content addressed cache of process
+    outputs on disk.
+
+    The key is a hash of the process identifier, the sorted
+    literal inputs, the hashes of the complex inputs and the
+    requested outputs. The raw output bytes of an execution are
+    stored gzip compressed in one file per key.
+    If the files are larger than max_bytes together, the
+    least recently used ones are removed.
+    '''
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def create_key(identifier, inputs, outputs):
+        '''
+        Returns the hash for the execution of the process
+        with the inputs and the requested outputs.
+        '''
+        literals = []
+        complex_inputs = []
+        bounding_boxes = []
+        for input_identifier, value in inputs:
+            if isinstance(value, ComplexDataInput):
+                complex_inputs.append([
+                    input_identifier,
+                    value.mime_type,
+                    hashlib.sha256(_as_bytes(value.value)).hexdigest()
+                ])
+            elif isinstance(value, BoundingBoxDataInput):
+                bounding_boxes.append([
+                    input_identifier,
+                    value.crs,
+                    [float(x) for x in value.data]
+                ])
+            else:
+                literals.append([input_identifier, str(value)])
+        canonical = json.dumps({
+            'identifier': identifier,
+            'literals': sorted(literals),
+            'complex': sorted(complex_inputs, key=str),
+            'bounding_boxes': sorted(bounding_boxes, key=str),
+            'outputs': sorted(
+                [output_identifier, bool(as_reference)]
+                for output_identifier, as_reference in outputs
+            ),
+        }, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self._directory, key + '.gz')
+
+    def get(self, key):
+        '''
+        Returns the dict with the output bytes for the key
+        or None if it is not in the cache.
+        Truncated or corrupt files are removed and
+        count as misses.
+        '''
+        path = self._get_path(key)
+        try:
+            with gzip.open(path, 'rb') as cache_file:
+                header = json.loads(cache_file.readline())
+                outputs = {}
+                for name, length in header:
+                    outputs[name] = cache_file.read(length)
+                    if len(outputs[name]) != length:
+                        raise EOFError('Truncated cache file ' + path)
+                # reading to the end checks the crc of the file
+                if cache_file.read():
+                    raise ValueError('Unexpected data in cache file ' + path)
+            # the modification time is used for the lru order
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        except (EOFError, gzip.BadGzipFile, OSError, ValueError, zlib.error):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return outputs
+
+    def put(self, key, outputs):
+        '''
+        Stores the dict with the output bytes for the key.
+        '''
+        outputs = {name: _as_bytes(value) for name, value in outputs.items()}
+        header = json.dumps([
+            [name, len(value)]
+            for name, value in outputs.items()
+        ])
+        file_descriptor, temp_path = tempfile.mkstemp(
+            dir=self._directory,
+            suffix='.tmp'
+        )
+        with os.fdopen(file_descriptor, 'wb') as temp_file:
+            with gzip.GzipFile(fileobj=temp_file, mode='wb') as cache_file:
+                cache_file.write(header.encode('utf-8') + b'\n')
+                for value in outputs.values():
+                    cache_file.write(value)
+        os.replace(temp_path, self._get_path(key))
+        self._evict()
+
+    def _evict(self):
+        '''
+        Removes the least recently used files until
+        the size is below the limit.
+        '''
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self._directory):
+                if entry.name.endswith('.gz'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total_size <= self._max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+
+    def get_size(self):
+        '''
+        Returns the size of all the cache files in bytes.
+        '''
+        return sum(
+            entry.stat().st_size
+            for entry in os.scandir(self._directory)
+            if entry.name.endswith('.gz')
+        )
+
+    def clear(self):
+        '''
+        Removes all the cache files.
+        '''
+        with self._lock:
+            for entry in os.scandir(self._directory):
+                if entry.name.endswith('.gz'):
+                    os.remove(entry.path)
+
+
+class StatusPoller():
+    '''
+    Class to poll the states of all the running
+    executions of a client in one place.
+
+    Each execution has its own poll interval that starts
+    with initial_interval and grows with the factor up to
+    max_interval; it starts again from the beginning when the
+    status changes. All the executions that are due are
+    requested together over the pooled connections.
+    '''
+    def __init__(self, client, initial_interval=1.0, max_interval=30.0,
+                 factor=1.5, poll_counts=None):
+        self._client = client
+        self._initial_interval = initial_interval
+        self._max_interval = max_interval
+        self._factor = factor
+        self._queue = []
+        self._jobs = {}
+        self._wakeup = None
+        self._task = None
+        if poll_counts is None:
+            poll_counts = collections.Counter()
+        self.poll_counts = poll_counts
+
+    def watch(self, execution):
+        '''
+        Adds the execution and returns a future that is
+        done as soon as the execution is finished.
+        An execution that is already watched gives
+        the same future again.
+        '''
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if execution.is_finished():
+            future.set_result(execution)
+            return future
+        if execution.status_location is None:
+            raise Exception(
+                'No status location for the process {}'.format(
+                    execution.identifier
+                )
+            )
+        job = execution.status_location
+        if job in self._jobs:
+            return self._jobs[job][1]
+        self._jobs[job] = (execution, future, self._initial_interval)
+        heapq.heappush(
+            self._queue,
+            (loop.time() + self._initial_interval, job)
+        )
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        return future
+
+    async def wait(self, execution):
+        '''
+        Waits until the execution is finished.
+        '''
+        return await self.watch(execution)
+
+    def get_running_count(self):
+        '''
+        Returns the number of executions that are not finished yet.
+        '''
+        return len(self._jobs)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self._jobs:
+            self._wakeup.clear()
+            delay = self._queue[0][0] - loop.time()
+            if delay > 0:
+                try:
+                    # a new execution may be due earlier
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+            now = loop.time()
+            due = []
+            while self._queue and self._queue[0][0] <= now:
+                job = heapq.heappop(self._queue)[1]
+                if job not in due:
+                    due.append(job)
+            await asyncio.gather(*[self._poll(job) for job in due])
+
+    async def _poll(self, job):
+        if job not in self._jobs:
+            # already finished
+            return
+        execution, future, interval = self._jobs[job]
+        self.poll_counts[job] += 1
+        try:
+            updated = await self._client.update(execution)
+        except Exception as exception:  # pylint: disable=broad-except
+            self._jobs.pop(job, None)
+            if not future.done():
+                future.set_exception(exception)
+            return
+        if updated.is_finished():
+            self._jobs.pop(job, None)
+            if not future.done():
+                future.set_result(updated)
+            return
+        if updated.status_location is None:
+            updated.status_location = job
+        if updated.status != execution.status:
+            interval = self._initial_interval
+        else:
+            interval = min(self._max_interval, interval * self._factor)
+        self._jobs[job] = (updated, future, interval)
+        heapq.heappush(
+            self._queue,
+            (asyncio.get_running_loop().time() + interval, job)
+        )
+
+
+class WpsClient():
+    '''
+    Class for the asynchronous execution of
+    wps processes.
+
+    All the http requests share one connection pool.
+    The blocking requests run in a thread pool, so that
+    the submission, the status polling and the downloads of
+    several processes can run concurrently.
+
+    The client accepts all the content encodings that
+    urllib3 can decode (gzip, deflate and zstd or br if the
+    packages are installed). With compress_requests the
+    execute requests are sent gzip compressed - this must
+    be supported by the server.
+    '''
+    def __init__(self, url, max_connections=10, poll_interval=1.0,
+                 timeout=60.0, session=None, cache=None,
+                 max_poll_interval=30.0, compress_requests=False):
+        self._url = url
+        self._compress_requests = compress_requests
+        self._cache = cache
+        self._poll_interval = poll_interval
+        self._max_poll_interval = max_poll_interval
+        self._pollers = {}
+        self._poll_counts = collections.Counter()
+        self._timeout = timeout
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=max_connections,
+                pool_maxsize=max_connections
+            )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['Accept-Encoding'] = ', '.join(
+                encoding.strip()
+                for encoding in urllib3.util.request.ACCEPT_ENCODING.split(',')
+            )
+        self._session = session
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_connections
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        '''
+        Closes the connection pool and the thread pool.
+        '''
+        self._executor.shutdown(wait=False)
+        self._session.close()
+
+    def get_url(self):
+        '''
+        Returns the url of the wps server.
+        '''
+        return self._url
+
+    async def _request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self._timeout)
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(
+            self._executor,
+            functools.partial(self._session.request, method, url, **kwargs)
+        )
+        response.raise_for_status()
+        return response
+
+    async def submit(self, identifier, inputs, outputs):
+        '''
+        Submits the execute request and returns the
+        first state of the execution.
+        '''
+        request = WpsExecuteRequest(identifier, inputs, outputs)
+        data = request.to_xml_string()
+        headers = {'Content-Type': 'text/xml'}
+        if self._compress_requests:
+            data = gzip.compress(data)
+            headers['Content-Encoding'] = 'gzip'
+        response = await self._request(
+            'POST',
+            self._url,
+            data=data,
+            headers=headers
+        )
+        return parse_execute_response(identifier, response.content)
+
+    async def update(self, execution):
+        '''
+        Requests the actual state of the execution.
+        '''
+        response = await self._request('GET', execution.status_location)
+        return parse_execute_response(execution.identifier, response.content)
+
+    def get_poller(self):
+        '''
+        Returns the status poller for the running event loop.
+        '''
+        loop = asyncio.get_running_loop()
+        if loop not in self._pollers:
+            # there is only one loop in use at a time
+            self._pollers = {
+                loop: StatusPoller(
+                    self,
+                    self._poll_interval,
+                    self._max_poll_interval,
+                    poll_counts=self._poll_counts
+                )
+            }
+        return self._pollers[loop]
+
+    def get_poll_counts(self):
+        '''
+        Returns a dict with the number of status
+        requests per status location.
+        '''
+        return dict(self._poll_counts)
+
+    async def wait(self, execution):
+        '''
+        Polls the state until the execution is finished.
+        Raises an exception if the process failed.
+        '''
+        execution = await self.get_poller().wait(execution)
+        return WpsClient._check_succeeded(execution)
+
+    @staticmethod
+    def _check_succeeded(execution):
+        if not execution.is_succeeded():
+            raise Exception('Process {} failed: {}'.format(
+                execution.identifier,
+                execution.message
+            ))
+        return execution
+
+    async def execute(self, identifier, inputs, outputs):
+        '''
+        Executes the process and waits until it is finished.
+        '''
+        execution = await self.submit(identifier, inputs, outputs)
+        return await self.wait(execution)
+
+    async def execute_all(self, execute_requests):
+        '''
+        Executes all the processes (given as WpsExecuteRequest)
+        concurrently and returns their executions in
+        the same order.
+        '''
+        return await asyncio.gather(*[
+            self.execute(request.identifier, request.inputs, request.outputs)
+            for request in execute_requests
+        ])
+
+    async def fetch(self, reference):
+        '''
+        Downloads the content of an output reference.
+        '''
+        response = await self._request('GET', reference)
+        return response.content
+
+    async def fetch_stream(self, reference, loader):
+        '''
+        Downloads the content of an output reference
+        and gives the streaming response to the loader
+        (for example Shakemap.from_stream), so that the parsing
+        starts while the data arrives.
+        Returns the result of the loader.
+        '''
+        response = await self._request('GET', reference, stream=True)
+        loop = asyncio.get_running_loop()
+        with response:
+            return await loop.run_in_executor(
+                self._executor,
+                loader,
+                response
+            )
+
+    async def fetch_output(self, reference):
+        '''
+        Downloads the content of an output reference
+        and returns it as WpsOutput.
+        '''
+        response = await self._request('GET', reference)
+        return WpsOutput.from_response(response, reference)
+
+    async def fetch_outputs(self, execution):
+        '''
+        Downloads all the outputs of the execution concurrently.
+        Returns a dict with WpsOutput values.
+        '''
+        output_identifiers = list(execution.outputs.keys())
+        outputs = await asyncio.gather(*[
+            self._fetch_or_get_output(execution, output_identifier)
+            for output_identifier in output_identifiers
+        ])
+        return dict(zip(output_identifiers, outputs))
+
+    async def _fetch_or_get_output(self, execution, output_identifier):
+        value = execution.outputs[output_identifier]
+        if isinstance(value, bytes):
+            return WpsOutput(value)
+        return await self.fetch_output(value)
+
+    async def execute_and_fetch(self, identifier, inputs, outputs,
+                                use_cache=True):
+        '''
+        Executes the process and downloads all of its outputs.
+        Returns a dict with the output bytes.
+
+        If the client has a cache (and use_cache is true)
+        the outputs of an earlier execution with the same inputs
+        are returned without contacting the server.
+        '''
+        loop = asyncio.get_running_loop()
+        key = None
+        if self._cache is not None and use_cache:
+            key = OutputCache.create_key(identifier, inputs, outputs)
+            cached = await loop.run_in_executor(
+                self._executor,
+                self._cache.get,
+                key
+            )
+            if cached is not None:
+                return cached
+
+        execution = await self.execute(identifier, inputs, outputs)
+        output_identifiers = [
+            output_identifier
+            for output_identifier, _ in outputs
+        ]
+        contents = await asyncio.gather(*[
+            self._fetch_or_get_data(execution, output_identifier)
+            for output_identifier in output_identifiers
+        ])
+        result = dict(zip(output_identifiers, contents))
+
+        if key is not None:
+            await loop.run_in_executor(
+                self._executor,
+                self._cache.put,
+                key,
+                result
+            )
+        return result
+
+    async def _fetch_or_get_data(self, execution, output_identifier):
+        value = execution.outputs[output_identifier]
+        if isinstance(value, bytes):
+            # data given in the response document
+            return value
+        return await self.fetch(value)
+
+    async def fetch_all(self, references):
+        '''
+        Downloads the content of all the output references
+        concurrently.
+        '''
+        return await asyncio.gather(*[
+            self.fetch(reference)
+            for reference in references
+        ])
+
+
+def _hash_bytes(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def _hash_value(value):
+    '''
+    Returns a hash for an input value of a pipeline node.
+    Dataframes, series and arrays are hashed by their content,
+    xml elements and the wrappers with a to_xml method by the
+    serialized xml.
+    Returns None for values that can't be hashed by their
+    content (the node is not memoized then).
+    '''
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return _hash_bytes(
+            (type(value).__name__ + ':' + repr(value)).encode('utf-8')
+        )
+    if isinstance(value, (bytes, WpsOutput)):
+        return _hash_bytes(_as_bytes(value))
+    if isinstance(value, ComplexDataInput):
+        return _hash_bytes(
+            repr(value.mime_type).encode('utf-8') +
+            _as_bytes(value.value)
+        )
+    if isinstance(value, BoundingBoxDataInput):
+        return _hash_bytes(repr(
+            (value.crs, value.dimensions, [float(x) for x in value.data])
+        ).encode('utf-8'))
+    if isinstance(value, (list, tuple, dict)):
+        if isinstance(value, dict):
+            items = sorted(value.items(), key=lambda item: repr(item[0]))
+            value = [x for item in items for x in item]
+        hashes = [_hash_value(x) for x in value]
+        if None in hashes:
+            return None
+        return _hash_bytes(','.join(hashes).encode('utf-8'))
+    if isinstance(value, (np.ndarray, np.generic)):
+        if value.dtype.hasobject:
+            return None
+        return _hash_bytes(
+            repr((value.dtype.str, value.shape)).encode('utf-8') +
+            np.ascontiguousarray(value).tobytes()
+        )
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        try:
+            row_hashes = pd.util.hash_pandas_object(value, index=True)
+        except TypeError:
+            # cells with lists, dicts or other unhashable objects
+            return None
+        if isinstance(value, pd.DataFrame):
+            description = [list(value.columns), list(value.dtypes)]
+        else:
+            description = [value.name, value.dtype]
+        return _hash_bytes(
+            repr(description).encode('utf-8') +
+            row_hashes.to_numpy().tobytes()
+        )
+    if isinstance(value, le._Element):  # pylint: disable=protected-access
+        return _hash_bytes(le.tostring(value))
+    if callable(getattr(value, 'to_xml', None)):
+        return _hash_bytes(le.tostring(value.to_xml()))
+    return None
+
+
+class NodeOutput():
+    '''
+    Class for the reference to the result
+    of another node in the pipeline.
+    For process nodes the output is the output identifier,
+    for function nodes it is an optional key of the result.
+    '''
+    def __init__(self, node, output=None):
+        self.node = node
+        self.output = output
+
+
+class Parameter():
+    '''
+    Class for a value that is given to the
+    pipeline on running it.
+    '''
+    def __init__(self, name):
+        self.name = name
+
+
+class ProcessNode():
+    '''
+    Class for a wps process in the pipeline.
+    All the outputs are requested as reference
+    and the node results in a dict with WpsOutput values.
+
+    Inputs that reference outputs of other
+    nodes are given as complex data.
+    '''
+    def __init__(self, identifier, inputs, outputs):
+        self.identifier = identifier
+        self.inputs = inputs
+        self.outputs = outputs
+
+    def get_input_items(self):
+        '''
+        Returns the pairs of input name and value.
+        '''
+        return list(self.inputs)
+
+    def get_signature(self):
+        '''
+        Returns a text that identifies the work of the node.
+        '''
+        return 'process:{}:{}'.format(self.identifier, sorted(self.outputs))
+
+    @staticmethod
+    def _to_wps_input(value):
+        if isinstance(value, WpsOutput):
+            return value.to_complex_input()
+        if isinstance(value, bytes):
+            return ComplexDataInput(value)
+        return value
+
+    async def run(self, client, inputs):
+        '''
+        Executes the process and downloads its outputs.
+        '''
+        if client is None:
+            raise Exception(
+                'A wps client is needed for the process {}'.format(
+                    self.identifier
+                )
+            )
+        execution = await client.execute(
+            self.identifier,
+            [
+                (name, ProcessNode._to_wps_input(value))
+                for name, value in inputs
+            ],
+            [(output, True) for output in self.outputs]
+        )
+        return await client.fetch_outputs(execution)
+
+
+class FunctionNode():
+    '''
+    Class for a local function in the pipeline
+    (for example a format conversion).
+    The inputs are the keyword arguments of the function.
+    The function runs in a thread, so that it does
+    not block the other nodes.
+    '''
+    def __init__(self, function, inputs=None):
+        self.function = function
+        self.inputs = inputs or {}
+
+    def get_input_items(self):
+        '''
+        Returns the pairs of input name and value.
+        '''
+        return sorted(self.inputs.items(), key=lambda item: item[0])
+
+    def get_signature(self):
+        '''
+        Returns a text that identifies the work of the node.
+        '''
+        return 'function:{}.{}'.format(
+            getattr(self.function, '__module__', None),
+            getattr(self.function, '__qualname__', repr(self.function))
+        )
+
+    async def run(self, client, inputs):
+        '''
+        Calls the function with the inputs.
+        '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None,
+            functools.partial(self.function, **dict(inputs))
+        )
+
+
+class Pipeline():
+    '''
+    Class for a pipeline of wps processes and local
+    functions that depend on each other.
+
+    All nodes whose inputs are ready run concurrently.
+    The last result of each node is memoized with the hash of
+    its inputs, so that running the pipeline again only executes
+    the nodes that depend on a changed input.
+    Nodes with inputs that can't be hashed by their content
+    (other objects than numbers, texts, bytes, arrays, dataframes
+    and xml) are not memoized and run every time.
+    '''
+    def __init__(self):
+        self._nodes = collections.OrderedDict()
+        self._memo = {}
+        self.run_counts = collections.Counter()
+
+    def add(self, name, node):
+        '''
+        Adds (or replaces) a node.
+        Returns a reference to the result of the node.
+        '''
+        self._nodes[name] = node
+        return NodeOutput(name)
+
+    def get_node_names(self):
+        '''
+        Returns the names of the nodes.
+        '''
+        return list(self._nodes.keys())
+
+    def clear(self):
+        '''
+        Removes all memoized results.
+        '''
+        self._memo.clear()
+
+    def _get_dependencies(self, name):
+        node = self._nodes[name]
+        dependencies = []
+        for _, value in node.get_input_items():
+            if isinstance(value, NodeOutput):
+                if value.node not in self._nodes:
+                    raise Exception(
+                        'Unknown node {} used by {}'.format(value.node, name)
+                    )
+                dependencies.append(value.node)
+        return dependencies
+
+    def _get_order(self, targets):
+        '''
+        Returns the nodes needed for the targets
+        in topological order.
+        '''
+        order = []
+        state = {}
+
+        def visit(name):
+            if state.get(name) == 'done':
+                return
+            if state.get(name) == 'visiting':
+                raise Exception('Cycle in the pipeline at {}'.format(name))
+            state[name] = 'visiting'
+            for dependency in self._get_dependencies(name):
+                visit(dependency)
+            state[name] = 'done'
+            order.append(name)
+
+        for name in targets:
+            if name not in self._nodes:
+                raise Exception('Unknown node {}'.format(name))
+            visit(name)
+        return order
+
+    @staticmethod
+    def _select_output(result, output, output_hashes, name):
+        if output is None:
+            return result, output_hashes[None]
+        if output not in output_hashes:
+            raise Exception('No output {} for the node {}'.format(
+                output,
+                name
+            ))
+        return result[output], output_hashes[output]
+
+    async def run(self, client=None, parameters=None, targets=None):
+        '''
+        Runs the pipeline and returns a dict
+        with the results of the nodes.
+        If targets are given only those nodes
+        and the ones they depend on are run.
+        '''
+        parameters = parameters or {}
+        if targets is None:
+            targets = self.get_node_names()
+        order = self._get_order(targets)
+        entries = {}
+        tasks = {}
+
+        async def run_node(name):
+            node = self._nodes[name]
+            await asyncio.gather(*[
+                tasks[dependency]
+                for dependency in self._get_dependencies(name)
+            ])
+            inputs = []
+            input_hashes = []
+            for input_name, value in node.get_input_items():
+                if isinstance(value, NodeOutput):
+                    result, output_hashes = entries[value.node]
+                    value, value_hash = Pipeline._select_output(
+                        result,
+                        value.output,
+                        output_hashes,
+                        value.node
+                    )
+                elif isinstance(value, Parameter):
+                    if value.name not in parameters:
+                        raise Exception(
+                            'No value for the parameter {}'.format(value.name)
+                        )
+                    value = parameters[value.name]
+                    value_hash = _hash_value(value)
+                else:
+                    value_hash = _hash_value(value)
+                inputs.append((input_name, value))
+                input_hashes.append([input_name, value_hash])
+
+            if any(value_hash is None for _, value_hash in input_hashes):
+                # an input that can't be hashed: the node runs every time
+                # and the nodes that depend on it run again too
+                key = None
+            else:
+                key = _hash_bytes(json.dumps(
+                    [name, node.get_signature(), input_hashes]
+                ).encode('utf-8'))
+            memo_key, result, output_hashes = self._memo.get(
+                name,
+                (None, None, None)
+            )
+            if key is None or memo_key != key:
+                result = await node.run(client, inputs)
+                self.run_counts[name] += 1
+                output_key = key if key is not None else uuid.uuid4().hex
+                output_hashes = {None: output_key}
+                if isinstance(node, ProcessNode):
+                    # same content from the process means
+                    # no need to run the following nodes again
+                    for output, value in result.items():
+                        output_hashes[output] = _hash_value(value)
+                elif isinstance(result, dict):
+                    for output in result.keys():
+                        output_hashes[output] = _hash_bytes(
+                            (output_key + ':' + str(output)).encode('utf-8')
+                        )
+                if key is None:
+                    self._memo.pop(name, None)
+                else:
+                    self._memo[name] = (key, result, output_hashes)
+            entries[name] = (result, output_hashes)
+
+        for name in order:
+            tasks[name] = asyncio.ensure_future(run_node(name))
+        try:
+            await asyncio.gather(*tasks.values())
+        finally:
+            for task in tasks.values():
+                task.cancel()
+        return {name: entries[name][0] for name in order}
+
+
+def iterate_quakeml_events(dataframe, id_column='eventID'):
+    '''
+    Returns an iterator over the pairs of event id
+    and quakeml string for each event in the dataframe.
+    The xml is created only when the event is needed.
+    '''
+    for i in range(len(dataframe)):
+        event = dataframe.iloc[[i]]
+        yield (
+            event[id_column].iloc[0],
+            gfzwpsformatconversions.QuakeMLDataframe.from_dataframe(
+                event
+            ).to_xml_string()
+        )
+
+
+class BatchSummary():
+    '''
+    Class for the counts of a batch run.
+    The failures are pairs of the item and the error message.
+    '''
+    def __init__(self):
+        self.n_succeeded = 0
+        self.n_retries = 0
+        self.failures = []
+
+
+class BatchRunner():
+    '''
+    Class to run the same task for many items
+    (for example events) with a limited number of
+    concurrent executions.
+
+    New items are only taken from the iterable if
+    there is a free slot, and the results are given
+    to the consumer as soon as they are finished, so
+    that they don't need to be kept in memory.
+    Failed tasks are retried with an exponential
+    backoff and random jitter.
+    '''
+    def __init__(self, client, max_concurrency=8, max_retries=3,
+                 backoff=1.0, max_backoff=30.0, seed=None):
+        self._client = client
+        self._max_concurrency = max_concurrency
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._random = random.Random(seed)
+
+    def _get_delay(self, attempt):
+        return self._random.uniform(
+            0,
+            min(self._max_backoff, self._backoff * 2 ** attempt)
+        )
+
+    async def _run_with_retries(self, task, item, summary):
+        attempt = 0
+        while True:
+            try:
+                return item, await task(self._client, item), None
+            except Exception as exception:  # pylint: disable=broad-except
+                if attempt >= self._max_retries:
+                    return item, None, str(exception)
+                summary.n_retries += 1
+                await asyncio.sleep(self._get_delay(attempt))
+                attempt += 1
+
+    async def run(self, items, task, consumer):
+        '''
+        Runs the task (an async function with the
+        client and the item as arguments) for all the items.
+        The consumer is called with the item and the
+        result of each successful task.
+        Returns a BatchSummary.
+        '''
+        summary = BatchSummary()
+        iterator = iter(items)
+        pending = set()
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < self._max_concurrency:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.add(asyncio.ensure_future(
+                    self._run_with_retries(task, item, summary)
+                ))
+            if not pending:
+                return summary
+            done, pending = await asyncio.wait(
+                pending,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            for future in done:
+                item, result, error = future.result()
+                if error is None:
+                    consumer(item, result)
+                    summary.n_succeeded += 1
+                else:
+                    summary.failures.append((item, error))
+
+    @staticmethod
+    def _get_shakyground_task(identifier, quakeml_input, shakemap_output):
+        async def task(client, event):
+            execution = await client.execute(
+                identifier,
+                [(quakeml_input, ComplexDataInput(event[1], 'text/xml'))],
+                [(shakemap_output, True)]
+            )
+            return await client.fetch_stream(
+                execution.get_output_reference(shakemap_output),
+                gfzwpsformatconversions.Shakemap.from_stream
+            )
+        return task
+
+    async def run_shakyground(self, events, consumer,
+                              identifier='shakyground',
+                              quakeml_input='quakeMLFile',
+                              shakemap_output='shakeMapFile'):
+        '''
+        Runs the shakyground process for all events of the
+        dataframe and gives the event id and the shakemap
+        to the consumer (for example ShakemapStack.add).
+        The shakemaps are parsed while they are downloaded.
+        '''
+        return await self.run(
+            iterate_quakeml_events(events),
+            BatchRunner._get_shakyground_task(
+                identifier,
+                quakeml_input,
+                shakemap_output
+            ),
+            lambda event, shakemap: consumer(event[0], shakemap)
+        )
+
+    async def run_damage(self, events, damage_engine, consumer,
+                         identifier='shakyground',
+                         quakeml_input='quakeMLFile',
+                         shakemap_output='shakeMapFile'):
+        '''
+        Runs the shakyground process for all events of the
+        dataframe, computes the damage for each shakemap
+        with the DamageEngine (instead of the deus process)
+        and gives the event id and the DamageEngineResult
+        to the consumer (for example LossTable.add).
+        The damage is computed in a thread, so that
+        the other executions go on.
+        '''
+        shakyground = BatchRunner._get_shakyground_task(
+            identifier,
+            quakeml_input,
+            shakemap_output
+        )
+
+        async def task(client, event):
+            shakemap = await shakyground(client, event)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                None,
+                damage_engine.compute,
+                shakemap
+            )
+
+        return await self.run(
+            iterate_quakeml_events(events),
+            task,
+            lambda event, result: consumer(event[0], result)
+        )
+
+
+class StubProcess():
+    '''
+    Class for a process of the stub wps server.
+    The function gets a dict with the inputs
+    and must return a dict with the outputs.
+    The execution is reported as started until
+    the duration (in seconds) is over.
+    '''
+    def __init__(self, function, duration=0.0):
+        self.function = function
+        self.duration = duration
+
+
+class StubWpsServer():
+    '''
+    Class for a local wps server to test
+    the pipeline without network access.
+
+    It supports the asynchronous execution
+    with status locations and output references.
+    Literal inputs are given as str, complex inputs
+    as bytes and bounding boxes as list of floats.
+    '''
+    def __init__(self, processes, host='127.0.0.1', port=0):
+        self._processes = processes
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.request_counts = collections.Counter()
+        stub = self
+
+        class _Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                # pylint: disable=invalid-name
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length)
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    stub.request_counts['compressed'] += 1
+                    body = gzip.decompress(body)
+                stub.handle_post(self, body)
+
+            def do_GET(self):
+                # pylint: disable=invalid-name
+                stub.handle_get(self)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        '''
+        Starts the server in a background thread.
+        '''
+        self._thread = threading.Thread(
+            target=self._server.serve_forever,
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        '''
+        Stops the server.
+        '''
+        self._server.shutdown()
+        self._server.server_close()
+
+    def get_url(self):
+        '''
+        Returns the url for the execute requests.
+        '''
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}/wps/WebProcessingService'.format(host, port)
+
+    def _get_base_url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    @staticmethod
+    def _send(handler, status_code, content,
+              content_type='text/xml; charset=utf-8'):
+        handler.send_response(status_code)
+        handler.send_header('Content-Type', content_type)
+        accept_encoding = handler.headers.get('Accept-Encoding', '')
+        if len(content) > 1024 and 'gzip' in accept_encoding:
+            content = gzip.compress(content)
+            handler.send_header('Content-Encoding', 'gzip')
+        handler.send_header('Content-Length', str(len(content)))
+        handler.end_headers()
+        handler.wfile.write(content)
+
+    @staticmethod
+    def _read_inputs(execute):
+        inputs = {}
+        data_inputs = execute.find(_add_wps_namespace('DataInputs'))
+        if data_inputs is None:
+            return inputs
+        for wps_input in data_inputs.findall(_add_wps_namespace('Input')):
+            identifier = wps_input.findtext(_add_ows_namespace('Identifier'))
+            data = wps_input.find(_add_wps_namespace('Data'))[0]
+            name = le.QName(data).localname
+            if name == 'ComplexData':
+                if len(data):
+                    inputs[identifier] = le.tostring(data[0])
+                else:
+                    inputs[identifier] = _as_bytes(data.text or '')
+            elif name == 'BoundingBoxData':
+                inputs[identifier] = [
+                    float(x)
+                    for corner in ('LowerCorner', 'UpperCorner')
+                    for x in data.findtext(_add_ows_namespace(corner)).split()
+                ]
+            else:
+                inputs[identifier] = data.text or ''
+        return inputs
+
+    def handle_post(self, handler, body):
+        '''
+        Handles an execute request.
+        '''
+        self.request_counts['execute'] += 1
+        execute = le.fromstring(body)
+        identifier = execute.findtext(_add_ows_namespace('Identifier'))
+        if identifier not in self._processes:
+            StubWpsServer._send(
+                handler,
+                400,
+                self._exception_report('No such process: ' + identifier)
+            )
+            return
+        process = self._processes[identifier]
+        job_id = uuid.uuid4().hex
+        try:
+            outputs = process.function(StubWpsServer._read_inputs(execute))
+            message = None
+        except Exception as exception:  # pylint: disable=broad-except
+            outputs = None
+            message = str(exception)
+        with self._lock:
+            self._jobs[job_id] = {
+                'identifier': identifier,
+                'finish_time': time.monotonic() + process.duration,
+                'outputs': {
+                    name: _as_bytes(value)
+                    for name, value in (outputs or {}).items()
+                },
+                'message': message,
+            }
+        StubWpsServer._send(
+            handler,
+            200,
+            self._execute_response(job_id, STATUS_ACCEPTED)
+        )
+
+    def handle_get(self, handler):
+        '''
+        Handles the status and output requests.
+        '''
+        path = urllib.parse.urlparse(handler.path).path.strip('/').split('/')
+        job = None
+        if len(path) >= 2:
+            with self._lock:
+                job = self._jobs.get(path[1])
+        if job is None:
+            StubWpsServer._send(
+                handler,
+                404,
+                self._exception_report('Not found')
+            )
+            return
+        if path[0] == 'status':
+            self.request_counts['status'] += 1
+            if time.monotonic() < job['finish_time']:
+                status = STATUS_STARTED
+            elif job['message'] is not None:
+                status = STATUS_FAILED
+            else:
+                status = STATUS_SUCCEEDED
+            StubWpsServer._send(
+                handler,
+                200,
+                self._execute_response(path[1], status)
+            )
+        elif path[0] == 'outputs' and len(path) == 3:
+            self.request_counts['output'] += 1
+            StubWpsServer._send(
+                handler,
+                200,
+                job['outputs'][path[2]],
+                'application/octet-stream'
+            )
+        else:
+            StubWpsServer._send(
+                handler,
+                404,
+                self._exception_report('Not found')
+            )
+
+    def _execute_response(self, job_id, status):
+        job = self._jobs[job_id]
+        response = le.Element(
+            _add_wps_namespace('ExecuteResponse'),
+            {
+                'service': 'WPS',
+                'version': '1.0.0',
+                'statusLocation': '{}/status/{}'.format(
+                    self._get_base_url(),
+                    job_id
+                ),
+            },
+            nsmap=NSMAP
+        )
+        process = le.SubElement(response, _add_wps_namespace('Process'))
+        identifier = le.SubElement(process, _add_ows_namespace('Identifier'))
+        identifier.text = job['identifier']
+        status_element = le.SubElement(response, _add_wps_namespace('Status'))
+        if status == STATUS_FAILED:
+            failed = le.SubElement(
+                status_element,
+                _add_wps_namespace(STATUS_FAILED)
+            )
+            failed.text = job['message']
+            return le.tostring(response)
+        le.SubElement(status_element, _add_wps_namespace(status))
+        if status == STATUS_SUCCEEDED:
+            process_outputs = le.SubElement(
+                response,
+                _add_wps_namespace('ProcessOutputs')
+            )
+            for name in job['outputs']:
+                output = le.SubElement(
+                    process_outputs,
+                    _add_wps_namespace('Output')
+                )
+                output_identifier = le.SubElement(
+                    output,
+                    _add_ows_namespace('Identifier')
+                )
+                output_identifier.text = name
+                le.SubElement(
+                    output,
+                    _add_wps_namespace('Reference'),
+                    {
+                        'href': '{}/outputs/{}/{}'.format(
+                            self._get_base_url(),
+                            job_id,
+                            name
+                        )
+                    }
+                )
+        return le.tostring(response)
+
+    @staticmethod
+    def _exception_report(text):
+        report = le.Element(
+            _add_ows_namespace('ExceptionReport'),
+            {'version': '1.0.0'},
+            nsmap=NSMAP
+        )
+        exception = le.SubElement(report, _add_ows_namespace('Exception'))
+        exception_text = le.SubElement(
+            exception,
+            _add_ows_namespace('ExceptionText')
+        )
+        exception_text.text = text
+        return le.tostring(report)
@@ -8,12 +8,30 @@ library related python code.
 To run the tests use pytest.
 '''
 
+import asyncio
+import copy
+import gzip
+import io
+import json
 import math
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import warnings
 
 import lxml.etree as le
+import numpy as np
 import pandas as pd
+import requests
 
+import benchmark_all
+import gfzwpsconvert
 import gfzwpsformatconversions
+import gfzwpspipeline
 
 
 def test_quakeml2df():
@@ -586,3 +604,2303 @@ def test_shakemap2dataframe():
     first_event_with_location = event_geodataframe.iloc[0]
     assert -28.7 < first_event_with_location['geometry'].y < -28.6
     assert -71.3 < first_event_with_location['geometry'].x < 71.2
+
+
+def _read_testinput(filename):
+    '''
+    Reads the content of a file in the testinputs folder.
+    '''
+    path = os.path.join(os.path.dirname(__file__), 'testinputs', filename)
+    with open(path, 'rb') as input_file:
+        return input_file.read()
+
+
+def test_exposure():
+    '''
+    Tests the conversion of the exposure model
+    to the columnar expo table.
+    '''
+    exposure = gfzwpsformatconversions.Exposure.from_string(
+        _read_testinput('exposure_sara.json')
+    )
+
+    expo = exposure.to_expo_dataframe()
+
+    assert len(expo) == 45
+    assert list(expo['feature'].unique()) == [0, 1, 2]
+
+    first_one = expo.iloc[0]
+    assert first_one['feature'] == 0
+    assert first_one['asset'] == '1022'
+    assert first_one['Taxonomy'] == 'MCF-DUC-H1-3'
+    assert 641.0 < first_one['Buildings'] < 641.2
+    assert first_one['Damage'] == 'D0'
+    assert 9107.1 < first_one['Population'] < 9107.3
+
+    buildings_per_feature = expo.groupby('feature')['Buildings'].sum()
+    assert 17289.6 < buildings_per_feature[0] < 17289.8
+
+    properties = exposure.to_properties_dataframe()
+    assert len(properties) == 3
+    assert properties.iloc[1]['name'] == 'Valparaiso'
+    assert 'expo' not in properties.columns
+
+    geometries = exposure.to_geometry_array()
+    assert len(geometries) == 3
+    assert geometries[0]['type'] == 'MultiPolygon'
+
+    geodataframe = exposure.to_geodataframe()
+    assert len(geodataframe) == 3
+    assert geodataframe.iloc[0]['geometry'].geom_type == 'MultiPolygon'
+
+
+def test_fragility():
+    '''
+    Tests the evaluation of the fragility functions.
+    '''
+    fragility = gfzwpsformatconversions.Fragility.from_string(
+        _read_testinput('fragility_sara.json')
+    )
+
+    assert fragility.get_damage_states() == ['D1', 'D2', 'D3', 'D4']
+    assert fragility.get_mean_matrix().shape == (39, 4)
+    assert fragility.get_stddev_matrix().shape == (39, 4)
+
+    taxonomy_indices = fragility.to_taxonomy_indices(
+        ['MUR-H1', 'MUR-H1', 'ER-ETR-H1-2', 'unknown']
+    )
+    assert list(taxonomy_indices[[0, 1, 3]]) == [0, 0, -1]
+    assert fragility.get_taxonomies()[taxonomy_indices[2]] == 'ER_ETR_H1_2'
+
+    intensities = [0.0, 0.5, 0.5, 0.5]
+    probabilities = fragility.to_exceedance_probabilities(
+        intensities,
+        taxonomy_indices
+    )
+
+    assert probabilities.shape == (4, 4)
+    assert list(probabilities[0]) == [0.0, 0.0, 0.0, 0.0]
+
+    # lognorm(scale=exp(D4_mean), s=D4_stddev).cdf(0.5)
+    expected = 0.5 * (
+        1 + math.erf((math.log(0.5) + 0.231) / (0.317 * math.sqrt(2)))
+    )
+    assert abs(probabilities[1, 3] - expected) < 1e-12
+    # higher damage states are less likely
+    assert all(probabilities[1, :-1] >= probabilities[1, 1:])
+    assert all(math.isnan(x) for x in probabilities[3])
+
+    all_probabilities = fragility.to_exceedance_probabilities(intensities)
+    assert all_probabilities.shape == (4, 39, 4)
+    assert all_probabilities[1, 0, 3] == probabilities[1, 3]
+
+    # negative intensities exceed nothing, NaN stays NaN (without warnings)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        invalid = fragility.to_exceedance_probabilities(
+            [-0.5, math.nan],
+            [0, 0]
+        )
+        all_invalid = fragility.to_exceedance_probabilities([-0.5, math.nan])
+    assert list(invalid[0]) == [0.0, 0.0, 0.0, 0.0]
+    assert all(math.isnan(x) for x in invalid[1])
+    assert (all_invalid[0] == 0.0).all()
+    assert np.isnan(all_invalid[1]).all()
+
+
+def test_fragility_lookup_table():
+    '''
+    Tests the evaluation of the fragility functions
+    using the precomputed lookup table.
+    '''
+    fragility = gfzwpsformatconversions.Fragility.from_string(
+        _read_testinput('fragility_sara.json')
+    )
+    assert fragility.get_lookup_table_max_error() is None
+
+    fragility_with_table = fragility.with_lookup_table(
+        intensity_max=3.0,
+        n_points=2048
+    )
+    max_error = fragility_with_table.get_lookup_table_max_error()
+    assert 0.0 < max_error < 1e-3
+
+    random = np.random.default_rng(42)
+    intensities = random.uniform(0.0, 3.0, 10000)
+    taxonomy_indices = random.integers(0, 39, 10000)
+
+    exact = fragility.to_exceedance_probabilities(
+        intensities,
+        taxonomy_indices
+    )
+    interpolated = fragility_with_table.to_exceedance_probabilities(
+        intensities,
+        taxonomy_indices
+    )
+    assert interpolated.shape == (10000, 4)
+    assert np.max(np.abs(exact - interpolated)) <= max_error * 1.01
+
+    all_interpolated = fragility_with_table.to_exceedance_probabilities(
+        intensities[:10]
+    )
+    assert all_interpolated.shape == (10, 39, 4)
+    assert np.allclose(
+        all_interpolated[np.arange(10), taxonomy_indices[:10]],
+        interpolated[:10]
+    )
+
+    # values outside of the range are clamped
+    outside = fragility_with_table.to_exceedance_probabilities(
+        [-1.0, 0.0, 3.0, 10.0, math.nan],
+        [0, 0, 0, 0, 0]
+    )
+    assert list(outside[0]) == list(outside[1])
+    assert list(outside[2]) == list(outside[3])
+    assert all(math.isnan(x) for x in outside[4])
+
+
+def test_damage_engine():
+    '''
+    Tests the local damage computation.
+    '''
+    raw_xml = b'''<shakemap_grid
+        xmlns="http://earthquake.usgs.gov/eqcenter/shakemap"
+        event_id="quakeml:quakeledger/CHOA_122"
+        shakemap_id="quakeml:quakeledger/CHOA_122"
+        shakemap_version="1"
+        shakemap_event_type="expert">
+    <grid_specification
+        lon_min="-72.0"
+        lat_min="-33.5"
+        lon_max="-71.0"
+        lat_max="-32.5"
+        nominal_lon_spacing="0.5"
+        nominal_lat_spacing="0.5"
+        nlon="3"
+        nlat="3"
+        regular_grid="1" />
+    <grid_field index="1" name="LON" units="dd" />
+    <grid_field index="2" name="LAT" units="dd" />
+    <grid_field index="3" name="PGA" units="g" />
+    <grid_data>-72.0 -32.5 0.3
+        -71.5 -32.5 0.3
+        -71.0 -32.5 0.3
+        -72.0 -33.0 0.3
+        -71.5 -33.0 0.3
+        -71.0 -33.0 0.3
+        -72.0 -33.5 0.3
+        -71.5 -33.5 0.3
+        -71.0 -33.5 0.3
+    </grid_data>
+</shakemap_grid>
+    '''
+    shakemap = gfzwpsformatconversions.Shakemap.from_xml(
+        le.fromstring(raw_xml)
+    )
+    assert shakemap.to_grid_array().shape == (9, 3)
+    values = shakemap.to_values_at([-71.6, -80.0], [-33.1, -33.0], 'PGA')
+    assert values[0] == 0.3
+    assert math.isnan(values[1])
+
+    exposure = gfzwpsformatconversions.Exposure.from_string(
+        _read_testinput('exposure_sara.json')
+    )
+    fragility = gfzwpsformatconversions.Fragility.from_string(
+        _read_testinput('fragility_sara.json')
+    )
+    engine = gfzwpsformatconversions.DamageEngine(exposure, fragility)
+    result = engine.compute(shakemap)
+
+    expo = exposure.to_expo_dataframe()
+    updated_expo = result.to_updated_exposure().to_expo_dataframe()
+
+    assert set(updated_expo['Damage']) == {'D0', 'D1', 'D2', 'D3', 'D4'}
+    assert np.allclose(
+        updated_expo.groupby('feature')['Buildings'].sum(),
+        expo.groupby('feature')['Buildings'].sum()
+    )
+
+    # MCF-DUC-H1-3 is MCF_DUC_H1_3 in the fragility functions
+    first_asset = updated_expo[
+        (updated_expo['feature'] == 0) &
+        (updated_expo['Taxonomy'] == 'MCF-DUC-H1-3')
+    ]
+    exceedance = fragility.to_exceedance_probabilities(
+        [0.3],
+        fragility.to_taxonomy_indices(['MCF-DUC-H1-3'])
+    )[0]
+    d4 = first_asset[first_asset['Damage'] == 'D4'].iloc[0]
+    assert abs(d4['Buildings'] - 641.1 * exceedance[3]) < 1e-9
+    assert abs(d4['Population'] - 9107.2 * exceedance[3]) < 1e-9
+
+    transitions = result.to_transition_dataframe()
+    assert set(transitions['from_damage_state']) == {'D0'}
+    assert set(transitions['to_damage_state']) == {'D1', 'D2', 'D3', 'D4'}
+    assert np.allclose(
+        transitions.groupby('feature')['n_buildings'].sum(),
+        updated_expo[updated_expo['Damage'] != 'D0'].groupby(
+            'feature'
+        )['Buildings'].sum()
+    )
+
+    loss_values = result.to_loss_array()
+    assert len(loss_values) == 3
+    assert all(loss_values > 0)
+
+    deus_output = result.to_deus_output()
+    assert len(deus_output['updated_exposure']['features']) == 3
+    first_damage = deus_output['damage']['features'][0]['properties']
+    assert first_damage['loss_value'] == loss_values[0]
+    assert first_damage['loss_unit'] == 'USD'
+    assert first_damage['name'] == 'Quilpue'
+    first_transitions = deus_output['transition']['features'][0][
+        'properties'
+    ]['transitions']
+    assert first_transitions['from_damage_state'] == ['D0'] * 4
+    assert first_transitions['to_damage_state'] == ['D1', 'D2', 'D3', 'D4']
+
+    # and the updated exposure can be used for another computation
+    updated_exposure = gfzwpsformatconversions.Exposure.from_geojson(
+        deus_output['updated_exposure']
+    )
+    second_result = gfzwpsformatconversions.DamageEngine(
+        updated_exposure,
+        fragility
+    ).compute(shakemap)
+    second_expo = second_result.to_updated_exposure().to_expo_dataframe()
+    assert np.allclose(
+        second_expo.groupby('feature')['Buildings'].sum(),
+        expo.groupby('feature')['Buildings'].sum()
+    )
+    # one row per feature, taxonomy and damage state
+    for dataframe in (updated_expo, second_expo):
+        assert not dataframe.duplicated(
+            ['feature', 'Taxonomy', 'Damage']
+        ).any()
+    assert len(second_expo) == len(updated_expo)
+    third_expo = gfzwpsformatconversions.DamageEngine(
+        second_result.to_updated_exposure(),
+        fragility
+    ).compute(shakemap).to_updated_exposure().to_expo_dataframe()
+    assert len(third_expo) == len(second_expo)
+
+    # no intensities for the exposure, so nothing changes
+    unchanged_result = engine.compute(
+        gfzwpsformatconversions.Shakemap.from_xml(
+            le.fromstring(_read_testinput('shakemap.xml'))
+        )
+    )
+    assert len(unchanged_result.to_transition_dataframe()) == 0
+    assert unchanged_result.to_loss_array().dtype == np.float64
+    assert list(unchanged_result.to_loss_array()) == [0.0, 0.0, 0.0]
+    damage_states = fragility.get_all_damage_states()
+    state_counts = exposure.to_damage_state_counts(damage_states)
+    first_transitions = result.to_transitions()
+    second_sparse_transitions = second_result.to_transitions()
+    assert np.allclose(
+        first_transitions.apply(state_counts),
+        updated_exposure.to_damage_state_counts(damage_states)
+    )
+    assert np.allclose(
+        first_transitions.compose(
+            second_sparse_transitions,
+            state_counts
+        ).apply_to_exposure(exposure).to_numpy(),
+        second_result.to_updated_exposure().to_damage_state_counts(
+            damage_states
+        )
+    )
+    assert np.allclose(
+        gfzwpsformatconversions.Transitions.from_geojson(
+            deus_output['transition'],
+            damage_states
+        ).to_csr().toarray(),
+        first_transitions.to_csr().toarray()
+    )
+
+    second_transitions = second_result.to_transition_dataframe()
+    assert 'D4' not in set(second_transitions['from_damage_state'])
+    assert all(
+        int(from_state[1:]) < int(to_state[1:])
+        for from_state, to_state in zip(
+            second_transitions['from_damage_state'],
+            second_transitions['to_damage_state']
+        )
+    )
+
+
+def _create_grid_shakemap(pga, event_id='quakeml:quakeledger/CHOA_122'):
+    '''
+    Creates the xml of a shakemap with the same pga
+    for the 3x3 cells around the sara exposure.
+    '''
+    grid_data = '\n'.join(
+        '{} {} {}'.format(lon, lat, pga)
+        for lat in (-32.5, -33.0, -33.5)
+        for lon in (-72.0, -71.5, -71.0)
+    )
+    return '''<shakemap_grid
+        xmlns="http://earthquake.usgs.gov/eqcenter/shakemap"
+        event_id="{event_id}" shakemap_id="{event_id}"
+        shakemap_version="1" shakemap_event_type="expert">
+    <grid_specification lon_min="-72.0" lat_min="-33.5"
+        lon_max="-71.0" lat_max="-32.5"
+        nominal_lon_spacing="0.5" nominal_lat_spacing="0.5"
+        nlon="3" nlat="3" regular_grid="1" />
+    <grid_field index="1" name="LON" units="dd" />
+    <grid_field index="2" name="LAT" units="dd" />
+    <grid_field index="3" name="PGA" units="g" />
+    <grid_data>{grid_data}</grid_data>
+</shakemap_grid>'''.format(
+        event_id=event_id,
+        grid_data=grid_data
+    ).encode('utf-8')
+
+
+def test_damage_result_aggregation():
+    '''
+    Tests the aggregations of the damage results
+    (by feature properties, by the updated exposure
+    and by the taxonomy of the transitions).
+    '''
+    exposure = gfzwpsformatconversions.Exposure.from_string(
+        _read_testinput('exposure_sara.json')
+    )
+    fragility = gfzwpsformatconversions.Fragility.from_string(
+        _read_testinput('fragility_sara.json')
+    )
+    shakemap = gfzwpsformatconversions.Shakemap.from_xml(
+        le.fromstring(_create_grid_shakemap(0.3))
+    )
+    result = gfzwpsformatconversions.DamageEngine(
+        exposure,
+        fragility
+    ).compute(shakemap)
+    expo = exposure.to_expo_dataframe()
+    loss_values = result.to_loss_array()
+    deus_output = result.to_deus_output()
+
+    damage_result = gfzwpsformatconversions.DamageResult.from_string(
+        json.dumps(deus_output['damage']),
+        json.dumps(deus_output['updated_exposure'])
+    )
+    assert damage_result.to_dataframe()['loss_value'].dtype == np.float64
+    assert abs(damage_result.get_total_loss() - sum(loss_values)) < 1e-6
+    assert damage_result.get_max_loss() == max(loss_values)
+    quantiles = damage_result.get_loss_quantiles([0.0, 1.0])
+    assert quantiles[0] == min(loss_values)
+    assert quantiles[1] == max(loss_values)
+    loss_by_name = damage_result.to_loss_by('name')
+    assert loss_by_name['Quilpue'] == loss_values[0]
+    buildings_by_name_and_damage = damage_result.to_exposure_aggregation(
+        ['name', 'Damage']
+    )
+    assert abs(
+        buildings_by_name_and_damage['Quilpue'].sum() - 17289.7
+    ) < 1e-6
+    buildings_by_taxonomy = damage_result.to_exposure_aggregation('Taxonomy')
+    assert abs(
+        buildings_by_taxonomy['MCF-DUC-H1-3'] -
+        expo[expo['Taxonomy'] == 'MCF-DUC-H1-3']['Buildings'].sum()
+    ) < 1e-6
+    engine_damage_result = result.to_damage_result()
+    assert engine_damage_result.get_total_loss() == \
+        damage_result.get_total_loss()
+
+    loss_by_taxonomy = engine_damage_result.to_loss_by_taxonomy()
+    assert abs(loss_by_taxonomy.sum() - sum(loss_values)) < 1e-6
+    # all assets start in D0 (with a loss ratio of 0)
+    updated_expo = result.to_updated_exposure().to_expo_dataframe()
+    loss_ratios = updated_expo['Damage'].map(
+        gfzwpsformatconversions.DamageEngine.DEFAULT_LOSS_RATIOS
+    )
+    expected = (
+        updated_expo['Buildings'] *
+        updated_expo['Repl-cost-USD-bdg'] *
+        loss_ratios
+    ).groupby(updated_expo['Taxonomy']).sum()
+    assert np.allclose(
+        loss_by_taxonomy,
+        expected.loc[loss_by_taxonomy.index]
+    )
+    try:
+        damage_result.to_loss_by_taxonomy()
+        message = None
+    except Exception as exception:  # pylint: disable=broad-except
+        message = str(exception)
+    assert message == 'There are no losses per taxonomy'
+
+
+def test_transitions():
+    '''
+    Tests the sparse transition matrices and
+    the composition of two hazards.
+    '''
+    damage_states = ['D0', 'D1', 'D2']
+    dataframe = pd.DataFrame({
+        'feature': [0, 0, 2],
+        'from_damage_state': ['D0', 'D0', 'D1'],
+        'to_damage_state': ['D1', 'D2', 'D2'],
+        'n_buildings': [10.0, 5.0, 2.0],
+    })
+    first = gfzwpsformatconversions.Transitions.from_dataframe(
+        dataframe,
+        3,
+        damage_states
+    )
+    assert first.to_csr().shape == (3, 9)
+    assert first.to_csr()[0, 1] == 10.0
+    assert first.to_csr()[2, 5] == 2.0
+
+    state_counts = np.array([
+        [100.0, 0.0, 0.0],
+        [50.0, 0.0, 0.0],
+        [0.0, 4.0, 0.0],
+    ])
+    assert np.allclose(first.apply(state_counts), [
+        [85.0, 10.0, 5.0],
+        [50.0, 0.0, 0.0],
+        [0.0, 2.0, 2.0],
+    ])
+
+    geojson = {
+        'type': 'FeatureCollection',
+        'features': [
+            {
+                'type': 'Feature',
+                'geometry': None,
+                'properties': {
+                    'transitions': {
+                        'from_damage_state': ['D0', 'D1'],
+                        'to_damage_state': ['D1', 'D2'],
+                        'n_buildings': [17.0, 5.0],
+                    },
+                },
+            },
+            {
+                'type': 'Feature',
+                'geometry': None,
+                'properties': {
+                    'transitions': {
+                        'from_damage_state': [],
+                        'to_damage_state': [],
+                        'n_buildings': [],
+                    },
+                },
+            },
+            {
+                'type': 'Feature',
+                'geometry': None,
+                'properties': {
+                    'transitions': {
+                        'from_damage_state': [],
+                        'to_damage_state': [],
+                        'n_buildings': [],
+                    },
+                },
+            },
+        ],
+    }
+    second = gfzwpsformatconversions.Transitions.from_string(
+        json.dumps(geojson)
+    )
+    assert second.get_damage_states() == damage_states
+    assert len(second.to_dataframe()) == 2
+
+    composed = first.compose(second, state_counts)
+    assert np.allclose(
+        composed.apply(state_counts),
+        second.apply(first.apply(state_counts))
+    )
+    composed_dataframe = composed.to_dataframe().set_index(
+        ['feature', 'from_damage_state', 'to_damage_state']
+    )['n_buildings']
+    # 17 of the 85 buildings in D0 go to D1,
+    # 5 of the 10 buildings in D1 go to D2
+    assert abs(composed_dataframe[(0, 'D0', 'D1')] - 17.0 - 5.0) < 1e-9
+    assert abs(composed_dataframe[(0, 'D0', 'D2')] - 5.0 - 5.0) < 1e-9
+    assert abs(composed_dataframe[(2, 'D1', 'D2')] - 2.0) < 1e-9
+
+
+def _create_stub_processes(duration):
+    '''
+    Creates stub processes for assetmaster, modelprop
+    and quakeledger that just echo some of their inputs.
+    '''
+    def assetmaster(inputs):
+        return {'selectedRowsGeoJson': json.dumps({
+            'schema': inputs['schema'],
+            'lonmin': inputs['lonmin'],
+        })}
+
+    def modelprop(inputs):
+        return {'selectedRows': json.dumps({'schema': inputs['schema']})}
+
+    def quakeledger(inputs):
+        return {'selectedRows': json.dumps({
+            'bbox': inputs['input-boundingbox'],
+        })}
+
+    def failing(inputs):
+        raise Exception('Something went wrong for ' + inputs['value'])
+
+    return {
+        'assetmaster': gfzwpspipeline.StubProcess(assetmaster, duration),
+        'modelprop': gfzwpspipeline.StubProcess(modelprop, duration),
+        'quakeledger': gfzwpspipeline.StubProcess(quakeledger, duration),
+        'failing': gfzwpspipeline.StubProcess(failing, duration),
+    }
+
+
+def test_wps_client_executes_concurrently():
+    '''
+    Tests that the independent processes run
+    concurrently on the (stub) wps server.
+    '''
+    duration = 0.5
+    execute_requests = [
+        gfzwpspipeline.WpsExecuteRequest(
+            'assetmaster',
+            [('lonmin', '-71.8'), ('schema', 'SARA_v1.0')],
+            [('selectedRowsGeoJson', True)]
+        ),
+        gfzwpspipeline.WpsExecuteRequest(
+            'modelprop',
+            [('schema', 'SARA_v1.0')],
+            [('selectedRows', True)]
+        ),
+        gfzwpspipeline.WpsExecuteRequest(
+            'quakeledger',
+            [(
+                'input-boundingbox',
+                gfzwpspipeline.BoundingBoxDataInput([-70, -72, -10, -68])
+            )],
+            [('selectedRows', True)]
+        ),
+    ]
+
+    async def run(client):
+        executions = await client.execute_all(execute_requests)
+        return await client.fetch_all([
+            execution.get_output_reference(output_identifier)
+            for execution, output_identifier in zip(
+                executions,
+                ['selectedRowsGeoJson', 'selectedRows', 'selectedRows']
+            )
+        ])
+
+    with gfzwpspipeline.StubWpsServer(
+            _create_stub_processes(duration)) as server:
+        with gfzwpspipeline.WpsClient(
+                server.get_url(), poll_interval=0.05) as client:
+            start = time.monotonic()
+            contents = asyncio.run(run(client))
+            wall_time = time.monotonic() - start
+
+    assert wall_time < 2 * duration
+    assert json.loads(contents[0]) == {
+        'schema': 'SARA_v1.0',
+        'lonmin': '-71.8',
+    }
+    assert json.loads(contents[1]) == {'schema': 'SARA_v1.0'}
+    assert json.loads(contents[2]) == {'bbox': [-70.0, -72.0, -10.0, -68.0]}
+    assert server.request_counts['execute'] == 3
+    assert server.request_counts['output'] == 3
+
+
+def test_wps_client_complex_input_and_failure():
+    '''
+    Tests complex xml inputs and the handling
+    of failed processes.
+    '''
+    def echo(inputs):
+        return {'output': inputs['quakeMLFile']}
+
+    processes = _create_stub_processes(0.0)
+    processes['echo'] = gfzwpspipeline.StubProcess(echo)
+    quakeml = b'<eventParameters xmlns="http://quakeml.org/xmlns/bed/1.2"/>'
+
+    async def run(client):
+        execution = await client.execute(
+            'echo',
+            [('quakeMLFile', gfzwpspipeline.ComplexDataInput(quakeml))],
+            [('output', True)]
+        )
+        content = await client.fetch(execution.get_output_reference('output'))
+        try:
+            await client.execute(
+                'failing',
+                [('value', 'x')],
+                [('output', True)]
+            )
+            message = None
+        except Exception as exception:  # pylint: disable=broad-except
+            message = str(exception)
+        return content, message
+
+    with gfzwpspipeline.StubWpsServer(processes) as server:
+        with gfzwpspipeline.WpsClient(
+                server.get_url(), poll_interval=0.01) as client:
+            content, message = asyncio.run(run(client))
+
+    assert le.fromstring(content).tag == \
+        '{http://quakeml.org/xmlns/bed/1.2}eventParameters'
+    assert 'Something went wrong for x' in message
+
+
+def test_output_cache():
+    '''
+    Tests that cached outputs are served
+    without contacting the server.
+    '''
+    inputs = [('schema', 'SARA_v1.0'), ('lonmin', '-71.8')]
+
+    key = gfzwpspipeline.OutputCache.create_key(
+        'assetmaster',
+        inputs,
+        [('selectedRowsGeoJson', True)]
+    )
+    assert key == gfzwpspipeline.OutputCache.create_key(
+        'assetmaster',
+        list(reversed(inputs)),
+        [('selectedRowsGeoJson', True)]
+    )
+    assert key != gfzwpspipeline.OutputCache.create_key(
+        'assetmaster',
+        [('schema', 'SARA_v1.0'), ('lonmin', '-71.9')],
+        [('selectedRowsGeoJson', True)]
+    )
+    assert gfzwpspipeline.OutputCache.create_key(
+        'shakyground',
+        [('quakeMLFile', gfzwpspipeline.ComplexDataInput('<a/>'))],
+        [('shakeMapFile', True)]
+    ) != gfzwpspipeline.OutputCache.create_key(
+        'shakyground',
+        [('quakeMLFile', gfzwpspipeline.ComplexDataInput('<b/>'))],
+        [('shakeMapFile', True)]
+    )
+
+    async def run(client):
+        first = await client.execute_and_fetch(
+            'assetmaster',
+            inputs,
+            [('selectedRowsGeoJson', True)]
+        )
+        second = await client.execute_and_fetch(
+            'assetmaster',
+            list(reversed(inputs)),
+            [('selectedRowsGeoJson', True)]
+        )
+        return first, second
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = gfzwpspipeline.OutputCache(directory)
+        with gfzwpspipeline.StubWpsServer(
+                _create_stub_processes(0.0)) as server:
+            with gfzwpspipeline.WpsClient(
+                    server.get_url(),
+                    poll_interval=0.01,
+                    cache=cache) as client:
+                first, second = asyncio.run(run(client))
+
+        assert first == second
+        assert json.loads(first['selectedRowsGeoJson'])['lonmin'] == '-71.8'
+        assert server.request_counts['execute'] == 1
+        assert server.request_counts['output'] == 1
+        assert cache.hits == 1
+        assert cache.misses == 1
+
+
+def test_output_cache_eviction():
+    '''
+    Tests the lru eviction of the output cache.
+    '''
+    random = np.random.default_rng(42)
+    with tempfile.TemporaryDirectory() as directory:
+        cache = gfzwpspipeline.OutputCache(directory, max_bytes=25000)
+        # random bytes can't be compressed
+        values = [random.bytes(10000) for _ in range(3)]
+        cache.put('a', {'output': values[0]})
+        cache.put('b', {'output': values[1]})
+        os.utime(os.path.join(directory, 'a.gz'), (1, 1))
+        os.utime(os.path.join(directory, 'b.gz'), (2, 2))
+        # a is used again, so b is the least recently used one
+        assert cache.get('a') == {'output': values[0]}
+        cache.put('c', {'output': values[2]})
+
+        assert cache.get('b') is None
+        assert cache.get('a') == {'output': values[0]}
+        assert cache.get('c') == {'output': values[2]}
+        assert cache.get_size() <= 25000
+
+        cache.clear()
+        assert cache.get('a') is None
+
+
+def test_output_cache_corrupt_files():
+    '''
+    Tests that truncated or corrupt cache files
+    are removed and count as misses.
+    '''
+    random = np.random.default_rng(42)
+    with tempfile.TemporaryDirectory() as directory:
+        cache = gfzwpspipeline.OutputCache(directory)
+        value = random.bytes(10000)
+        path = os.path.join(directory, 'a.gz')
+        for corrupt in (
+                lambda content: content[:len(content) // 2],
+                lambda content: content[:-8],
+                lambda content: b'not gzip',
+                lambda content: gzip.compress(
+                    b'[["output", 20000]]\n' + value
+                ),
+                lambda content: gzip.compress(b'no json\n')):
+            cache.put('a', {'output': value})
+            assert cache.get('a') == {'output': value}
+            with open(path, 'rb') as cache_file:
+                content = cache_file.read()
+            with open(path, 'wb') as cache_file:
+                cache_file.write(corrupt(content))
+            assert cache.get('a') is None
+            assert not os.path.exists(path)
+        assert cache.hits == 5
+        assert cache.misses == 5
+
+
+def test_wps_output_views():
+    '''
+    Tests that the output is downloaded once
+    and given unchanged to the next process.
+    '''
+    shakemap_content = _read_testinput('shakemap.xml')
+    received = {}
+
+    def shakyground(inputs):
+        return {'shakeMapFile': shakemap_content}
+
+    def deus(inputs):
+        received['intensity'] = inputs['intensity']
+        return {'damage': json.dumps({'type': 'FeatureCollection',
+                                      'features': []})}
+
+    processes = {
+        'shakyground': gfzwpspipeline.StubProcess(shakyground),
+        'deus': gfzwpspipeline.StubProcess(deus),
+    }
+
+    async def run(client):
+        execution = await client.execute(
+            'shakyground',
+            [],
+            [('shakeMapFile', True)]
+        )
+        output = await client.fetch_output(
+            execution.get_output_reference('shakeMapFile')
+        )
+        await client.execute(
+            'deus',
+            [('intensity', output.to_complex_input())],
+            [('damage', True)]
+        )
+        return output
+
+    with gfzwpspipeline.StubWpsServer(processes) as server:
+        with gfzwpspipeline.WpsClient(
+                server.get_url(),
+                poll_interval=0.01) as client:
+            output = asyncio.run(run(client))
+
+    assert server.request_counts['output'] == 1
+    assert output.content == shakemap_content
+    assert output.mime_type == 'application/octet-stream'
+    assert output.text.startswith('<?xml')
+    assert output.xml is output.xml
+    assert output.shakemap is output.shakemap
+    assert output.shakemap.get_grid_specification()['nlon'] > 0
+
+    # the shakemap is inserted in the execute request as it is
+    execute_request = gfzwpspipeline.WpsExecuteRequest(
+        'deus',
+        [('intensity', output.to_complex_input())],
+        [('damage', True)]
+    )
+    assert execute_request.to_xml_string().find(
+        shakemap_content[shakemap_content.find(b'?>') + 2:]
+    ) > 0
+    received_xml = le.fromstring(received['intensity'])
+    grid_data = '{http://earthquake.usgs.gov/eqcenter/shakemap}grid_data'
+    assert received_xml.tag == output.xml.tag
+    assert received_xml.findtext(grid_data) == output.xml.findtext(grid_data)
+
+    exposure = gfzwpspipeline.WpsOutput(
+        _read_testinput('exposure_sara.json'),
+        mime_type='application/json'
+    )
+    assert exposure.json() is exposure.json()
+    assert len(exposure.geodataframe) == len(exposure.json()['features'])
+    assert exposure.geodataframe.crs is not None
+
+
+def test_quakeml_from_stream():
+    '''
+    Tests the parsing of the quakeml
+    while the data is downloaded.
+    '''
+    events = gfzwpsformatconversions.generate_event_dataframe(5)
+    content = gfzwpsformatconversions.QuakeMLDataframe.from_dataframe(
+        events
+    ).to_xml_string().encode('utf-8')
+    expected = gfzwpsformatconversions.QuakeML.from_string(
+        content
+    ).to_dataframe()
+
+    chunks = [content[i:i + 100] for i in range(0, len(content), 100)]
+    quakeml = gfzwpsformatconversions.QuakeML.from_stream(iter(chunks))
+    pd.testing.assert_frame_equal(quakeml.to_dataframe(), expected)
+
+    quakeml = gfzwpsformatconversions.QuakeML.from_stream(
+        io.BytesIO(content),
+        chunk_size=1000
+    )
+    pd.testing.assert_frame_equal(quakeml.to_dataframe(), expected)
+
+    xml = gfzwpsformatconversions.parse_xml_stream(iter(chunks))
+    assert le.QName(xml).localname == 'eventParameters'
+
+
+def test_shakemap_from_stream():
+    '''
+    Tests the parsing of the shakemap
+    while the data is downloaded.
+    '''
+    content = _read_testinput('shakemap.xml')
+    expected = gfzwpsformatconversions.Shakemap.from_xml(
+        le.fromstring(content)
+    ).to_grid_array()
+
+    chunks = (content[i:i + 4096] for i in range(0, len(content), 4096))
+    shakemap = gfzwpsformatconversions.Shakemap.from_stream(chunks)
+    assert np.array_equal(shakemap.to_grid_array(), expected)
+
+    path = os.path.join(
+        os.path.dirname(__file__),
+        'testinputs',
+        'shakemap.xml'
+    )
+    with open(path, 'rb') as infile:
+        shakemap = gfzwpsformatconversions.Shakemap.from_stream(
+            infile,
+            chunk_size=1000
+        )
+    assert np.array_equal(shakemap.to_grid_array(), expected)
+
+    processes = {
+        'shakyground': gfzwpspipeline.StubProcess(
+            lambda inputs: {'shakeMapFile': content}
+        ),
+    }
+
+    async def run(client):
+        execution = await client.execute(
+            'shakyground',
+            [],
+            [('shakeMapFile', True)]
+        )
+        return await client.fetch_stream(
+            execution.get_output_reference('shakeMapFile'),
+            gfzwpsformatconversions.Shakemap.from_stream
+        )
+
+    with gfzwpspipeline.StubWpsServer(processes) as server:
+        with gfzwpspipeline.WpsClient(
+                server.get_url(),
+                poll_interval=0.01) as client:
+            shakemap = asyncio.run(run(client))
+    assert np.array_equal(shakemap.to_grid_array(), expected)
+
+
+def test_pipeline():
+    '''
+    Tests the concurrent execution of the pipeline
+    and that only the nodes with changed inputs run again.
+    '''
+    duration = 0.5
+    pipeline = gfzwpspipeline.Pipeline()
+    assetmaster = pipeline.add('assetmaster', gfzwpspipeline.ProcessNode(
+        'assetmaster',
+        [
+            ('lonmin', gfzwpspipeline.Parameter('lonmin')),
+            ('schema', gfzwpspipeline.Parameter('schema')),
+        ],
+        ['selectedRowsGeoJson']
+    ))
+    modelprop = pipeline.add('modelprop', gfzwpspipeline.ProcessNode(
+        'modelprop',
+        [('schema', gfzwpspipeline.Parameter('schema'))],
+        ['selectedRows']
+    ))
+
+    def combine(exposure, fragility):
+        return {
+            'lonmin': exposure.json()['lonmin'],
+            'schema': fragility.json()['schema'],
+        }
+
+    combined = pipeline.add('combine', gfzwpspipeline.FunctionNode(
+        combine,
+        {
+            'exposure': gfzwpspipeline.NodeOutput(
+                assetmaster.node,
+                'selectedRowsGeoJson'
+            ),
+            'fragility': gfzwpspipeline.NodeOutput(
+                modelprop.node,
+                'selectedRows'
+            ),
+        }
+    ))
+    pipeline.add('lonmin', gfzwpspipeline.FunctionNode(
+        lambda combined: combined['lonmin'],
+        {'combined': combined}
+    ))
+
+    with gfzwpspipeline.StubWpsServer(
+            _create_stub_processes(duration)) as server:
+        with gfzwpspipeline.WpsClient(
+                server.get_url(),
+                poll_interval=0.01) as client:
+            parameters = {'lonmin': '-71.8', 'schema': 'SARA_v1.0'}
+            start = time.time()
+            results = asyncio.run(pipeline.run(client, parameters))
+            elapsed = time.time() - start
+
+            assert results['combine'] == {
+                'lonmin': '-71.8',
+                'schema': 'SARA_v1.0',
+            }
+            assert results['lonmin'] == '-71.8'
+            # assetmaster and modelprop run at the same time
+            assert elapsed < 2 * duration
+            assert server.request_counts['execute'] == 2
+
+            # nothing changed, so nothing runs again
+            asyncio.run(pipeline.run(client, parameters))
+            assert server.request_counts['execute'] == 2
+            assert pipeline.run_counts['combine'] == 1
+
+            parameters['lonmin'] = '-71.5'
+            results = asyncio.run(pipeline.run(client, parameters))
+            assert results['lonmin'] == '-71.5'
+            assert server.request_counts['execute'] == 3
+            assert pipeline.run_counts['assetmaster'] == 2
+            assert pipeline.run_counts['modelprop'] == 1
+            assert pipeline.run_counts['lonmin'] == 2
+
+            results = asyncio.run(pipeline.run(
+                client,
+                parameters,
+                targets=['modelprop']
+            ))
+            assert list(results.keys()) == ['modelprop']
+
+    pipeline.add('cycle', gfzwpspipeline.FunctionNode(
+        lambda value: value,
+        {'value': gfzwpspipeline.NodeOutput('cycle')}
+    ))
+    try:
+        asyncio.run(pipeline.run(targets=['cycle']))
+        message = None
+    except Exception as exception:  # pylint: disable=broad-except
+        message = str(exception)
+    assert message.startswith('Cycle')
+
+
+def test_pipeline_input_hashes():
+    '''
+    Tests that the memoization of the pipeline
+    uses the content of dataframes, arrays and xml.
+    '''
+    pipeline = gfzwpspipeline.Pipeline()
+    pipeline.add('total', gfzwpspipeline.FunctionNode(
+        lambda data: float(np.sum(np.asarray(data, dtype=np.float64))),
+        {'data': gfzwpspipeline.Parameter('data')}
+    ))
+    pipeline.add('tag', gfzwpspipeline.FunctionNode(
+        lambda xml: le.QName(xml.to_xml()).localname,
+        {'xml': gfzwpspipeline.Parameter('xml')}
+    ))
+    pipeline.add('length', gfzwpspipeline.FunctionNode(
+        lambda values: len(values),  # pylint: disable=unnecessary-lambda
+        {'values': gfzwpspipeline.Parameter('other')}
+    ))
+
+    dataframe = pd.DataFrame({'value': np.arange(1000, dtype=np.float64)})
+    shakemap = gfzwpsformatconversions.Shakemap.from_xml(
+        le.fromstring(_read_testinput('shakemap.xml'))
+    )
+    parameters = {'data': dataframe, 'xml': shakemap, 'other': {1, 2}}
+    asyncio.run(pipeline.run(parameters=parameters))
+
+    # an equal copy and an equal, but newly parsed shakemap are memoized
+    parameters['data'] = dataframe.copy()
+    parameters['xml'] = gfzwpsformatconversions.Shakemap.from_xml(
+        le.fromstring(_read_testinput('shakemap.xml'))
+    )
+    results = asyncio.run(pipeline.run(parameters=parameters))
+    assert pipeline.run_counts['total'] == 1
+    assert pipeline.run_counts['tag'] == 1
+    assert results['tag'] == 'shakemap_grid'
+    # a set has no content hash, so the node runs every time
+    assert pipeline.run_counts['length'] == 2
+
+    # a change in the middle rows (hidden in the repr)
+    changed = dataframe.copy()
+    changed.loc[500, 'value'] = -1.0
+    assert repr(changed) == repr(dataframe)
+    parameters['data'] = changed
+    results = asyncio.run(pipeline.run(parameters=parameters))
+    assert pipeline.run_counts['total'] == 2
+    assert results['total'] == dataframe['value'].sum() - 501
+
+    parameters['data'] = changed['value'].to_numpy()
+    asyncio.run(pipeline.run(parameters=parameters))
+    assert pipeline.run_counts['total'] == 3
+    parameters['data'] = changed['value'].to_numpy().copy()
+    asyncio.run(pipeline.run(parameters=parameters))
+    assert pipeline.run_counts['total'] == 3
+    parameters['data'] = changed.rename(columns={'value': 'other'})
+    asyncio.run(pipeline.run(parameters=parameters))
+    assert pipeline.run_counts['total'] == 4
+
+
+def test_batch_runner():
+    '''
+    Tests the limited concurrency, the retries
+    and the streaming of the results of the batch runner.
+    '''
+    state = {'running': 0, 'max_running': 0, 'taken': 0, 'attempts': 0}
+
+    def items():
+        for i in range(10):
+            state['taken'] += 1
+            yield i
+
+    async def task(client, item):
+        state['running'] += 1
+        state['max_running'] = max(state['max_running'], state['running'])
+        await asyncio.sleep(0.01)
+        state['running'] -= 1
+        if item == 3:
+            state['attempts'] += 1
+            raise Exception('no data for 3')
+        return item * 2
+
+    results = []
+
+    def consumer(item, result):
+        # only the running tasks have been taken from the items
+        assert state['taken'] - len(results) <= 3 + 1
+        results.append(result)
+
+    runner = gfzwpspipeline.BatchRunner(
+        None,
+        max_concurrency=3,
+        max_retries=2,
+        backoff=0.001,
+        seed=42
+    )
+    summary = asyncio.run(runner.run(items(), task, consumer))
+    assert state['max_running'] == 3
+    assert sorted(results) == [0, 2, 4, 8, 10, 12, 14, 16, 18]
+    assert summary.n_succeeded == 9
+    assert summary.failures == [(3, 'no data for 3')]
+    assert state['attempts'] == 3
+    assert summary.n_retries == 2
+
+    content = _read_testinput('shakemap.xml')
+    received = []
+
+    def shakyground(inputs):
+        quakeml = gfzwpsformatconversions.QuakeML.from_string(
+            inputs['quakeMLFile']
+        ).to_dataframe()
+        received.append(quakeml['eventID'].iloc[0])
+        if len(received) == 1:
+            raise Exception('Temporary failure')
+        return {'shakeMapFile': content}
+
+    events = gfzwpsformatconversions.generate_event_dataframe(4)
+    stack = gfzwpsformatconversions.ShakemapStack('PGA')
+    with gfzwpspipeline.StubWpsServer(
+            {'shakyground': gfzwpspipeline.StubProcess(shakyground)}
+    ) as server:
+        with gfzwpspipeline.WpsClient(
+                server.get_url(),
+                poll_interval=0.01) as client:
+            runner = gfzwpspipeline.BatchRunner(
+                client,
+                max_concurrency=2,
+                backoff=0.001,
+                seed=42
+            )
+            summary = asyncio.run(runner.run_shakyground(events, stack.add))
+
+    assert summary.n_succeeded == 4
+    assert summary.n_retries == 1
+    assert not summary.failures
+    assert len(received) == 5
+    assert sorted(stack.get_event_ids()) == sorted(events['eventID'])
+
+    shakemap = gfzwpsformatconversions.Shakemap.from_xml(
+        le.fromstring(content)
+    )
+    spec = shakemap.get_grid_specification()
+    array = stack.to_array()
+    assert array.shape == (4, spec['nlat'], spec['nlon'])
+    assert array.dtype == np.float32
+    assert np.allclose(
+        stack.to_maximum(),
+        shakemap.to_dense_grid('PGA'),
+        equal_nan=True
+    )
+
+
+def test_batch_damage():
+    '''
+    Tests the damage computation for many events
+    with the batch runner.
+    '''
+    def create_shakemap(event_id):
+        return _create_grid_shakemap(
+            0.1 * (int(event_id.rsplit('_', 1)[1]) + 1),
+            event_id
+        )
+
+    def shakyground(inputs):
+        event_id = gfzwpsformatconversions.QuakeML.from_string(
+            inputs['quakeMLFile']
+        ).to_dataframe()['eventID'].iloc[0]
+        return {'shakeMapFile': create_shakemap(event_id)}
+
+    exposure = gfzwpsformatconversions.Exposure.from_string(
+        _read_testinput('exposure_sara.json')
+    )
+    fragility = gfzwpsformatconversions.Fragility.from_string(
+        _read_testinput('fragility_sara.json')
+    )
+    engine = gfzwpsformatconversions.DamageEngine(exposure, fragility)
+    events = gfzwpsformatconversions.generate_event_dataframe(3)
+    table = gfzwpsformatconversions.LossTable()
+    with gfzwpspipeline.StubWpsServer(
+            {'shakyground': gfzwpspipeline.StubProcess(shakyground)}
+    ) as server:
+        with gfzwpspipeline.WpsClient(
+                server.get_url(),
+                poll_interval=0.01) as client:
+            runner = gfzwpspipeline.BatchRunner(client, max_concurrency=2)
+            summary = asyncio.run(
+                runner.run_damage(events, engine, table.add)
+            )
+
+    assert summary.n_succeeded == 3
+    assert not summary.failures
+    assert table.get_loss_unit() == 'USD'
+    losses = table.to_dataframe().loc[events['eventID']]
+    assert losses.shape == (3, 3)
+    for event_id, row in losses.iterrows():
+        expected = engine.compute(
+            gfzwpsformatconversions.Shakemap.from_xml(
+                le.fromstring(create_shakemap(event_id))
+            )
+        ).to_loss_array()
+        assert np.allclose(row.to_numpy(), expected)
+    total_losses = table.to_total_losses().loc[events['eventID']]
+    assert total_losses.is_monotonic_increasing
+    assert total_losses.iloc[0] > 0
+
+
+def test_status_poller():
+    '''
+    Tests that the poll intervals grow for long
+    running executions and that all executions
+    are finished as soon as possible.
+    '''
+    duration = 0.6
+    execute_requests = [
+        gfzwpspipeline.WpsExecuteRequest(
+            'modelprop',
+            [('schema', 'SARA_v{}'.format(i))],
+            [('selectedRows', True)]
+        )
+        for i in range(6)
+    ]
+
+    with gfzwpspipeline.StubWpsServer(
+            _create_stub_processes(duration)) as server:
+        with gfzwpspipeline.WpsClient(
+                server.get_url(),
+                poll_interval=0.02,
+                max_poll_interval=0.1) as client:
+            start = time.time()
+            executions = asyncio.run(client.execute_all(execute_requests))
+            elapsed = time.time() - start
+            poll_counts = client.get_poll_counts()
+
+    assert all(execution.is_succeeded() for execution in executions)
+    assert elapsed < duration + 0.4
+    assert len(poll_counts) == 6
+    # a fixed interval of 0.02 seconds would need 30 polls per execution
+    assert all(2 <= count <= 12 for count in poll_counts.values())
+    assert sum(poll_counts.values()) == server.request_counts['status']
+
+
+def test_status_poller_watch_twice():
+    '''
+    Tests that an execution can be watched twice
+    and that a failing status request doesn't stop
+    the polling of the other executions.
+    '''
+    async def run(client):
+        execution = await client.submit(
+            'modelprop',
+            [('schema', 'SARA_v1.0')],
+            [('selectedRows', True)]
+        )
+        missing = copy.copy(execution)
+        missing.status_location = execution.status_location + '-missing'
+        poller = client.get_poller()
+        first = poller.watch(execution)
+        second = poller.watch(execution)
+        assert first is second
+        assert poller.get_running_count() == 1
+        failed = poller.watch(missing)
+        return await asyncio.gather(
+            first,
+            second,
+            failed,
+            return_exceptions=True
+        )
+
+    with gfzwpspipeline.StubWpsServer(
+            _create_stub_processes(0.2)) as server:
+        with gfzwpspipeline.WpsClient(
+                server.get_url(),
+                poll_interval=0.02) as client:
+            first, second, failed = asyncio.run(
+                asyncio.wait_for(run(client), 5)
+            )
+
+    assert first is second
+    assert first.is_succeeded()
+    assert isinstance(failed, Exception)
+
+
+def test_compression():
+    '''
+    Tests the reading and writing of gzip (and zstd)
+    compressed data and the compressed transport.
+    '''
+    content = _read_testinput('shakemap.xml')
+    shakemap = gfzwpsformatconversions.Shakemap.from_xml(
+        le.fromstring(content)
+    )
+    expected = shakemap.to_grid_array()
+
+    output = io.BytesIO()
+    shakemap.write(output, compression='gzip')
+    compressed = output.getvalue()
+    assert compressed[:2] == gfzwpsformatconversions.GZIP_MAGIC
+    assert len(compressed) < len(content) / 2
+    chunks = [compressed[i:i + 2] for i in range(0, 100, 2)] + [
+        compressed[100:]
+    ]
+    assert np.array_equal(
+        gfzwpsformatconversions.Shakemap.from_stream(chunks).to_grid_array(),
+        expected
+    )
+
+    exposure = gfzwpsformatconversions.Exposure.from_string(
+        _read_testinput('exposure_sara.json')
+    )
+    events = gfzwpsformatconversions.generate_event_dataframe(3)
+    with tempfile.TemporaryDirectory() as directory:
+        exposure_path = os.path.join(directory, 'exposure.json.gz')
+        exposure.write(exposure_path)
+        with open(exposure_path, 'rb') as infile:
+            assert infile.read(2) == gfzwpsformatconversions.GZIP_MAGIC
+            infile.seek(0)
+            streamed = gfzwpsformatconversions.Exposure.from_stream(infile)
+        pd.testing.assert_frame_equal(
+            streamed.to_expo_dataframe(),
+            exposure.to_expo_dataframe()
+        )
+
+        quakeml_path = os.path.join(directory, 'events.xml.gz')
+        gfzwpsformatconversions.QuakeMLDataframe.from_dataframe(
+            events
+        ).write(quakeml_path)
+        with open(quakeml_path, 'rb') as infile:
+            quakeml = gfzwpsformatconversions.QuakeML.from_string(
+                infile.read()
+            )
+        assert quakeml.to_dataframe()['eventID'].tolist() == events[
+            'eventID'
+        ].tolist()
+
+    if gfzwpsformatconversions.zstandard is None:
+        try:
+            shakemap.write(io.BytesIO(), compression='zstd')
+            message = None
+        except Exception as exception:  # pylint: disable=broad-except
+            message = str(exception)
+        assert 'zstandard' in message
+    else:
+        output = io.BytesIO()
+        shakemap.write(output, compression='zstd')
+        assert output.getvalue()[:4] == gfzwpsformatconversions.ZSTD_MAGIC
+        output.seek(0)
+        assert np.array_equal(
+            gfzwpsformatconversions.Shakemap.from_stream(
+                output
+            ).to_grid_array(),
+            expected
+        )
+
+    processes = {
+        'shakyground': gfzwpspipeline.StubProcess(
+            lambda inputs: {'shakeMapFile': content}
+        ),
+    }
+
+    async def run(client):
+        execution = await client.execute(
+            'shakyground',
+            [('quakeMLFile', gfzwpspipeline.ComplexDataInput(
+                gfzwpsformatconversions.QuakeMLDataframe.from_dataframe(
+                    events
+                ).to_xml_string()
+            ))],
+            [('shakeMapFile', True)]
+        )
+        reference = execution.get_output_reference('shakeMapFile')
+        return reference, await client.fetch(reference)
+
+    with gfzwpspipeline.StubWpsServer(processes) as server:
+        with gfzwpspipeline.WpsClient(
+                server.get_url(),
+                poll_interval=0.01,
+                compress_requests=True) as client:
+            reference, fetched = asyncio.run(run(client))
+        response = requests.get(reference)
+    assert server.request_counts['compressed'] == 1
+    assert fetched == content
+    assert response.headers['Content-Encoding'] == 'gzip'
+
+
+def test_synthetic_generators():
+    '''
+    Tests the generation of synthetic quakeml
+    and shakemap documents.
+    '''
+    chunks = list(gfzwpsformatconversions.generate_quakeml(
+        25,
+        seed=7,
+        events_per_chunk=10
+    ))
+    assert len(chunks) == 5
+    assert b''.join(chunks) == b''.join(
+        gfzwpsformatconversions.generate_quakeml(
+            25,
+            seed=7,
+            events_per_chunk=10
+        )
+    )
+    dataframe = gfzwpsformatconversions.QuakeML.from_stream(
+        chunks
+    ).to_dataframe()
+    assert len(dataframe) == 25
+    assert dataframe['eventID'].is_unique
+    assert dataframe['magnitude'].between(5.0, 9.5).all()
+    assert dataframe['depthUncertainty'].isna().all()
+
+    dataframe = gfzwpsformatconversions.QuakeML.from_stream(
+        gfzwpsformatconversions.generate_quakeml(
+            5,
+            seed=7,
+            with_uncertainties=True
+        )
+    ).to_dataframe()
+    assert dataframe['depthUncertainty'].notna().all()
+    assert dataframe['magnitudeUncertainty'].notna().all()
+
+    shakemap = gfzwpsformatconversions.Shakemap.from_stream(
+        gfzwpsformatconversions.generate_shakemap(
+            30,
+            40,
+            fields=('PGA', 'STDPGA', 'MI'),
+            seed=3,
+            rows_per_chunk=7
+        )
+    )
+    spec = shakemap.get_grid_specification()
+    assert (spec['nlat'], spec['nlon']) == (30, 40)
+    assert shakemap.to_grid_field_names() == [
+        'LON', 'LAT', 'PGA', 'STDPGA', 'MI'
+    ]
+    grid_array = shakemap.to_grid_array()
+    assert grid_array.shape == (1200, 5)
+    assert np.isclose(grid_array[0, 0], spec['lon_min'])
+    assert np.isclose(grid_array[0, 1], spec['lat_max'])
+    assert not np.isnan(shakemap.to_dense_grid('PGA')).any()
+    assert (grid_array[:, 4] >= 1.0).all()
+
+    reference = gfzwpsformatconversions.Shakemap.from_xml(
+        le.fromstring(_read_testinput('shakemap.xml'))
+    )
+    assert set(shakemap.to_intensity_dataframe().columns) >= set(
+        reference.to_intensity_dataframe().columns
+    )
+
+
+def test_instrumentation():
+    '''
+    Tests the measurement of the stages of the conversions.
+    '''
+    quakeml_chunks = list(
+        gfzwpsformatconversions.generate_quakeml(20, seed=1)
+    )
+    registry = gfzwpsformatconversions.CounterRegistry()
+    measurements = []
+    gfzwpsformatconversions.add_instrumentation_sink(
+        registry,
+        trace_memory=True
+    )
+    gfzwpsformatconversions.add_instrumentation_sink(measurements.append)
+    try:
+        quakeml = gfzwpsformatconversions.QuakeML.from_stream(quakeml_chunks)
+        dataframe = quakeml.to_dataframe()
+        gfzwpsformatconversions.QuakeMLDataframe.from_dataframe(
+            dataframe
+        ).to_xml_string()
+        shakemap = gfzwpsformatconversions.Shakemap.from_stream(
+            gfzwpsformatconversions.generate_shakemap(10, 12, seed=1)
+        )
+        shakemap.to_intensity_dataframe()
+        shakemap.to_grid_array()
+    finally:
+        gfzwpsformatconversions.remove_instrumentation_sink(registry)
+        gfzwpsformatconversions.remove_instrumentation_sink(
+            measurements.append
+        )
+
+    counters = registry.get_counters()
+    assert counters['QuakeML.to_dataframe']['count'] == 20
+    assert counters['QuakeMLDataframe.to_xml']['count'] == 20
+    assert counters['QuakeMLDataframe.serialize_xml']['calls'] == 1
+    assert counters['Shakemap.to_intensity_dataframe']['count'] == 120
+    assert counters['Shakemap.build_dataframe']['count'] == 120
+    # tokenized for the dataframe and for the grid array
+    assert counters['Shakemap.tokenize_grid']['calls'] == 2
+    assert counters['Shakemap.tokenize_grid']['count'] == 2 * 120 * 4
+    assert counters['Shakemap.parse_xml']['count'] > 0
+    assert all(counter['seconds'] >= 0 for counter in counters.values())
+    # the outer stage includes the memory of the inner ones
+    assert counters['Shakemap.to_intensity_dataframe'][
+        'peak_memory_bytes'
+    ] >= counters['Shakemap.build_dataframe']['peak_memory_bytes'] > 0
+    assert len(measurements) == sum(
+        counter['calls'] for counter in counters.values()
+    )
+    assert not tracemalloc.is_tracing()
+
+    text = registry.to_prometheus_text()
+    assert '# TYPE gfzwps_stage_seconds_total counter' in text
+    assert 'gfzwps_stage_values_total{stage="QuakeML.to_dataframe"} 20' in text
+
+    # without sinks nothing is measured
+    quakeml.to_dataframe()
+    assert registry.get_counters()['QuakeML.to_dataframe']['calls'] == 1
+
+
+def test_instrumentation_threads():
+    '''
+    Tests the memory tracing of stages in several threads
+    and that it ends with the last sink that asked for it.
+    '''
+    # pylint: disable=protected-access
+    measurements = []
+    memory_measurements = []
+    gfzwpsformatconversions.add_instrumentation_sink(measurements.append)
+    gfzwpsformatconversions.add_instrumentation_sink(
+        memory_measurements.append,
+        trace_memory=True
+    )
+    try:
+        first_entered = threading.Event()
+        second_entered = threading.Event()
+        first_exited = threading.Event()
+        arrays = []
+
+        def first():
+            with gfzwpsformatconversions._stage('first'):
+                first_entered.set()
+                second_entered.wait()
+            first_exited.set()
+
+        def second():
+            first_entered.wait()
+            with gfzwpsformatconversions._stage('second'):
+                second_entered.set()
+                first_exited.wait()
+                # the tracing goes on after the first stage ended
+                assert tracemalloc.is_tracing()
+                arrays.append(np.ones(1024 * 1024))
+
+        threads = [
+            threading.Thread(target=first),
+            threading.Thread(target=second),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(arrays) == 1
+        assert not tracemalloc.is_tracing()
+        peaks = {
+            measurement.stage: measurement.peak_memory_bytes
+            for measurement in measurements
+        }
+        assert peaks['second'] >= 8 * 1024 * 1024
+        assert peaks['first'] is not None
+
+        gfzwpsformatconversions.remove_instrumentation_sink(
+            memory_measurements.append
+        )
+        with gfzwpsformatconversions._stage('untraced'):
+            assert not tracemalloc.is_tracing()
+        assert measurements[-1].stage == 'untraced'
+        assert measurements[-1].peak_memory_bytes is None
+    finally:
+        gfzwpsformatconversions.remove_instrumentation_sink(
+            measurements.append
+        )
+        gfzwpsformatconversions.remove_instrumentation_sink(
+            memory_measurements.append
+        )
+
+
+def test_instrumentation_user_tracing():
+    '''
+    Tests that the stages keep the tracemalloc
+    session (and its peak) of the user.
+    '''
+    # pylint: disable=protected-access
+    measurements = []
+    tracemalloc.start()
+    try:
+        array = np.ones(1024 * 1024)
+        del array
+        user_peak = tracemalloc.get_traced_memory()[1]
+        assert user_peak >= 8 * 1024 * 1024
+
+        gfzwpsformatconversions.add_instrumentation_sink(
+            measurements.append,
+            trace_memory=True
+        )
+        try:
+            with gfzwpsformatconversions._stage('outer'):
+                with gfzwpsformatconversions._stage('inner'):
+                    pass
+        finally:
+            gfzwpsformatconversions.remove_instrumentation_sink(
+                measurements.append
+            )
+        assert tracemalloc.is_tracing()
+        assert tracemalloc.get_traced_memory()[1] >= user_peak
+        # the peaks are the ones since the last reset of the user
+        assert all(
+            measurement.peak_memory_bytes >= user_peak
+            for measurement in measurements
+        )
+    finally:
+        tracemalloc.stop()
+
+
+def test_compare_with_baseline():
+    '''
+    Tests the detection of regressions of the
+    benchmarks compared with a baseline.
+    '''
+    megabyte = 1024 * 1024
+
+    def entry(benchmark, seconds, peak_memory, peak_rss):
+        return {
+            'benchmark': benchmark,
+            'size': 100,
+            'unit': 'events',
+            'seconds': seconds,
+            'peak_memory_bytes': peak_memory,
+            'peak_rss_bytes': peak_rss,
+        }
+
+    baseline = {'results': [
+        entry('slower', 1.0, 10 * megabyte, 10 * megabyte),
+        entry('equal', 1.0, 10 * megabyte, 10 * megabyte),
+        entry('zero', 1.0, 0, 0),
+        entry('unmeasured', 1.0, 0, None),
+    ]}
+    results = [
+        entry('slower', 2.0, 10 * megabyte, 30 * megabyte),
+        entry('equal', 1.0, 10 * megabyte, 10 * megabyte),
+        entry('missing', 5.0, 100 * megabyte, 100 * megabyte),
+        entry('zero', 1.0, 0.5 * megabyte, 5 * megabyte),
+        entry('unmeasured', 1.0, 0, 50 * megabyte),
+    ]
+    regressions = benchmark_all.compare_with_baseline(results, baseline)
+    assert regressions == [
+        'slower (100 events): seconds 2.00x of the baseline',
+        'slower (100 events): peak_rss_bytes 3.00x of the baseline',
+        # small peaks are compared with 1 MB
+        'zero (100 events): peak_rss_bytes 5.00x of the baseline',
+    ]
+    assert benchmark_all.compare_with_baseline(
+        results,
+        baseline,
+        tolerance=5.0
+    ) == []
+    assert benchmark_all.compare_with_baseline(results, {'results': []}) == []
+
+    # the native memory of lxml is in the resident memory
+    if benchmark_all.resource is not None and hasattr(os, 'fork'):
+        # pylint: disable=protected-access
+        peak_rss = benchmark_all._measure_peak_rss(
+            lambda: np.ones(4 * megabyte)
+        )
+        assert peak_rss >= 16 * megabyte
+
+
+def test_import_time_budget():
+    '''
+    Tests that the xml and pandas conversions don't
+    import the geospatial libraries and that the
+    import of the module stays cheap.
+    '''
+    script = '''
+import sys
+import time
+start = time.perf_counter()
+import gfzwpsconvert
+import gfzwpsformatconversions
+import_seconds = time.perf_counter() - start
+dataframe = gfzwpsformatconversions.QuakeML.from_stream(
+    gfzwpsformatconversions.generate_quakeml(5, seed=1)
+).to_dataframe()
+gfzwpsformatconversions.QuakeMLDataframe.from_dataframe(
+    dataframe
+).to_xml_string()
+print(import_seconds)
+print(','.join(
+    name for name in ('geopandas', 'georasters', 'osgeo', 'shapely', 'scipy')
+    if name in sys.modules
+))
+'''
+    output = subprocess.run(
+        [sys.executable, '-c', script],
+        check=True,
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    ).stdout.splitlines()
+
+    # the budget is generous, as the test machines differ
+    # (the geospatial imports alone need more than a second)
+    assert float(output[0]) < 2.0
+    assert output[1] == ''
+
+    # the lazy modules load on the first attribute access
+    assert gfzwpsformatconversions.scipy.special.ndtr(0.0) == 0.5
+
+
+def test_convert_command():
+    '''
+    Tests the command line converter with the
+    skipping of the outputs that are up to date.
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        input_dir = os.path.join(directory, 'inputs')
+        output_dir = os.path.join(directory, 'outputs')
+        os.makedirs(input_dir)
+        for index in range(3):
+            with open(os.path.join(
+                    input_dir, 'events_{}.xml.gz'.format(index)
+            ), 'wb') as output_file:
+                output_file.write(gzip.compress(b''.join(
+                    gfzwpsformatconversions.generate_quakeml(4, seed=index)
+                )))
+        shakemap_path = os.path.join(input_dir, 'shakemap.xml')
+        with open(shakemap_path, 'wb') as output_file:
+            for chunk in gfzwpsformatconversions.generate_shakemap(5, 6):
+                output_file.write(chunk)
+
+        arguments = [input_dir, '--to', 'csv', '--output-dir', output_dir]
+        # the shakemap can't be converted to csv
+        assert gfzwpsconvert.main(arguments) == 1
+        assert sorted(os.listdir(output_dir)) == [
+            '.gfzwps-convert.json',
+            'events_0.csv',
+            'events_1.csv',
+            'events_2.csv',
+        ]
+        dataframe = pd.read_csv(os.path.join(output_dir, 'events_1.csv'))
+        assert len(dataframe) == 4
+
+        glob_pattern = os.path.join(input_dir, 'events_*.xml.gz')
+        mtime = os.path.getmtime(os.path.join(output_dir, 'events_1.csv'))
+        # a new modification time with the same content is still up to date
+        os.utime(os.path.join(input_dir, 'events_1.xml.gz'), (1, 1))
+        assert gfzwpsconvert.main([
+            glob_pattern, '--to', 'csv', '--output-dir', output_dir
+        ]) == 0
+        assert os.path.getmtime(
+            os.path.join(output_dir, 'events_1.csv')
+        ) == mtime
+
+        # and the dataframes back to quakeml with two workers
+        assert gfzwpsconvert.main([
+            os.path.join(output_dir, '*.csv'), '--to', 'xml', '--jobs', '2'
+        ]) == 0
+        quakeml = gfzwpsformatconversions.QuakeML.from_string(
+            open(os.path.join(output_dir, 'events_1.xml'), 'rb').read()
+        )
+        assert len(quakeml.to_dataframe()) == 4
+
+        assert gfzwpsconvert.main([
+            os.path.join(input_dir, 'shakemap.xml'), '--to', 'npy',
+            '--output-dir', output_dir
+        ]) == 0
+        grid = np.load(os.path.join(output_dir, 'shakemap.npy'))
+        assert grid.shape == (30, 4)
+
+        # sources with the same target are not converted
+        other_dir = os.path.join(directory, 'other')
+        os.makedirs(other_dir)
+        with open(
+                os.path.join(input_dir, 'events_0.xml'), 'wb'
+        ) as output_file:
+            output_file.write(b''.join(
+                gfzwpsformatconversions.generate_quakeml(2, seed=9)
+            ))
+        with open(
+                os.path.join(other_dir, 'events_1.xml'), 'wb'
+        ) as output_file:
+            output_file.write(b''.join(
+                gfzwpsformatconversions.generate_quakeml(2, seed=10)
+            ))
+        conflict_dir = os.path.join(directory, 'conflicts')
+        conflicts = gfzwpsconvert.find_target_conflicts(
+            gfzwpsconvert.find_input_files([input_dir, other_dir]),
+            'csv',
+            conflict_dir
+        )
+        assert sorted(
+            os.path.basename(target) for target in conflicts
+        ) == ['events_0.csv', 'events_1.csv']
+        assert all(len(sources) == 2 for sources in conflicts.values())
+        assert gfzwpsconvert.main([
+            os.path.join(input_dir, 'events_*'),
+            os.path.join(other_dir, 'events_*'),
+            '--to', 'csv', '--output-dir', conflict_dir
+        ]) == 1
+        assert sorted(os.listdir(conflict_dir)) == [
+            '.gfzwps-convert.json',
+            'events_2.csv',
+        ]
+
+
+def test_hazard_stack():
+    '''
+    Tests the resampling of an earthquake shakemap
+    and a tsunami map onto a common grid.
+    '''
+    shakemap = gfzwpsformatconversions.Shakemap.from_stream(
+        gfzwpsformatconversions.generate_shakemap(
+            60, 60, lon_min=-71.8, lat_max=-32.9, spacing=0.01
+        )
+    )
+    # the tsunami map has a finer grid, an other extent
+    # and lower case coordinate fields
+    tsunami_xml = b''.join(gfzwpsformatconversions.generate_shakemap(
+        50, 40, fields=('MWH',), lon_min=-71.75, lat_max=-32.95,
+        spacing=0.005, seed=1
+    )).replace(b'name="LON"', b'name="lon"').replace(
+        b'name="LAT"', b'name="lat"'
+    )
+    tsunami_map = gfzwpsformatconversions.Shakemap.from_stream([tsunami_xml])
+    assert tsunami_map.get_intensity_field_names() == ['MWH']
+    assert tsunami_map.get_field_units()['MWH'] == 'm'
+
+    stack = gfzwpsformatconversions.HazardStack(dtype=np.float64)
+    stack.add('earthquake', shakemap, ['PGA'])
+    stack.add('tsunami', tsunami_map)
+    assert stack.get_hazards() == ['earthquake', 'tsunami']
+    assert stack.to_grid_field_names() == ['PGA', 'MWH']
+    assert stack.get_hazard('MWH') == 'tsunami'
+    assert stack.to_array().shape == (2, 60, 60)
+
+    try:
+        stack.add('aftershock', shakemap, ['PGA'])
+        assert False
+    except Exception as exception:  # pylint: disable=broad-except
+        message = str(exception)
+        assert message == (
+            'The field PGA is already in the stack for earthquake'
+        )
+
+    lons = np.array([-71.62, -71.6, -71.3, -75.0])
+    lats = np.array([-33.05, -33.0, -33.4, -33.0])
+    dataframe = stack.to_values_dataframe_at(lons, lats)
+    assert list(dataframe.columns) == ['PGA', 'MWH']
+    assert np.allclose(
+        dataframe['PGA'],
+        shakemap.to_values_at(lons, lats, 'PGA'),
+        equal_nan=True
+    )
+    # the tsunami values are taken at the centers of the common grid
+    cell_lons = -71.8 + np.rint((lons[:2] + 71.8) / 0.01) * 0.01
+    cell_lats = -32.9 - np.rint((-32.9 - lats[:2]) / 0.01) * 0.01
+    assert np.allclose(
+        dataframe['MWH'][:2],
+        tsunami_map.to_values_at(cell_lons, cell_lats, 'MWH')
+    )
+    # outside of the tsunami map and outside of the common grid
+    assert math.isnan(dataframe['MWH'][2])
+    assert dataframe.iloc[3].isna().all()
+
+    # the stack can be used instead of the shakemap in the damage engine
+    engine = gfzwpsformatconversions.DamageEngine(
+        gfzwpsformatconversions.Exposure.from_string(
+            _read_testinput('exposure_sara.json')
+        ),
+        gfzwpsformatconversions.Fragility.from_string(
+            _read_testinput('fragility_sara.json')
+        )
+    )
+    assert np.allclose(
+        engine.compute(stack).to_loss_array(),
+        engine.compute(shakemap).to_loss_array()
+    )
+
+
+def test_shakemap_to_geotiff():
+    '''
+    Tests the writing of the shakemap as tiled
+    geotiff with overviews.
+    '''
+    import rasterio  # pylint: disable=import-outside-toplevel
+
+    shakemap = gfzwpsformatconversions.Shakemap.from_stream(
+        gfzwpsformatconversions.generate_shakemap(
+            300, 200, lon_min=-72.0, lat_max=-32.0, spacing=0.01
+        )
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'shakemap.tif')
+        shakemap.to_geotiff(path, block_size=64, overviews=True)
+        assert os.listdir(directory) == ['shakemap.tif']
+
+        with rasterio.open(path) as dataset:
+            assert dataset.count == 2
+            assert (dataset.height, dataset.width) == (300, 200)
+            assert dataset.descriptions == ('PGA', 'STDPGA')
+            assert dataset.tags(1)['units'] == 'g'
+            assert dataset.block_shapes[0] == (64, 64)
+            assert dataset.compression.value == 'DEFLATE'
+            assert dataset.overviews(1) == [2, 4]
+            assert np.allclose(
+                dataset.bounds,
+                (-72.005, -34.995, -70.005, -31.995)
+            )
+            pga = dataset.read(1)
+        assert np.allclose(pga, shakemap.to_dense_grid('PGA'), atol=1e-6)
+
+        path = os.path.join(directory, 'stdpga.tif')
+        shakemap.to_geotiff(path, bands=['STDPGA'], tiled=False, compress=None)
+        with rasterio.open(path) as dataset:
+            assert dataset.count == 1
+            assert dataset.overviews(1) == []
+            assert dataset.compression is None
+
+        # a grid with a missing point, the windows are filled
+        # from the points in their rows
+        shakemap = gfzwpsformatconversions.Shakemap.from_xml(
+            le.fromstring(_read_testinput('shakemap.xml'))
+        )
+        pga = shakemap.to_dense_grid('PGA')
+        assert np.isnan(pga).sum() == 1
+        path = os.path.join(directory, 'pga.tif')
+        shakemap.to_geotiff(path, bands=['PGA'], block_size=16)
+        with rasterio.open(path) as dataset:
+            assert np.isnan(dataset.nodata)
+            assert np.allclose(dataset.read(1), pga, equal_nan=True)
+
+        # the nodata value must fit into integer dtypes
+        path = os.path.join(directory, 'pga_int.tif')
+        shakemap.to_geotiff(path, bands=['PGA'], dtype='int16')
+        with rasterio.open(path) as dataset:
+            assert dataset.dtypes == ('int16',)
+            assert dataset.nodata == -32768
+            assert np.array_equal(
+                dataset.read(1),
+                np.where(np.isnan(pga), -32768, np.rint(pga))
+            )
+
+
+def test_zonal_statistics():
+    '''
+    Tests the intensity statistics for the
+    polygons of the exposure model.
+    '''
+    import shapely.geometry  # pylint: disable=import-outside-toplevel
+
+    geojson = json.loads(_read_testinput('exposure_sara.json'))
+    # a polygon smaller than a cell and one outside of the grid
+    for lon, size in ((-71.6001, 0.001), (-60.0, 0.1)):
+        geojson['features'].append({
+            'type': 'Feature',
+            'geometry': shapely.geometry.mapping(
+                shapely.geometry.box(lon, -33.0, lon + size, -33.0 + size)
+            ),
+            'properties': {},
+        })
+    exposure = gfzwpsformatconversions.Exposure.from_geojson(geojson)
+
+    def create_shakemap(seed):
+        return gfzwpsformatconversions.Shakemap.from_stream(
+            gfzwpsformatconversions.generate_shakemap(
+                40, 50, lon_min=-71.8, lat_max=-32.8, spacing=0.01, seed=seed
+            )
+        )
+
+    gfzwpsformatconversions.ZonalStatistics.clear_cache()
+    registry = gfzwpsformatconversions.CounterRegistry()
+    gfzwpsformatconversions.add_instrumentation_sink(registry)
+    try:
+        shakemap = create_shakemap(1)
+        statistics = gfzwpsformatconversions.ZonalStatistics(
+            exposure
+        ).to_dataframe(shakemap, 'PGA')
+        # an other instance for the same exposure and grid uses the cache
+        gfzwpsformatconversions.ZonalStatistics(exposure).to_dataframe(
+            create_shakemap(2),
+            'PGA'
+        )
+    finally:
+        gfzwpsformatconversions.remove_instrumentation_sink(registry)
+    assert registry.get_counters()['ZonalStatistics.rasterize']['calls'] == 1
+
+    spec = shakemap.get_grid_specification()
+    lons, lats = np.meshgrid(
+        spec['lon_min'] + np.arange(spec['nlon']) * 0.01,
+        spec['lat_max'] - np.arange(spec['nlat']) * 0.01
+    )
+    pga = shakemap.to_values_at(lons.ravel(), lats.ravel(), 'PGA')
+    for index in range(3):
+        shape = shapely.geometry.shape(geojson['features'][index]['geometry'])
+        inside = np.array([
+            shape.contains(shapely.geometry.Point(lon, lat))
+            for lon, lat in zip(lons.ravel(), lats.ravel())
+        ])
+        row = statistics.iloc[index]
+        assert row['n_cells'] == inside.sum() > 0
+        assert np.isclose(row['min'], pga[inside].min())
+        assert np.isclose(row['mean'], pga[inside].mean())
+        assert np.isclose(row['max'], pga[inside].max())
+
+    assert statistics.iloc[3]['n_cells'] == 1
+    assert np.isclose(
+        statistics.iloc[3]['mean'],
+        shakemap.to_values_at([-71.6], [-33.0], 'PGA')[0]
+    )
+    assert statistics.iloc[4]['n_cells'] == 0
+    assert statistics.iloc[4][['min', 'mean', 'max']].isna().all()
+
+
+def test_map_payload():
+    '''
+    Tests the compact geojson for the damage layer.
+    '''
+    damage_result = gfzwpsformatconversions.DamageResult.from_geojson({
+        'type': 'FeatureCollection',
+        'features': [
+            {
+                'type': 'Feature',
+                'geometry': feature['geometry'],
+                'properties': {
+                    'name': feature['properties']['name'],
+                    'loss_value': loss_value,
+                },
+            }
+            for feature, loss_value in zip(
+                json.loads(_read_testinput('exposure_sara.json'))['features'],
+                [0.0, 2e9, 5e8]
+            )
+        ],
+    })
+    payload = gfzwpsformatconversions.MapPayload.from_damage_result(
+        damage_result
+    )
+
+    geojson = payload.to_geojson(columns=['name', 'loss_value'], precision=3)
+    styles = [
+        feature['properties']['style'] for feature in geojson['features']
+    ]
+    assert [style['fillColor'] for style in styles] == [
+        '#ffffb2', '#bd0026', '#fecc5c'
+    ]
+    assert styles[0]['color'] == 'grey'
+    assert geojson['features'][1]['properties']['name'] == 'Valparaiso'
+    ring = geojson['features'][0]['geometry']['coordinates'][0][0]
+    assert all(round(value, 3) == value for point in ring for value in point)
+    # equal points after the rounding are removed
+    assert all(ring[i] != ring[i + 1] for i in range(len(ring) - 1))
+
+    # rings that collapse by the rounding stay valid
+    small_square = [
+        [-71.501, -33.001], [-71.499, -33.001], [-71.499, -32.999],
+        [-71.501, -32.999], [-71.501, -33.001]
+    ]
+    collapsing = gfzwpsformatconversions.MapPayload(
+        np.array([
+            {'type': 'Polygon', 'coordinates': [small_square]},
+            {'type': 'LineString', 'coordinates': small_square[:2]},
+        ]),
+        pd.DataFrame({'loss_value': [1.0, 2.0]})
+    ).to_geojson(precision=1)
+    polygon, line = [
+        feature['geometry']['coordinates']
+        for feature in collapsing['features']
+    ]
+    assert len(polygon[0]) == 5
+    assert polygon[0][0] == polygon[0][-1] == [-71.5, -33.0]
+    assert line == [[-71.5, -33.0], [-71.5, -33.0]]
+    for feature in geojson['features']:
+        for polygon in feature['geometry']['coordinates']:
+            for ring in polygon:
+                assert len(ring) >= 4
+                assert ring[0] == ring[-1]
+
+    assert list(gfzwpsformatconversions.MapPayload.to_colors(
+        [np.nan, 1.0, 3.0, 5.0]
+    )) == ['#808080', '#ffffb2', '#fd8d3c', '#bd0026']
+
+    full_text = payload.to_string()
+    text = payload.to_string(max_bytes=len(full_text) // 4)
+    assert len(text) <= len(full_text) // 4
+    assert len(json.loads(text)['features']) == 3
+    try:
+        payload.to_string(max_bytes=100)
+        assert False
+    except Exception as exception:  # pylint: disable=broad-except
+        message = str(exception)
+        assert message == 'The map payload does not fit in 100 bytes'
+
+
+def test_geojson_writer():
+    '''
+    Tests the streaming geojson writer for the
+    exposure model and the damage result.
+    '''
+    raw_exposure = _read_testinput('exposure_sara.json')
+    exposure = gfzwpsformatconversions.Exposure.from_string(raw_exposure)
+
+    output = io.BytesIO()
+    exposure.write(output, compression=None)
+    # same structure as the assetmaster output
+    assert json.loads(output.getvalue()) == json.loads(raw_exposure)
+
+    writer = gfzwpsformatconversions.GeoJsonWriter(
+        exposure.to_geometry_array(),
+        exposure.to_properties_dataframe(),
+        ('expo', exposure.to_expo_dataframe()),
+        exposure.get_crs(),
+        features_per_chunk=2
+    )
+    chunks = list(writer.iterate_chunks())
+    assert len(chunks) == 6
+    assert ''.join(chunks).encode('utf-8') == output.getvalue()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'exposure.json.gz')
+        exposure.write(path, precision=3)
+        with open(path, 'rb') as input_file:
+            rounded = gfzwpsformatconversions.Exposure.from_stream(
+                input_file
+            )
+    ring = rounded.to_geometry_array()[0]['coordinates'][0][0]
+    original_ring = exposure.to_geometry_array()[0]['coordinates'][0][0]
+    assert np.allclose(ring, np.round(original_ring, 3))
+    pd.testing.assert_frame_equal(
+        rounded.to_expo_dataframe(),
+        exposure.to_expo_dataframe()
+    )
+
+    damage_result = gfzwpsformatconversions.DamageResult.from_geojson({
+        'type': 'FeatureCollection',
+        'features': [
+            {
+                'type': 'Feature',
+                'geometry': feature['geometry'],
+                'properties': {
+                    'gid': feature['properties']['gid'],
+                    'loss_value': loss_value,
+                    'loss_unit': 'USD',
+                },
+            }
+            for feature, loss_value in zip(
+                json.loads(raw_exposure)['features'],
+                [np.nan, 2e9, 5e8]
+            )
+        ],
+    })
+    output = io.BytesIO()
+    damage_result.write(output, compression=None)
+    damage_geojson = json.loads(output.getvalue())
+    assert damage_geojson['features'][0]['properties']['loss_value'] is None
+    assert damage_geojson['features'][1]['properties'] == {
+        'gid': 'CHL.16.7.5_1',
+        'loss_value': 2e9,
+        'loss_unit': 'USD',
+    }
+
+    geojson = json.loads(
+        gfzwpsformatconversions.GeoJsonWriter.from_geodataframe(
+            exposure.to_geodataframe(),
+            precision=2
+        ).to_string()
+    )
+    assert geojson['features'][2]['properties']['name'] == 'Vina del Mar'
+    assert geojson['features'][2]['geometry']['type'] == 'MultiPolygon'
+
+    # dates and times as iso strings, NaT as null
+    geodataframe = exposure.to_geodataframe()
+    geodataframe['updated'] = pd.to_datetime([
+        pd.Timestamp('2019-08-08T12:31:27.890823'),
+        None,
+        pd.Timestamp('2020-01-01'),
+    ])
+    geodataframe['updated_utc'] = geodataframe['updated'].dt.tz_localize(
+        'UTC'
+    )
+    geojson = json.loads(
+        gfzwpsformatconversions.GeoJsonWriter.from_geodataframe(
+            geodataframe
+        ).to_string()
+    )
+    properties = [
+        feature['properties'] for feature in geojson['features']
+    ]
+    assert [item['updated'] for item in properties] == [
+        '2019-08-08T12:31:27.890823', None, '2020-01-01T00:00:00'
+    ]
+    assert properties[0]['updated_utc'] == '2019-08-08T12:31:27.890823+00:00'
+    assert properties[1]['updated_utc'] is None
+
+
+def test_incremental_damage():
+    '''
+    Tests the diff of two shakemap versions and the
+    recomputation of the damage for the changed cells.
+    '''
+    old_shakemap = gfzwpsformatconversions.Shakemap.from_stream(
+        gfzwpsformatconversions.generate_shakemap(
+            60, 60, lon_min=-71.8, lat_max=-32.8, spacing=0.01
+        )
+    )
+    exposure = gfzwpsformatconversions.Exposure.from_string(
+        _read_testinput('exposure_sara.json')
+    )
+    lons, lats = exposure.to_centroids()
+
+    # the new version has higher values around the second feature
+    # and tiny changes everywhere else
+    grid = old_shakemap.to_grid_array().copy()
+    near = (np.abs(grid[:, 0] - lons[1]) < 0.03) & \
+        (np.abs(grid[:, 1] - lats[1]) < 0.03)
+    grid[:, 2] += 1e-9
+    grid[near, 2] *= 1.5
+    new_xml = le.fromstring(le.tostring(old_shakemap.to_xml()))
+    new_xml.find('grid_data', namespaces=new_xml.nsmap).text = '\n'.join(
+        ' '.join(repr(value) for value in row) for row in grid.tolist()
+    )
+    new_shakemap = gfzwpsformatconversions.Shakemap.from_xml(new_xml)
+
+    diff = gfzwpsformatconversions.ShakemapDiff.from_shakemaps(
+        old_shakemap,
+        new_shakemap
+    )
+    assert diff.get_changed_count() == near.sum() > 0
+    assert list(diff.is_changed_at(lons, lats)) == [False, True, False]
+    assert not diff.is_changed_at([-80.0], [-33.0])[0]
+    assert gfzwpsformatconversions.ShakemapDiff.from_shakemaps(
+        old_shakemap,
+        new_shakemap,
+        tolerance=10.0
+    ).get_changed_count() == 0
+
+    engine = gfzwpsformatconversions.DamageEngine(
+        exposure,
+        gfzwpsformatconversions.Fragility.from_string(
+            _read_testinput('fragility_sara.json')
+        )
+    )
+    old_result = engine.compute(old_shakemap)
+    registry = gfzwpsformatconversions.CounterRegistry()
+    gfzwpsformatconversions.add_instrumentation_sink(registry)
+    looked_up_lons = []
+    to_values_at = new_shakemap.to_values_at
+
+    def recording_to_values_at(lons, lats, value_column):
+        looked_up_lons.extend(lons)
+        return to_values_at(lons, lats, value_column)
+
+    new_shakemap.to_values_at = recording_to_values_at
+    try:
+        updated_result = engine.update(old_result, new_shakemap, diff)
+    finally:
+        gfzwpsformatconversions.remove_instrumentation_sink(registry)
+        del new_shakemap.to_values_at
+    # the intensities of the unchanged features are not evaluated
+    assert looked_up_lons and set(looked_up_lons) == {lons[1]}
+    full_result = engine.compute(new_shakemap)
+
+    # only the rows of the second feature were recomputed
+    assert registry.get_counters()['DamageEngine.update']['count'] == (
+        exposure.to_expo_dataframe()['feature'] == 1
+    ).sum()
+    pd.testing.assert_frame_equal(
+        updated_result.to_updated_exposure().to_expo_dataframe(),
+        full_result.to_updated_exposure().to_expo_dataframe()
+    )
+    pd.testing.assert_frame_equal(
+        updated_result.to_transition_dataframe(),
+        full_result.to_transition_dataframe()
+    )
+    pd.testing.assert_frame_equal(
+        updated_result.to_taxonomy_loss_dataframe(),
+        full_result.to_taxonomy_loss_dataframe()
+    )
+    assert np.allclose(
+        updated_result.to_loss_array(),
+        full_result.to_loss_array()
+    )
+    assert updated_result.to_loss_array()[1] > old_result.to_loss_array()[1]
+
+    # nothing changed
+    assert engine.update(
+        old_result,
+        old_shakemap,
+        gfzwpsformatconversions.ShakemapDiff.from_shakemaps(
+            old_shakemap,
+            old_shakemap
+        )
+    ) is old_result